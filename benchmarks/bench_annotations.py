@@ -0,0 +1,70 @@
+import os
+
+from viewmask import Annotations, PackedAnnotations
+from viewmask.utils import centers_of_contours
+
+from .synthetic import region_grid_size, write_tcga_xml
+
+VERTEX_COUNTS = [10_000, 100_000, 1_000_000]
+
+
+def _write_inputs():
+    inputs = {}
+    for n_vertices in VERTEX_COUNTS:
+        path = os.path.abspath(f'annotations-{n_vertices}.xml')
+        n_regions = write_tcga_xml(path, n_vertices)
+        inputs[n_vertices] = path, region_grid_size(n_regions)
+    return inputs
+
+
+class FromTCGA:
+    params = VERTEX_COUNTS
+    param_names = ['n_vertices']
+    timeout = 600
+
+    def setup_cache(self):
+        return _write_inputs()
+
+    def time_annotations(self, inputs, n_vertices):
+        Annotations.from_tcga(inputs[n_vertices][0])
+
+    def peakmem_annotations(self, inputs, n_vertices):
+        Annotations.from_tcga(inputs[n_vertices][0])
+
+    def time_packed_annotations(self, inputs, n_vertices):
+        PackedAnnotations.from_tcga(inputs[n_vertices][0])
+
+    def peakmem_packed_annotations(self, inputs, n_vertices):
+        PackedAnnotations.from_tcga(inputs[n_vertices][0])
+
+
+class Rendering:
+    params = VERTEX_COUNTS
+    param_names = ['n_vertices']
+    timeout = 600
+
+    def setup_cache(self):
+        return _write_inputs()
+
+    def setup(self, inputs, n_vertices):
+        path, (height, width) = inputs[n_vertices]
+        self.annotations = Annotations.from_tcga(path)
+        self.packed = PackedAnnotations.from_tcga(path)
+        self.shape = (height, width, 3)
+
+    def time_centers_of_contours(self, inputs, n_vertices):
+        centers_of_contours(self.packed)
+
+    def time_as_image(self, inputs, n_vertices):
+        self.annotations.as_image(shape=self.shape)
+
+    def peakmem_as_image(self, inputs, n_vertices):
+        self.annotations.as_image(shape=self.shape)
+
+    def time_as_image_chunked(self, inputs, n_vertices):
+        self.annotations.as_image(
+            shape=self.shape, chunks=(2048, 2048)).max(axis=(0, 1)).compute()
+
+    def peakmem_as_image_chunked(self, inputs, n_vertices):
+        self.annotations.as_image(
+            shape=self.shape, chunks=(2048, 2048)).max(axis=(0, 1)).compute()
@@ -0,0 +1,41 @@
+import os
+
+import dask.array as da
+import numpy as np
+
+from viewmask.utils import mask_to_contours
+
+from .synthetic import write_mask
+
+MASK_SIZES = [2048, 8192, 16384]
+
+
+class MaskToContours:
+    params = MASK_SIZES
+    param_names = ['size']
+    timeout = 600
+
+    def setup_cache(self):
+        paths = {}
+        for size in MASK_SIZES:
+            paths[size] = os.path.abspath(f'mask-{size}.npy')
+            write_mask(paths[size], size)
+        return paths
+
+    def setup(self, paths, size):
+        self.mask = np.load(paths[size])
+
+    def time_dense(self, paths, size):
+        mask_to_contours(self.mask)
+
+    def peakmem_dense(self, paths, size):
+        mask_to_contours(self.mask)
+
+    def time_tiled(self, paths, size):
+        mask_to_contours(
+            da.from_array(self.mask, chunks=2048), tiled=True)
+
+    def peakmem_tiled(self, paths, size):
+        mask_to_contours(
+            da.from_array(np.load(paths[size], mmap_mode='r'), chunks=2048),
+            tiled=True)
@@ -0,0 +1,33 @@
+import os
+
+from viewmask.utils import file_to_dask_array
+
+from .synthetic import write_tiled_tiff
+
+# from 4 megapixels to 1 gigapixel
+SLIDE_SIZES = [2048, 8192, 32768]
+
+
+class FileToDaskArray:
+    params = SLIDE_SIZES
+    param_names = ['size']
+    repeat = (1, 3, 60.0)
+    timeout = 1800
+
+    def setup_cache(self):
+        paths = {}
+        for size in SLIDE_SIZES:
+            paths[size] = os.path.abspath(f'slide-{size}.tif')
+            write_tiled_tiff(paths[size], size)
+        return paths
+
+    def time_build_graph(self, paths, size):
+        file_to_dask_array(paths[size], multiscale=True)
+
+    def time_read_level_0(self, paths, size):
+        # reduce every tile as it is read, so the whole slide never has to
+        # be held in memory
+        file_to_dask_array(paths[size], cache=False).max(axis=(0, 1)).compute()
+
+    def peakmem_read_level_0(self, paths, size):
+        file_to_dask_array(paths[size], cache=False).max(axis=(0, 1)).compute()
@@ -0,0 +1,136 @@
+"""Generators for the synthetic inputs of the benchmarks.
+
+Every generator is deterministic for a given seed and writes its output
+incrementally, so that inputs with millions of vertices or billions of
+pixels can be created without holding them in memory.
+"""
+import numpy as np
+
+# every region is a noisy circle, laid out on a square grid
+REGION_RADIUS = 20
+REGION_SPACING = 50
+
+
+def region_grid_size(n_regions):
+    """Return the height and width of the canvas that `n_regions` fill."""
+    side = int(np.ceil(np.sqrt(n_regions))) * REGION_SPACING
+    return side, side
+
+
+def write_tcga_xml(path, n_vertices, vertices_per_region=50, seed=0):
+    """Write a TCGA XML annotations file with about `n_vertices` vertices.
+
+    Parameters
+    ----------
+    path : str
+        The path of the XML file.
+    n_vertices : int
+        The total number of vertices, split into regions of
+        `vertices_per_region` vertices each.
+    vertices_per_region : int, optional
+        The number of vertices of every region.
+    seed : int, optional
+        The seed of the random jitter of the vertices.
+
+    Returns
+    -------
+    n_regions : int
+        The number of regions that were written.
+    """
+    rng = np.random.default_rng(seed)
+    n_regions = max(1, n_vertices // vertices_per_region)
+    columns = region_grid_size(n_regions)[1] // REGION_SPACING
+    angles = np.linspace(0, 2 * np.pi, vertices_per_region, endpoint=False)
+    with open(path, 'w') as f:
+        f.write(
+            '<Annotations MicronsPerPixel="0.252100">'
+            '<Annotation Id="1" LineColor="65280"><Regions>\n')
+        for region in range(n_regions):
+            cy, cx = divmod(region, columns)
+            center = (np.array([cx, cy]) + 0.5) * REGION_SPACING
+            radius = REGION_RADIUS * rng.uniform(0.8, 1.2, len(angles))
+            x = center[0] + radius * np.cos(angles)
+            y = center[1] + radius * np.sin(angles)
+            vertices = ''.join(
+                f'<Vertex X="{vx:.1f}" Y="{vy:.1f}"/>' for vx, vy in zip(x, y))
+            f.write(
+                f'<Region Id="{region + 1}"><Vertices>{vertices}'
+                '</Vertices></Region>\n')
+        f.write('</Regions></Annotation></Annotations>\n')
+    return n_regions
+
+
+def write_mask(path, size, seed=0, band_height=4096):
+    """Write a square ``.npy`` mask of white disks on a black background.
+
+    Parameters
+    ----------
+    path : str
+        The path of the ``.npy`` file.
+    size : int
+        The height and width of the mask.
+    seed : int, optional
+        The seed of the random radii of the disks.
+    band_height : int, optional
+        The number of rows that are drawn at a time.
+    """
+    import cv2
+
+    rng = np.random.default_rng(seed)
+    centers = np.arange(REGION_SPACING // 2, size, REGION_SPACING)
+    radii = rng.integers(
+        REGION_RADIUS // 2, REGION_RADIUS, (len(centers), len(centers)))
+    mask = np.lib.format.open_memmap(
+        path, mode='w+', dtype=np.uint8, shape=(size, size))
+    for y0 in range(0, size, band_height):
+        band = np.zeros((min(band_height, size - y0), size), dtype=np.uint8)
+        rows = np.flatnonzero(
+            np.abs(centers - y0 - band.shape[0] / 2)
+            <= band.shape[0] / 2 + REGION_RADIUS)
+        for row in rows:
+            for column, cx in enumerate(centers):
+                cv2.circle(
+                    band, (int(cx), int(centers[row] - y0)),
+                    int(radii[row, column]), 255, thickness=-1)
+        mask[y0:y0 + band.shape[0]] = band
+    mask.flush()
+    del mask
+
+
+def write_tiled_tiff(path, size, tile_size=512, seed=0):
+    """Write a square RGB slide as a tiled, zlib-compressed TIFF file.
+
+    The slide is a smooth pink background with noise, which compresses
+    about as well as stained tissue, so that reading it costs about as
+    much decoding as reading a real slide.
+
+    Parameters
+    ----------
+    path : str
+        The path of the TIFF file.
+    size : int
+        The height and width of the slide.
+    tile_size : int, optional
+        The height and width of the tiles in the file.
+    seed : int, optional
+        The seed of the noise.
+    """
+    import tifffile
+
+    rng = np.random.default_rng(seed)
+    pink = np.array([230, 170, 200], dtype=np.int16)
+    gradient = np.linspace(-20, 20, tile_size, dtype=np.int16)
+
+    n_tiles = -(-size // tile_size)
+
+    def tiles():
+        for _ in range(n_tiles * n_tiles):
+            noise = rng.integers(-8, 8, (tile_size, tile_size, 1), np.int16)
+            tile = pink + gradient[:, None, None] + noise
+            yield tile.astype(np.uint8)
+
+    tifffile.imwrite(
+        path, tiles(), shape=(size, size, 3), dtype=np.uint8,
+        tile=(tile_size, tile_size), photometric='rgb',
+        compression='zlib', compressionargs={'level': 1},
+        bigtiff=size * size * 3 > 2 ** 32 - 2 ** 25)
@@ -1,5 +1,784 @@
+import pytest
 from viewmask import __version__
 
 
+@pytest.fixture(autouse=True)
+def annotation_cache_dir(tmp_path_factory, monkeypatch):
+    # keep the CLI from writing to the annotation cache in the home directory
+    cache_dir = str(tmp_path_factory.mktemp('cache'))
+    monkeypatch.setenv('VIEWMASK_CACHE_DIR', cache_dir)
+    return cache_dir
+
+
 def test_version():
     assert __version__ == '0.3.1'
+
+
+def test_file_to_dask_array_multiscale(tmp_path):
+    import numpy as np
+    from viewmask.utils import file_to_dask_array
+
+    path = str(tmp_path / 'mask.npy')
+    np.save(path, np.zeros((1024, 600, 3), dtype=np.uint8))
+    pyramid = file_to_dask_array(path, multiscale=True)
+    assert [level.shape for level in pyramid] == [
+        (1024, 600, 3), (512, 300, 3)]
+
+
+def test_file_to_dask_array_slide(tmp_path):
+    import numpy as np
+    import pytest
+    pytest.importorskip('openslide')
+    tifffile = pytest.importorskip('tifffile')
+    from viewmask.utils import file_to_dask_array
+
+    path = str(tmp_path / 'slide.tif')
+    img = np.random.default_rng(0).integers(
+        0, 255, (700, 500, 3), dtype=np.uint8)
+    tifffile.imwrite(path, img, tile=(256, 256), photometric='rgb')
+    arr = file_to_dask_array(path, tile_size=300)
+    assert arr.chunks == ((300, 300, 100), (300, 200), (3,))
+    np.testing.assert_array_equal(arr.compute(), img)
+
+
+def test_tile_cache_evicts_least_recently_used():
+    import numpy as np
+    from viewmask.utils import TileCache
+
+    cache = TileCache(max_bytes=200)
+    cache.put('a', np.zeros(100, dtype=np.uint8))
+    cache.put('b', np.zeros(100, dtype=np.uint8))
+    assert cache.get('a') is not None  # 'b' is now the oldest
+    cache.put('c', np.zeros(100, dtype=np.uint8))
+    assert 'b' not in cache and 'a' in cache and 'c' in cache
+    assert (cache.hits, cache.misses, cache.evictions) == (1, 0, 1)
+
+
+TCGA_XML = (
+    '<Annotations><Annotation LineColor="65280"><Regions>'
+    '<Region><Vertices><Vertex X="1.5" Y="2"/><Vertex X="10" Y="2"/>'
+    '<Vertex X="10" Y="12.9"/></Vertices></Region>'
+    '<Region><Vertices><Vertex X="20" Y="20"/><Vertex X="30" Y="20"/>'
+    '<Vertex X="30" Y="30"/><Vertex X="20" Y="30"/></Vertices></Region>'
+    '</Regions></Annotation></Annotations>'
+)
+
+
+def test_parse_tcga_xml_matches_tree(tmp_path):
+    import numpy as np
+    import xml.etree.ElementTree as ET
+    from viewmask import Annotations
+    from viewmask.utils import parse_tcga_xml
+
+    path = tmp_path / 'annotations.xml'
+    path.write_text(TCGA_XML)
+    coordinates, offsets = parse_tcga_xml(str(path), initial_capacity=1)
+    assert coordinates.shape == (7, 2) and offsets.tolist() == [0, 3, 7]
+    streamed = Annotations.from_tcga(str(path))
+    parsed = Annotations.from_tcga(ET.parse(str(path)))
+    for streamed_contour, parsed_contour in zip(streamed, parsed):
+        np.testing.assert_array_equal(streamed_contour, parsed_contour)
+    # a file without regions has no contours, not one empty contour
+    path.write_text('<Annotations><Annotation><Regions/></Annotation>'
+                    '</Annotations>')
+    assert len(Annotations.from_tcga(str(path))) == 0
+    assert len(Annotations.from_tcga(str(path), fit_spline=True)) == 0
+
+
+def test_packed_annotations_list_api():
+    import numpy as np
+    from viewmask import Annotations, PackedAnnotations
+
+    contours = [
+        np.array([[0, 0], [4, 0], [4, 4]], dtype=np.int32),
+        np.array([[1, 1], [2, 1], [2, 2], [1, 2]], dtype=np.int32),
+        np.array([[5, 5], [9, 5], [9, 9]], dtype=np.int32),
+    ]
+    packed = PackedAnnotations(contours)
+    assert len(packed) == 3 and packed.offsets.tolist() == [0, 3, 7, 10]
+    np.testing.assert_array_equal(packed[-1], contours[-1])
+    assert np.shares_memory(packed[1:].coordinates, packed.coordinates)
+    np.testing.assert_array_equal(packed[[2, 0]][0], contours[2])
+    packed.append(contours[0])
+    assert len(packed + Annotations(contours)) == 7
+    assert [c.shape for c in packed.export('napari')] == [
+        (3, 2), (4, 2), (3, 2), (3, 2)]
+
+    assert len(packed[[]]) == 0
+    copy = packed.copy()
+    del copy[1]
+    np.testing.assert_array_equal(copy.pop(), contours[0])
+    copy.remove(contours[2])
+    assert len(copy) == 1 and len(packed) == 4
+    np.testing.assert_array_equal(copy[0], contours[0])
+    copy.clear()
+    assert len(copy) == 0
+    # floats are kept, instead of being truncated to the default int32
+    copy.extend([np.array([[0.5, 1.5], [2.5, 3.5], [4.0, 0.0]])])
+    np.testing.assert_array_equal(copy[0][0], [0.5, 1.5])
+
+
+def test_centers_of_contours_matches_moments():
+    import cv2
+    import numpy as np
+    from viewmask.utils import centers_of_contours
+
+    rng = np.random.default_rng(0)
+    contours = [
+        rng.integers(0, 1000, (n, 2)).astype(np.int32)
+        for n in rng.integers(1, 20, 100)
+    ] + [np.array([[3, 3], [5, 3], [7, 3]], dtype=np.int32)]  # no area
+    expected = []
+    for contour in contours:
+        M = cv2.moments(contour)
+        if M["m00"] != 0:
+            expected.append((int(M["m10"] / M["m00"]),
+                             int(M["m01"] / M["m00"])))
+        else:
+            (x, y), _ = cv2.minEnclosingCircle(contour)
+            expected.append((int(x), int(y)))
+    assert centers_of_contours(contours) == expected
+
+
+def test_as_image_chunks_match_dense():
+    import numpy as np
+    from viewmask import Annotations, PackedAnnotations
+
+    rng = np.random.default_rng(0)
+    annotations = Annotations([
+        rng.integers(0, 200, (n, 2)).astype(np.int32)
+        for n in rng.integers(3, 12, 20)
+    ])
+    dense = annotations.as_image(shape=(200, 200))
+    tiled = annotations.as_image(shape=(200, 200), chunks=(64, 48))
+    assert tiled.chunks[:2] == ((64, 64, 64, 8), (48, 48, 48, 48, 8))
+    np.testing.assert_array_equal(tiled.compute(), dense)
+    # packed contours are drawn from their columns, at the same default shape
+    scaled = Annotations(annotations).scale(0.75)
+    np.testing.assert_array_equal(
+        PackedAnnotations(scaled).as_image(), scaled.as_image())
+
+
+def test_bounding_box_index_query():
+    import numpy as np
+    from viewmask import Annotations, PackedAnnotations
+    from viewmask.utils import BoundingBoxIndex
+
+    rng = np.random.default_rng(0)
+    corners = rng.integers(0, 10000, (2000, 2))
+    bboxes = np.hstack((corners, corners + rng.integers(0, 50, (2000, 2))))
+    bboxes[0, 2:] += 9000  # spans too many cells to be gridded
+    index = BoundingBoxIndex(bboxes)
+    for query in [(0, 0, 100, 100), (5000, 2000, 7500, 2600), (-5, -5, -1, -1)]:
+        expected = np.flatnonzero(
+            (bboxes[:, 0] <= query[2]) & (bboxes[:, 2] >= query[0])
+            & (bboxes[:, 1] <= query[3]) & (bboxes[:, 3] >= query[1]))
+        np.testing.assert_array_equal(index.query(query), expected)
+
+    annotations = PackedAnnotations([
+        np.array([[0, 0], [10, 0], [10, 10]]),
+        np.array([[100, 100], [110, 100], [110, 110]]),
+    ])
+    assert annotations.query((5, 5, 50, 50)).tolist() == [0]
+
+    annotations = Annotations(list(annotations))
+    assert annotations.query((5, 5, 50, 50)).tolist() == [0]
+    annotations.reverse()
+    assert annotations.query((5, 5, 50, 50)).tolist() == [1]
+    annotations.append(np.array([[0, 0], [20, 20], [0, 20]]))
+    del annotations[1]
+    assert annotations.query((5, 5, 50, 50)).tolist() == [1]
+    annotations += [np.array([[40, 40], [60, 40], [60, 60]])]
+    assert annotations.query((5, 5, 50, 50)).tolist() == [1, 2]
+    annotations.scale(0.1)
+    assert annotations.query((5, 5, 50, 50)).tolist() == [0, 2]
+
+
+def test_mask_to_contours_tiled_stitches_chunks():
+    import cv2
+    import dask.array as da
+    import numpy as np
+    from viewmask.utils import mask_to_contours
+
+    mask = np.zeros((300, 400), dtype=np.uint8)
+    cv2.circle(mask, (200, 150), 120, 255, -1)  # spans every chunk
+    cv2.circle(mask, (200, 150), 30, 0, -1)  # with a hole
+    cv2.circle(mask, (30, 30), 10, 255, -1)
+
+    def normalized(contours):
+        # start every contour at its smallest point, order is not important
+        result = []
+        for contour in contours:
+            points = [tuple(point) for point in contour.reshape(-1, 2).tolist()]
+            start = points.index(min(points))
+            result.append(tuple(points[start:] + points[:start]))
+        return sorted(result)
+
+    tiled = mask_to_contours(
+        da.from_array(mask, chunks=(64, 64)), tiled=True, halo=8)
+    assert len(tiled) == 3
+    assert normalized(tiled) == normalized(mask_to_contours(mask))
+
+
+def test_mask_to_contours_tiled_skips_contours_found_whole(monkeypatch):
+    import cv2
+    import dask
+    import dask.array as da
+    import numpy as np
+    from viewmask import utils
+
+    mask = np.zeros((256, 256), dtype=np.uint8)
+    for x in range(4, 256, 20):
+        for y in range(4, 256, 20):
+            cv2.circle(mask, (x, y), 5, 255, -1)  # many cross chunk edges
+    calls = []
+    find_contours = utils._find_contours
+
+    def counting_find_contours(*args):
+        calls.append(args[1:])
+        return find_contours(*args)
+
+    monkeypatch.setattr(utils, '_find_contours', counting_find_contours)
+    with dask.config.set(scheduler='sync'):
+        tiled = utils.mask_to_contours(
+            da.from_array(mask, chunks=(64, 64)), tiled=True, halo=8)
+    assert len(tiled) == 169
+    # every disk fits in its owner's halo, so no region is searched again
+    assert len(calls) == 16
+
+
+def test_fit_spline_adapts_to_arc_length(tmp_path):
+    import numpy as np
+    from viewmask import Annotations
+    from viewmask.utils import fit_spline_to_points, fit_splines
+
+    angles = np.linspace(0, 2 * np.pi, 12, endpoint=False)
+    small = np.stack((10 + 5 * np.cos(angles), 10 + 5 * np.sin(angles)), 1)
+    large = 10 * small
+    # the arc length is estimated from the perimeter of the polygon
+    assert len(fit_spline_to_points(small)) == 16
+    assert len(fit_spline_to_points(large)) == 156
+    assert len(fit_spline_to_points(small, n_points=1000)) == 1000
+    serial = fit_splines([small, large] * 3, processes=1, batch_size=2)
+    parallel = fit_splines([small, large] * 3, processes=2, batch_size=2)
+    for serial_contour, parallel_contour in zip(serial, parallel):
+        np.testing.assert_array_equal(serial_contour, parallel_contour)
+
+    path = tmp_path / 'annotations.xml'
+    path.write_text(TCGA_XML)
+    fitted = Annotations.from_tcga(str(path), fit_spline=True)
+    assert len(fitted[0]) == 3  # too few vertices for a cubic spline
+    assert len(fitted[1]) == 20 and fitted[1].dtype == np.int32
+
+
+def test_get_hematoxylin_dask_matches_numpy():
+    import dask.array as da
+    import numpy as np
+    from viewmask.utils import get_hematoxylin
+
+    rgb = np.random.default_rng(0).integers(0, 255, (90, 70, 3), np.uint8)
+    lazy = get_hematoxylin(da.from_array(rgb, chunks=(32, 32, 3)))
+    np.testing.assert_allclose(lazy.compute(), get_hematoxylin(rgb))
+    out = np.zeros(rgb.shape[:2], dtype=np.uint8)
+    get_hematoxylin(da.from_array(rgb, chunks=32), dtype=np.uint8, out=out)
+    np.testing.assert_array_equal(out, get_hematoxylin(rgb, dtype=np.uint8))
+
+
+def test_write_image_streams_tiff_and_png(tmp_path):
+    import dask.array as da
+    import numpy as np
+    import tifffile
+    from PIL import Image
+    from viewmask.utils import write_image
+
+    rgb = np.random.default_rng(0).integers(0, 255, (600, 530, 3), np.uint8)
+    lazy = da.from_array(rgb, chunks=(250, 200, 3))
+    write_image(lazy, str(tmp_path / 'out.png'))
+    np.testing.assert_array_equal(
+        np.asarray(Image.open(tmp_path / 'out.png')), rgb)
+    with open(tmp_path / 'out.tif', 'wb') as f:
+        write_image(lazy, f, pyramid=True)
+    with tifffile.TiffFile(tmp_path / 'out.tif') as tif:
+        levels = tif.series[0].levels
+        assert [level.shape for level in levels] == [rgb.shape, (300, 265, 3)]
+        np.testing.assert_array_equal(levels[0].asarray(), rgb)
+        np.testing.assert_array_equal(levels[1].asarray(), rgb[::2, ::2])
+
+
+def test_write_tiff_computes_every_chunk_once(tmp_path):
+    import dask.array as da
+    import numpy as np
+    import tifffile
+    from viewmask.utils import write_tiff
+
+    rgb = np.random.default_rng(0).integers(0, 255, (1100, 600, 3), np.uint8)
+    computed = []
+
+    def record(block, block_info=None):
+        computed.append(block_info[0]['chunk-location'])
+        return block
+
+    # 300-row chunks do not line up with the 256-row bands of tiles
+    lazy = da.from_array(rgb, chunks=(300, 300, 3)).map_blocks(
+        record, dtype=np.uint8)
+    write_tiff(lazy, str(tmp_path / 'out.tif'), pyramid=True)
+    assert sorted(computed) == sorted(
+        (i, j, 0) for i in range(4) for j in range(2))
+    with tifffile.TiffFile(tmp_path / 'out.tif') as tif:
+        levels = tif.series[0].levels
+        np.testing.assert_array_equal(levels[0].asarray(), rgb)
+        np.testing.assert_array_equal(levels[1].asarray(), rgb[::2, ::2])
+
+
+def test_convert_command_creates_store(tmp_path):
+    import numpy as np
+    import pytest
+    pytest.importorskip('zarr')
+    from click.testing import CliRunner
+    from viewmask.cli import cli
+    from viewmask.utils import file_to_dask_array
+
+    path = str(tmp_path / 'mask.npy')
+    mask = np.arange(600 * 520, dtype=np.uint32).reshape(600, 520)
+    np.save(path, mask)
+    result = CliRunner().invoke(cli, ['convert', path, '--tile-size', '128'])
+    assert result.exit_code == 0, result.output
+    assert result.output.strip() == path + '.zarr'
+    arr = file_to_dask_array(path)
+    assert arr.chunksize == (128, 128)
+    np.testing.assert_array_equal(arr.compute(), mask)
+    assert len(file_to_dask_array(path, multiscale=True)) == 2
+    # images keep the frame axis that dask_image reads them with
+    from PIL import Image
+    path = str(tmp_path / 'image.png')
+    rgb = np.random.default_rng(0).integers(
+        0, 256, (300, 260, 3), dtype=np.uint8)
+    Image.fromarray(rgb).save(path)
+    before = file_to_dask_array(path, multiscale=True)
+    result = CliRunner().invoke(cli, ['convert', path, '--tile-size', '128'])
+    assert result.exit_code == 0, result.output
+    after = file_to_dask_array(path, multiscale=True)
+    assert [level.shape for level in after] \
+        == [level.shape for level in before]
+    assert after[0].chunksize == (1, 128, 128, 3)
+    np.testing.assert_array_equal(after[0].compute(), rgb[np.newaxis])
+
+
+def test_convert_command_needs_zarr(tmp_path, monkeypatch):
+    import numpy as np
+    from click.testing import CliRunner
+    from viewmask import cli as cli_module
+
+    path = str(tmp_path / 'mask.npy')
+    np.save(path, np.zeros((10, 10), dtype=np.uint8))
+    monkeypatch.setattr(
+        cli_module, 'find_spec',
+        lambda name: None if name == 'zarr' else object())
+    result = CliRunner().invoke(cli_module.cli, ['convert', path])
+    assert result.exit_code == 2
+    assert 'pip install viewmask[zarr]' in result.output
+
+
+def test_batch_command_skips_existing_outputs(tmp_path):
+    from click.testing import CliRunner
+    from viewmask.cli import cli
+
+    for name in ('a', 'b'):
+        (tmp_path / f'{name}.xml').write_text(TCGA_XML)
+    (tmp_path / 'manifest.csv').write_text(
+        'annotations,output\na.xml,a.png\nb.xml,b.png\n')
+    (tmp_path / 'b.png').write_bytes(b'already rendered')
+    result = CliRunner().invoke(
+        cli, ['batch', str(tmp_path / 'manifest.csv'), '-j', '1'])
+    assert result.exit_code == 0, result.output
+    assert 'Skipping 1 existing output(s).' in result.output
+    assert (tmp_path / 'a.png').read_bytes().startswith(b'\x89PNG')
+    assert (tmp_path / 'b.png').read_bytes() == b'already rendered'
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        'a.png', 'a.xml', 'b.png', 'b.xml', 'manifest.csv']
+
+
+def test_batch_directory_does_not_pair_outputs_with_annotations(tmp_path):
+    from viewmask.cli import _read_batch_manifest
+
+    for name in ('s1.xml', 's1.png', 's1.tif', 's1.npy', 's2.xml', 's2.png',
+                 's3.xml', 's3.jpg', 's3.partial.png'):
+        (tmp_path / name).write_bytes(b'')
+    jobs = _read_batch_manifest(str(tmp_path), None, '.png')
+    assert [
+        (image and image[len(str(tmp_path)) + 1:], output[-6:])
+        for image, _, output in jobs
+    ] == [('s1.tif', 's1.png'), (None, 's2.png'), ('s3.jpg', 's3.png')]
+    # outputs that are written elsewhere are not in the way
+    jobs = _read_batch_manifest(str(tmp_path), str(tmp_path / 'out'), '.tif')
+    assert jobs[1][0] == str(tmp_path / 's2.png')
+
+
+def test_batch_command_fits_many_regions_in_daemonic_workers(
+        tmp_path, monkeypatch):
+    import os
+    from click.testing import CliRunner
+    from viewmask.cli import cli
+
+    # more than one batch of splines, which would otherwise be fit in a
+    # process pool that the daemonic batch workers cannot start
+    regions = ''.join(
+        f'<Region><Vertices><Vertex X="{x}" Y="{y}"/>'
+        f'<Vertex X="{x + 4}" Y="{y}"/><Vertex X="{x + 4}" Y="{y + 4}"/>'
+        f'<Vertex X="{x}" Y="{y + 4}"/></Vertices></Region>'
+        for x in range(0, 460, 10) for y in range(0, 460, 10))
+    (tmp_path / 'a.xml').write_text(
+        '<Annotations><Annotation LineColor="65280"><Regions>'
+        f'{regions}</Regions></Annotation></Annotations>')
+    monkeypatch.setattr(os, 'cpu_count', lambda: 4)
+    result = CliRunner().invoke(cli, ['batch', str(tmp_path), '-j', '1'])
+    assert result.exit_code == 0, result.output
+    assert (tmp_path / 'a.png').read_bytes().startswith(b'\x89PNG')
+
+
+def test_overlay_command_renders_at_downsample(tmp_path):
+    import numpy as np
+    from click.testing import CliRunner
+    from PIL import Image
+    from viewmask.cli import cli
+
+    image = str(tmp_path / 'image.npy')
+    np.save(image, np.zeros((600, 520, 3), dtype=np.uint8))
+    (tmp_path / 'a.xml').write_text(TCGA_XML)
+    output = str(tmp_path / 'overlay.png')
+    result = CliRunner().invoke(cli, [
+        'overlay', image, str(tmp_path / 'a.xml'), '-o', output,
+        '--downsample', '4'])
+    assert result.exit_code == 0, result.output
+    assert np.asarray(Image.open(output)).shape == (150, 130, 3)
+
+    result = CliRunner().invoke(cli, [
+        'overlay', image, str(tmp_path / 'a.xml'), '-o', output,
+        '--level', '7'])
+    assert result.exit_code == 2
+    assert "Invalid value for '--level'" in result.output
+
+
+def test_select_pyramid_level_scale():
+    import numpy as np
+    from viewmask import Annotations
+    from viewmask.utils import _downsample_pyramid, select_pyramid_level
+
+    pyramid = _downsample_pyramid(np.zeros((2048, 1024)))
+    arr, scale = select_pyramid_level(pyramid, downsample=8)
+    assert arr.shape == (256, 128) and scale == (1 / 8, 1 / 8)
+    arr, scale = select_pyramid_level(pyramid, level=1)
+    assert arr.shape == (1024, 512)
+    contours = Annotations([np.array([[16, 32], [64, 8]])]).scale(scale)
+    np.testing.assert_array_equal(contours[0], [[8, 16], [32, 4]])
+
+
+def test_profile_records_stages_and_counts(tmp_path):
+    import json
+    from click.testing import CliRunner
+    from viewmask import profiling
+    from viewmask.cli import cli
+
+    assert profiling.get_profiler() is None
+    (tmp_path / 'a.xml').write_text(TCGA_XML)
+    trace = str(tmp_path / 'trace.json')
+    result = CliRunner().invoke(cli, [
+        '--profile', trace, '--profile-format', 'chrome', 'annotations',
+        str(tmp_path / 'a.xml'), '-o', str(tmp_path / 'a.png')])
+    assert result.exit_code == 0, result.output
+    assert profiling.get_profiler() is None
+    events = json.loads(open(trace).read())['traceEvents']
+    parse, = [event for event in events
+              if event['name'] == 'parse annotations']
+    assert parse['ph'] == 'X' and parse['args']['vertices_parsed'] == 7
+    assert {'render', 'write'} <= {
+        event['name'] for event in events}
+
+    profiler = profiling.Profiler()
+    with profiling.profile(profiler):
+        with profiling.stage('outer'):
+            profiling.count('items', 2)
+            with profiling.stage('inner'):
+                profiling.count('items')
+    outer, inner = profiler.stages
+    assert outer['counts'] == {'items': 2} and inner['depth'] == 1
+    assert profiler.counts == {'items': 3}
+    assert profiler.summary()['outer']['wall_time'] >= inner['wall_time']
+
+
+def test_cli_import_is_lazy():
+    import json
+    import subprocess
+    import sys
+
+    script = (
+        'import json, sys, time\n'
+        'start = time.perf_counter()\n'
+        'import viewmask.cli\n'
+        'elapsed = time.perf_counter() - start\n'
+        'print(json.dumps([elapsed, sorted(\n'
+        '    {"cv2", "napari", "dask", "scipy", "skimage", "openslide"}\n'
+        '    & set(sys.modules))]))\n'
+    )
+    elapsed, heavy = json.loads(subprocess.run(
+        [sys.executable, '-c', script], check=True, capture_output=True,
+        text=True).stdout)
+    assert heavy == []
+    assert elapsed < 1.0
+
+
+def test_from_tcga_cache_memory_maps_columns(tmp_path, annotation_cache_dir):
+    import os
+    import numpy as np
+    from viewmask import Annotations, PackedAnnotations
+    from viewmask.utils import cached_tcga_columns
+
+    path = tmp_path / 'a.xml'
+    path.write_text(TCGA_XML)
+    expected = PackedAnnotations.from_tcga(str(path))
+    cached = PackedAnnotations.from_tcga(str(path), cache=True)
+    np.testing.assert_array_equal(cached.coordinates, expected.coordinates)
+    np.testing.assert_array_equal(cached.offsets, expected.offsets)
+    # the second read, of a copy under another name, is a memory map
+    copy = tmp_path / 'copy.xml'
+    copy.write_text(TCGA_XML)
+    coordinates, offsets = cached_tcga_columns(str(copy))
+    assert isinstance(coordinates, np.memmap)
+    assert not coordinates.flags.writeable
+    fitted = Annotations.from_tcga(str(path), fit_spline=True, cache=True)
+    for contour, reference in zip(
+            fitted, Annotations.from_tcga(str(path), fit_spline=True)):
+        np.testing.assert_array_equal(contour, reference)
+    assert len(os.listdir(os.path.join(annotation_cache_dir, 'annotations'))) \
+        == 2
+
+
+def test_annotation_cache_can_be_bypassed_and_cleared(
+        tmp_path, annotation_cache_dir, monkeypatch):
+    import os
+    from click.testing import CliRunner
+    from viewmask import Annotations, PackedAnnotations
+    from viewmask.cli import cli
+    from viewmask.utils import annotation_cache_dir as cache_dir
+
+    entries = os.path.join(annotation_cache_dir, 'annotations')
+    path = tmp_path / 'a.xml'
+    path.write_text(TCGA_XML)
+    (tmp_path / 'manifest.csv').write_text('annotations\na.xml\n')
+    result = CliRunner().invoke(cli, [
+        '--no-cache', 'batch', str(tmp_path / 'manifest.csv'), '-j', '1'])
+    assert result.exit_code == 0, result.output
+    assert (tmp_path / 'a.png').exists() and not os.path.exists(entries)
+    # a file without regions is cached as no contours, not one empty contour
+    empty = tmp_path / 'empty.xml'
+    empty.write_text('<Annotations><Annotation><Regions/></Annotation>'
+                     '</Annotations>')
+    for fit_spline in (False, True):
+        assert len(Annotations.from_tcga(
+            str(empty), fit_spline=fit_spline, cache=True)) == 0
+    assert len(PackedAnnotations.from_tcga(str(empty), cache=True)) == 0
+    Annotations.from_tcga(str(path), cache=True)
+    assert len(os.listdir(entries)) == 3
+    result = CliRunner().invoke(cli, ['clear-cache'])
+    assert result.exit_code == 0, result.output
+    assert result.output.startswith('Removed 3 entries')
+    assert os.listdir(entries) == []
+    monkeypatch.delenv('VIEWMASK_CACHE_DIR')
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    assert cache_dir() == os.path.join(str(tmp_path), 'viewmask')
+
+
+def test_file_to_dask_array_memory_maps_numpy_files(tmp_path):
+    import numpy as np
+    from viewmask.utils import _memmap_npz_member, file_to_dask_array
+
+    mask = np.arange(300 * 250, dtype=np.uint16).reshape(300, 250)
+    np.save(tmp_path / 'mask.npy', mask)
+    np.savez(tmp_path / 'mask.npz', mask=np.asfortranarray(mask), other=[1])
+    np.savez_compressed(tmp_path / 'compressed.npz', mask)
+    for name in ('mask.npy', 'mask.npz', 'compressed.npz'):
+        arr = file_to_dask_array(str(tmp_path / name), tile_size=128)
+        assert arr.chunks == ((128, 128, 44), (128, 122))
+        np.testing.assert_array_equal(arr.compute(), mask)
+    assert isinstance(
+        _memmap_npz_member(str(tmp_path / 'mask.npz'), 'mask.npy'), np.memmap)
+    assert _memmap_npz_member(
+        str(tmp_path / 'compressed.npz'), 'arr_0.npy') is None
+
+
+def test_file_to_dask_array_decompresses_npz_once(tmp_path, monkeypatch):
+    import numpy as np
+    from viewmask.utils import file_to_dask_array
+
+    mask = np.arange(300 * 250, dtype=np.uint16).reshape(300, 250)
+    np.savez_compressed(tmp_path / 'compressed.npz', mask)
+    loads = []
+    load = np.load
+    monkeypatch.setattr(
+        np, 'load', lambda *args, **kwargs: loads.append(args) or load(
+            *args, **kwargs))
+    arr = file_to_dask_array(str(tmp_path / 'compressed.npz'), tile_size=128)
+    for y in range(0, 300, 100):
+        np.testing.assert_array_equal(
+            arr[y:y + 100].compute(), mask[y:y + 100])
+    assert len(loads) == 1
+
+
+def test_render_overlay_is_one_blockwise_pass():
+    import cv2
+    import dask.array as da
+    import numpy as np
+    from viewmask import Annotations
+    from viewmask.utils import render_overlay
+
+    image = np.full((90, 70, 3), 200, dtype=np.uint8)
+    lazy = da.from_array(image, chunks=(32, 32, 3))
+    contours = Annotations([np.array([[10, 10], [40, 10], [40, 60], [10, 60]],
+                                     dtype=np.int32)])
+    overlay = render_overlay(lazy, contours)
+    assert overlay.chunks == lazy.chunks
+    assert len(overlay.dask.layers) == 2  # the image and the overlay
+    expected = cv2.add(image, contours.as_image(shape=image.shape))
+    cv2.circle(expected, (25, 35), 4, (255, 0, 0), -1)
+    np.testing.assert_array_equal(overlay.compute(), expected)
+
+    mask = np.zeros(image.shape, dtype=np.uint8)
+    cv2.circle(mask, (50, 20), 5, (0, 0, 255), -1)
+    cv2.circle(mask, (20, 70), 5, (0, 255, 0), -1)
+    overlay = render_overlay(lazy, da.from_array(mask, chunks=16)).compute()
+    assert tuple(overlay[20, 50]) == (255, 0, 0)  # blue nuclei are marked
+    assert tuple(overlay[70, 20]) == (200, 255, 200)
+
+
+def test_render_markers_matches_cv2_circles():
+    import cv2
+    import numpy as np
+    from viewmask.utils import centers_to_image, render_markers
+
+    centers = np.random.default_rng(0).integers(-10, 110, (200, 2))
+    expected = np.zeros((90, 100, 3), dtype=np.uint8)
+    for center in centers.tolist():
+        cv2.circle(expected, center, 4, (255, 0, 0), -1)
+    np.testing.assert_array_equal(
+        render_markers(centers, (90, 100)), expected)
+    lazy = centers_to_image(centers, shape=(90, 100, 3), chunks=(17, 30))
+    assert lazy.chunks[:2] == ((17,) * 5 + (5,), (30, 30, 30, 10))
+    np.testing.assert_array_equal(lazy.compute(), expected)
+
+
+def test_measure_matches_opencv_and_dense_mask():
+    import cv2
+    import dask.array as da
+    import numpy as np
+    from viewmask import Annotations, PackedAnnotations
+    from viewmask.utils import get_hematoxylin
+
+    rng = np.random.default_rng(0)
+    contours = [
+        np.array([[5, 5], [40, 8], [30, 50], [3, 30]], dtype=np.int32),
+        np.array([[50, 20], [90, 20], [90, 70], [50, 70]], dtype=np.int32),
+        np.array([[200, 200], [210, 200], [205, 210]], dtype=np.int32),
+    ]
+    image = rng.integers(0, 256, (80, 100, 3), dtype=np.uint8)
+    annotations = Annotations(contours)
+    measurements = annotations.measure(
+        da.from_array(image, chunks=(23, 31, 3)))
+    np.testing.assert_allclose(
+        measurements['area'], [cv2.contourArea(c) for c in contours])
+    np.testing.assert_allclose(
+        measurements['perimeter'], [cv2.arcLength(c, True) for c in contours])
+    np.testing.assert_array_equal(measurements['bbox_x_max'], [40, 90, 210])
+
+    hematoxylin = get_hematoxylin(image)
+    for i, contour in enumerate(contours[:2]):
+        mask = np.zeros(image.shape[:2], dtype=np.uint8)
+        cv2.fillPoly(mask, [contour], 1)
+        values = hematoxylin[mask.astype(bool)]
+        assert measurements['n_pixels'][i] == values.size
+        assert np.isclose(measurements['hematoxylin_mean'][i], values.mean())
+        assert np.isclose(measurements['hematoxylin_std'][i], values.std())
+    # the last contour is outside of the image
+    assert measurements['n_pixels'][2] == 0
+    assert np.isnan(measurements['hematoxylin_mean'][2])
+
+    packed = PackedAnnotations(contours).measure(image)
+    for name, column in measurements.items():
+        np.testing.assert_allclose(packed[name], column)
+
+
+def test_tile_prefetcher_reads_viewport_ahead_of_dask(tmp_path):
+    import numpy as np
+    import pytest
+    pytest.importorskip('openslide')
+    tifffile = pytest.importorskip('tifffile')
+    from viewmask.utils import TileCache, TilePrefetcher, file_to_dask_array
+
+    path = str(tmp_path / 'slide.tif')
+    img = np.random.default_rng(0).integers(
+        0, 255, (700, 500, 3), dtype=np.uint8)
+    tifffile.imwrite(path, img, tile=(256, 256), photometric='rgb')
+    cache = TileCache()
+    prefetcher = TilePrefetcher(cache, margin=0)
+    arr = file_to_dask_array(path, tile_size=300, cache=prefetcher)
+    keys = prefetcher.tiles(0, (310, 310, 499, 620))
+    # the tile under the center of the viewport comes first
+    assert keys[0] == (path, 0, 300, 300, 200, 300)
+    assert keys[1] == (path, 0, 300, 600, 200, 100)
+
+    prefetcher.prefetch(0, (310, 310, 499, 620))
+    try:
+        prefetcher._executor.shutdown(wait=True)
+        assert prefetcher.stats() == {
+            'prefetched': 2, 'cancelled': 0, 'pending': 0}
+        assert all(key in cache for key in keys)
+        np.testing.assert_array_equal(
+            arr[300:, 300:].compute(), img[300:, 300:])
+        assert cache.misses == 0
+        np.testing.assert_array_equal(arr.compute(), img)
+    finally:
+        prefetcher.close()
+
+
+def test_rle_mask_matches_dense_masks(tmp_path):
+    import dask.array as da
+    import numpy as np
+    from viewmask import Annotations, RLEMask
+
+    rng = np.random.default_rng(0)
+    a = rng.random((60, 80)) < 0.3
+    b = rng.random((60, 80)) < 0.5
+    mask_a, mask_b = RLEMask.from_dense(a), RLEMask.from_dense(b)
+    np.testing.assert_array_equal(mask_a.to_dense(), a)
+    np.testing.assert_array_equal((mask_a | mask_b).to_dense(), a | b)
+    np.testing.assert_array_equal((mask_a & mask_b).to_dense(), a & b)
+    # runs are merged, so equal masks have equal runs
+    np.testing.assert_array_equal(
+        (mask_a | mask_b).starts, RLEMask.from_dense(a | b).starts)
+    assert mask_a.area() == a.sum()
+    assert mask_a.area((10, 5, 29, 40)) == a[5:41, 10:30].sum()
+    lazy = mask_a.to_dask((25, 30))
+    assert lazy.chunks == ((25, 25, 10), (30, 30, 20))
+    np.testing.assert_array_equal(lazy.compute(), a)
+    np.testing.assert_array_equal(
+        RLEMask.from_dense(da.from_array(a, chunks=(7, 80))).offsets,
+        mask_a.offsets)
+    np.save(tmp_path / 'mask.npy', a.astype(np.uint8) * 255)
+    np.testing.assert_array_equal(
+        RLEMask.from_npy(str(tmp_path / 'mask.npy')).ends, mask_a.ends)
+    for shape in ((0, 80), (60, 0), (0, 0)):
+        for empty in (np.zeros(shape, bool), da.zeros(shape, dtype=bool)):
+            encoded = RLEMask.from_dense(empty)
+            assert encoded.shape == shape and encoded.area() == 0
+            np.testing.assert_array_equal(encoded.to_dense(), empty)
+
+    annotations = Annotations([
+        np.array([[5, 5], [40, 8], [30, 50], [3, 30]], dtype=np.int32),
+        np.array([[35, 20], [90, 20], [90, 70], [35, 70]], dtype=np.int32),
+        # contours that cross the edges, or lie outside, of the mask
+        np.array([[10, -30], [50, -5], [20, 45]], dtype=np.int32),
+        np.array([[-20, 40], [70, 90], [5, 100]], dtype=np.int32),
+        np.array([[100, 100], [120, 100], [110, 120]], dtype=np.int32),
+    ])
+    np.testing.assert_array_equal(
+        annotations.as_mask((60, 80)).to_dense(),
+        annotations.as_image((60, 80)).any(axis=2))
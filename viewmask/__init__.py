@@ -5,24 +5,35 @@ from viewmask import utils  # noqa  # pylint: disable=unused-import
 
 
 class Annotations(UserList):
+    # built by the first query, and dropped by every method that changes the
+    # list, so queries never compare the contours to see if it is stale
+    _spatial_index = None
+
     def __init__(self, initlist=()):
         UserList.__init__(self)
         if isinstance(initlist, Annotations):
             # Already deduped, copy without duplicate checking
-            self.data[:] = Annotations.data
+            self.data[:] = initlist.data
         else:
             self.extend(initlist)
 
     @classmethod
-    def from_tcga(cls, xml_tree, fit_spline=False):
+    def from_tcga(cls, xml_tree, fit_spline=False, cache=False):
         """Extract contours from a TCGA XML annotations file.
 
         Parameters
         ----------
-        xml_tree : xml.etree.ElementTree
-            The XML tree of the TCGA annotations file.
+        xml_tree : xml.etree.ElementTree or str
+            The XML tree of the TCGA annotations file. If the path to the file
+            is given instead, the file is streamed with
+            `viewmask.utils.parse_tcga_xml` without building the whole tree.
         fit_spline : bool, optional
             Whether the points in each contour should be fit through a spline.
+        cache : bool or str, optional
+            Whether to read the contours of a path through the on-disk cache
+            of `viewmask.utils.cached_tcga_columns`, or the directory of the
+            cache to use. Cached contours are views into a read-only memory
+            map.
 
         Returns
         -------
@@ -33,18 +44,44 @@ class Annotations(UserList):
             respectively.
         """
         # TODO: add reference to vmu.fit_spline_to_points in docstring
-        # TODO: fit_spline is untested
 
         from numpy import array as to_numpy_array, int32 as npint32
 
+        if isinstance(xml_tree, str):
+            from numpy import split
+
+            if cache:
+                coordinates, offsets = utils.cached_tcga_columns(
+                    xml_tree, fit_spline=fit_spline,
+                    cache_dir=None if cache is True else cache)
+            else:
+                coordinates, offsets = utils.parse_tcga_xml(xml_tree)
+            if len(offsets) == 1:
+                # np.split would return one empty contour instead of none
+                return cls()
+            if cache:
+                return cls(initlist=split(coordinates, offsets[1:-1]))
+            if fit_spline:
+                regions = [
+                    region.astype(npint32) for region in utils.fit_splines(
+                        split(coordinates, offsets[1:-1]))
+                ]
+            else:
+                # np.int32 is necessary for cv2.drawContours; casting the flat
+                # buffer once keeps every region a view into the same array
+                regions = split(coordinates.astype(npint32), offsets[1:-1])
+            return cls(initlist=regions)
+
         contours = [
-            to_numpy_array(
-                utils.region_to_contour(region, fit_spline=fit_spline),
-                # np.int32 is necessary for cv2.drawContours
-                dtype=npint32)
+            to_numpy_array(utils.region_to_contour(region))
             for region in xml_tree.getroot().iter("Vertices")
         ]
-        return cls(initlist=contours)
+        if fit_spline:
+            contours = utils.fit_splines(contours)
+        return cls(initlist=[
+            # np.int32 is necessary for cv2.drawContours
+            to_numpy_array(contour, dtype=npint32) for contour in contours
+        ])
 
     @classmethod
     def from_qpdata(cls, filepath):
@@ -98,35 +135,158 @@ class Annotations(UserList):
             from numpy import asarray as to_numpy_array, int32 as npint32
             return [to_numpy_array(contour, dtype=npint32) for contour in self.data]
 
-    def fit_spline(self):
-        # TODO: docstring
-        self.data = list(map(utils.region_to_contour, self.data))
+    def fit_spline(self, processes=None, **kwargs):
+        """Fit a closed B-spline through the points of every contour.
+
+        The contours are fit in parallel with `viewmask.utils.fit_splines`,
+        and replaced in place.
+
+        Parameters
+        ----------
+        processes : int, optional
+            The number of worker processes to use. Defaults to the number of
+            CPUs.
+        **kwargs
+            Passed to `viewmask.utils.fit_spline_to_points`. By default, the
+            number of points of every spline is chosen from the contour's arc
+            length.
+
+        Returns
+        -------
+        self : viewmask.Annotations
+        """
+        from numpy import int32 as npint32
+
+        self.data = [
+            contour.astype(npint32) for contour in utils.fit_splines(
+                self.data, processes=processes, **kwargs)
+        ]
+        self._spatial_index = None
+        return self
+
+    def scale(self, factor):
+        """Scale the coordinates of every contour, in place.
+
+        Parameters
+        ----------
+        factor : float or (float, float)
+            The factor to multiply the coordinates by, or separate factors
+            for the X and Y coordinates; for example, ``1 / 16`` maps level-0
+            coordinates onto a slide level that is downsampled 16 times.
+
+        Returns
+        -------
+        self : viewmask.Annotations
+            The annotations, with floating point coordinates.
+        """
+        from numpy import asarray, float64
+
+        factor = asarray(factor, dtype=float64)
+        self.data = [contour * factor for contour in self.data]
+        self._spatial_index = None
         return self
 
-    def as_image(self):
+    def as_image(self, shape=None, chunks=None):
         """Convert an annotations object to an annotation mask.
 
+        Parameters
+        ----------
+        shape : tuple of int, optional
+            The (height, width) of the output image. Defaults to the largest
+            Y and X coordinates of the annotations.
+        chunks : tuple, optional
+            If given, the mask is rendered lazily, chunk by chunk, as a dask
+            array with these chunks; for example, ``slide.chunks[:2]`` lines
+            the mask up with a slide from `viewmask.utils.file_to_dask_array`.
+
         Returns
         -------
-        rendered_annotations : numpy.ndarray
-            A 3-dimensional NumPy array representing the RGB output image.
+        rendered_annotations : numpy.ndarray or dask.array.Array
+            A 3-dimensional array representing the RGB output image.
+
+        See Also
+        --------
+        viewmask.utils.rasterize_contours
         """
-        import numpy as np
-        from cv2 import drawContours, fillPoly
         contours = self.export('opencv')
-        x_max = np.amax([x for contour in contours for x, _ in contour])
-        y_max = np.amax([y for contour in contours for _, y in contour])
-        shape = (y_max, x_max, 3)
-        rendered_annotations = np.zeros(shape, dtype=np.uint8)
-        rendered_annotations = drawContours(
-            rendered_annotations, contours, -1, [0, 255, 0])
-        for contour in contours:
-            rendered_annotations = fillPoly(
-                rendered_annotations,
-                np.array([contour], dtype=np.int32),
-                [230, 230, 230]
-            )
-        return rendered_annotations
+        if shape is None:
+            from numpy import amax
+
+            coordinates, _ = utils._flatten_contours(contours)
+            x_max, y_max = amax(coordinates, axis=0)
+            shape = (y_max, x_max, 3)
+        return utils.rasterize_contours(
+            contours,
+            shape,
+            chunks=chunks,
+            outline_color=[0, 255, 0],
+            fill_color=[230, 230, 230],
+        )
+
+    def query(self, bbox):
+        """Find the contours whose bounding boxes intersect a rectangle.
+
+        The first query builds a `viewmask.utils.BoundingBoxIndex` over the
+        contours, which is reused until the list is changed through its
+        methods. Modifying a contour array in place, or the ``data`` list
+        directly, does not rebuild the index.
+
+        Parameters
+        ----------
+        bbox : tuple of int
+            The inclusive (x_min, y_min, x_max, y_max) rectangle to query, in
+            the same coordinates as the contours.
+
+        Returns
+        -------
+        indices : numpy.ndarray
+            The sorted indices of the matching contours.
+        """
+        if self._spatial_index is None:
+            bboxes, _ = utils._contour_extents(
+                *utils._flatten_contours(self.data))
+            self._spatial_index = utils.BoundingBoxIndex(bboxes)
+        return self._spatial_index.query(bbox)
+
+    def as_mask(self, shape=None):
+        """Convert an annotations object to a run-length encoded mask.
+
+        Unlike `as_image`, no dense canvas is drawn: every contour is drawn
+        and encoded on its own, so the mask of a whole slide stays small.
+
+        Parameters
+        ----------
+        shape : tuple of int, optional
+            The (height, width) of the mask. Defaults to the largest Y and X
+            coordinates of the annotations.
+
+        Returns
+        -------
+        mask : viewmask.RLEMask
+            A mask of the pixels that `as_image` draws.
+        """
+        return RLEMask.from_annotations(self.data, shape=shape)
+
+    def measure(self, image=None):
+        """Measure the shape, and optionally the staining, of every contour.
+
+        Parameters
+        ----------
+        image : (M, N, 3) array_like or dask.array.Array, optional
+            The RGB image to measure the hematoxylin intensity in, such as a
+            slide from `viewmask.utils.file_to_dask_array`.
+
+        Returns
+        -------
+        measurements : dict of str to numpy.ndarray
+            A table with one row per contour, as a dict of columns, such as
+            ``area``, ``perimeter`` and ``hematoxylin_mean``.
+
+        See Also
+        --------
+        viewmask.utils.measure_contours
+        """
+        return utils.measure_contours(self.data, image=image)
 
     def check(self, v):
         from numpy import ndarray
@@ -140,12 +300,609 @@ class Annotations(UserList):
 
     def __setitem__(self, i, v):
         self.check(v)
-        self.list[i] = v
+        self._spatial_index = None
+        self.data[i] = v
+
+    def __delitem__(self, i):
+        self._spatial_index = None
+        super().__delitem__(i)
+
+    def __iadd__(self, other):
+        self._spatial_index = None
+        return super().__iadd__(other)
+
+    def __imul__(self, n):
+        self._spatial_index = None
+        return super().__imul__(n)
+
+    def append(self, item):
+        self._spatial_index = None
+        super().append(item)
 
     def insert(self, i, v):
         self.check(v)
+        self._spatial_index = None
         super().insert(i, v)
 
+    def pop(self, i=-1):
+        self._spatial_index = None
+        return super().pop(i)
+
+    def remove(self, item):
+        self._spatial_index = None
+        super().remove(item)
+
+    def clear(self):
+        self._spatial_index = None
+        super().clear()
+
+    def reverse(self):
+        self._spatial_index = None
+        super().reverse()
+
+    def sort(self, *args, **kwds):
+        self._spatial_index = None
+        super().sort(*args, **kwds)
+
     def extend(self, other):
         for x in other:
             self.append(x)
+
+
+class PackedAnnotations:
+    """A compact, columnar alternative to `viewmask.Annotations`.
+
+    All contours are stored in a single flat ``(N, 2)`` coordinate buffer,
+    and an ``(M + 1,)`` offsets array marks where each of the M contours
+    starts and ends. Indexing returns zero-copy views into the buffer, and
+    slicing, concatenation and export operate on the whole buffer at once, so
+    there is no per-contour Python object overhead.
+
+    The list-style API of `viewmask.Annotations` is supported, but methods
+    that modify a single contour (`append`, `insert`, `__setitem__`) rebuild
+    the buffer; prefer `extend` or `+` to add many contours at once.
+
+    Parameters
+    ----------
+    initlist : iterable of numpy.ndarray, optional
+        The contours to store. Each contour is an array of (X, Y) coordinate
+        pairs, with shape (n, 2) or (n, 1, 2).
+
+    Attributes
+    ----------
+    coordinates : numpy.ndarray
+        The (X, Y) coordinates of every contour, concatenated.
+    offsets : numpy.ndarray
+        The contour ``i`` is ``coordinates[offsets[i]:offsets[i + 1]]``.
+    """
+
+    __slots__ = ('coordinates', 'offsets', '_spatial_index')
+
+    def __init__(self, initlist=()):
+        import numpy as np
+
+        if isinstance(initlist, PackedAnnotations):
+            self.coordinates = initlist.coordinates
+            self.offsets = initlist.offsets
+            return
+        contours = [np.asarray(contour).reshape(-1, 2) for contour in initlist]
+        lengths = [len(contour) for contour in contours]
+        self.offsets = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+        if contours:
+            self.coordinates = np.concatenate(contours)
+        else:
+            self.coordinates = np.empty((0, 2), dtype=np.int32)
+
+    @classmethod
+    def from_columns(cls, coordinates, offsets):
+        """Wrap existing coordinate and offset arrays without copying them.
+
+        Parameters
+        ----------
+        coordinates : numpy.ndarray
+            An array with shape (N, 2) of (X, Y) coordinate pairs.
+        offsets : numpy.ndarray
+            An array with shape (M + 1,) of increasing indices into
+            `coordinates`, starting with 0 and ending with N.
+
+        Returns
+        -------
+        contours : viewmask.PackedAnnotations
+        """
+        import numpy as np
+
+        self = cls.__new__(cls)
+        self.coordinates = np.asarray(coordinates)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        return self
+
+    @classmethod
+    def from_tcga(cls, xml_tree, fit_spline=False, cache=False):
+        """Extract contours from a TCGA XML annotations file.
+
+        Parameters
+        ----------
+        xml_tree : xml.etree.ElementTree or str
+            The XML tree of the TCGA annotations file, or the path to the file.
+            Paths are streamed straight into the flat coordinate buffer.
+        fit_spline : bool, optional
+            Whether the points in each contour should be fit through a spline.
+        cache : bool or str, optional
+            Whether to read the contours of a path through the on-disk cache
+            of `viewmask.utils.cached_tcga_columns`, or the directory of the
+            cache to use. Cached columns are read-only memory maps, which
+            are shared by every process that opens the same annotations.
+
+        Returns
+        -------
+        contours : viewmask.PackedAnnotations
+
+        See Also
+        --------
+        viewmask.Annotations.from_tcga
+        """
+        if isinstance(xml_tree, str) and cache:
+            return cls.from_columns(*utils.cached_tcga_columns(
+                xml_tree, fit_spline=fit_spline,
+                cache_dir=None if cache is True else cache))
+        if isinstance(xml_tree, str) and not fit_spline:
+            from numpy import int32 as npint32
+
+            coordinates, offsets = utils.parse_tcga_xml(xml_tree)
+            # np.int32 is necessary for cv2.drawContours
+            return cls.from_columns(coordinates.astype(npint32), offsets)
+        return cls(Annotations.from_tcga(xml_tree, fit_spline=fit_spline))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        coordinates, offsets = self.coordinates, self.offsets
+        for start, stop in zip(offsets[:-1], offsets[1:]):
+            yield coordinates[start:stop]
+
+    def __getitem__(self, i):
+        import numpy as np
+
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step == 1:
+                stop = max(start, stop)
+                begin = self.offsets[start]
+                return self.from_columns(
+                    self.coordinates[begin:self.offsets[stop]],
+                    self.offsets[start:stop + 1] - begin
+                )
+            i = np.arange(start, stop, step)
+        if isinstance(i, (list, np.ndarray)):
+            return self.take(i)
+        i = range(len(self))[i]  # normalizes negative indices
+        return self.coordinates[self.offsets[i]:self.offsets[i + 1]]
+
+    def query(self, bbox):
+        """Find the contours whose bounding boxes intersect a rectangle.
+
+        See Also
+        --------
+        viewmask.Annotations.query
+        """
+        key, index = getattr(self, '_spatial_index', (None, None))
+        if key is None or key[0] is not self.coordinates \
+                or key[1] is not self.offsets:
+            key = self.coordinates, self.offsets
+            index = utils.BoundingBoxIndex(utils._contour_extents(*key)[0])
+            self._spatial_index = key, index
+        return index.query(bbox)
+
+    def take(self, indices):
+        """Return the contours at `indices` as a new `PackedAnnotations`.
+
+        Parameters
+        ----------
+        indices : array_like of int or bool
+            The indices of the contours to select, or a boolean mask with one
+            entry per contour.
+
+        Returns
+        -------
+        contours : viewmask.PackedAnnotations
+        """
+        import numpy as np
+
+        indices = np.asarray(indices)
+        if indices.dtype != bool:
+            # an empty list would otherwise be a float array
+            indices = indices.astype(np.intp, copy=False)
+        indices = np.arange(len(self))[indices]
+        starts = self.offsets[indices]
+        lengths = self.offsets[indices + 1] - starts
+        offsets = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+        gather = np.arange(offsets[-1]) + np.repeat(
+            starts - offsets[:-1], lengths)
+        return self.from_columns(self.coordinates[gather], offsets)
+
+    def __add__(self, other):
+        ret = self.__class__(self)
+        ret.extend(other)
+        return ret
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    def __setitem__(self, i, v):
+        contours = list(self)
+        contours[i] = v
+        self.__init__(contours)
+
+    def __delitem__(self, i):
+        import numpy as np
+
+        keep = np.ones(len(self), dtype=bool)
+        keep[i] = False
+        kept = self.take(keep)
+        self.coordinates, self.offsets = kept.coordinates, kept.offsets
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({list(self)!r})'
+
+    def append(self, contour):
+        self.extend([contour])
+
+    def insert(self, i, contour):
+        contours = list(self)
+        contours.insert(i, contour)
+        self.__init__(contours)
+
+    def pop(self, i=-1):
+        contour = self[i]
+        del self[i]
+        return contour
+
+    def remove(self, contour):
+        import numpy as np
+
+        for i, other in enumerate(self):
+            if np.array_equal(other, np.asarray(contour).reshape(-1, 2)):
+                del self[i]
+                return
+        raise ValueError('contour not in PackedAnnotations')
+
+    def clear(self):
+        self.__init__()
+
+    def copy(self):
+        return self.from_columns(
+            self.coordinates.copy(), self.offsets.copy())
+
+    def extend(self, other):
+        import numpy as np
+
+        if not isinstance(other, PackedAnnotations):
+            other = PackedAnnotations(other)
+        # the empty buffer's default dtype should not decide the result's
+        if not len(self.coordinates):
+            dtype = other.coordinates.dtype
+        elif not len(other.coordinates):
+            dtype = self.coordinates.dtype
+        else:
+            dtype = np.result_type(self.coordinates, other.coordinates)
+        self.offsets = np.concatenate(
+            (self.offsets, other.offsets[1:] + self.offsets[-1]))
+        self.coordinates = np.concatenate(
+            (self.coordinates, other.coordinates)).astype(dtype, copy=False)
+
+    def export(self, mode):
+        """Export the annotations to a usable format.
+
+        Parameters
+        ----------
+        mode : {'napari', 'opencv'}
+            See `viewmask.Annotations.export`.
+
+        Returns
+        -------
+        contours : list of numpy.ndarray
+            A list of contours; every contour is a view into a single buffer
+            that is converted once for all contours. Unlike
+            `viewmask.Annotations.export`, the order of the vertices is kept
+            when exporting to napari; only the X and Y coordinates are
+            swapped.
+        """
+        from numpy import split, int32 as npint32
+
+        if mode == 'napari':
+            coordinates = self.coordinates[:, ::-1]
+        elif mode == 'opencv':
+            coordinates = self.coordinates.astype(npint32, copy=False)
+        else:
+            raise ValueError(f"mode must be 'napari' or 'opencv', not {mode!r}")
+        if len(self) == 0:
+            return []
+        return split(coordinates, self.offsets[1:-1])
+
+    def fit_spline(self, processes=None, **kwargs):
+        """Fit a closed B-spline through the points of every contour, in place.
+
+        See Also
+        --------
+        viewmask.Annotations.fit_spline
+        """
+        from numpy import int32 as npint32
+
+        fitted = utils.fit_splines(self, processes=processes, **kwargs)
+        self.__init__(fitted)
+        self.coordinates = self.coordinates.astype(npint32)
+        return self
+
+    def scale(self, factor):
+        """Scale the coordinates of every contour, in place.
+
+        See Also
+        --------
+        viewmask.Annotations.scale
+        """
+        from numpy import asarray, float64
+
+        self.coordinates = self.coordinates * asarray(factor, dtype=float64)
+        return self
+
+    def as_image(self, shape=None, chunks=None):
+        """Convert the annotations to an annotation mask.
+
+        See Also
+        --------
+        viewmask.Annotations.as_image
+        """
+        if shape is None:
+            # truncated like the int32 coordinates that are drawn
+            x_max, y_max = self.coordinates.max(axis=0).astype(int)
+            shape = (y_max, x_max, 3)
+        # the columns are drawn as they are, without splitting them up
+        return utils.rasterize_contours(
+            self,
+            shape,
+            chunks=chunks,
+            outline_color=[0, 255, 0],
+            fill_color=[230, 230, 230],
+        )
+
+    def as_mask(self, shape=None):
+        """Convert the annotations to a run-length encoded mask.
+
+        See Also
+        --------
+        viewmask.Annotations.as_mask
+        """
+        return RLEMask.from_annotations(self, shape=shape)
+
+    def measure(self, image=None):
+        """Measure the shape, and optionally the staining, of every contour.
+
+        See Also
+        --------
+        viewmask.Annotations.measure
+        """
+        return utils.measure_contours(self, image=image)
+
+
+class RLEMask:
+    """A binary mask, stored as runs of foreground pixels along every row.
+
+    Annotation masks of whole slides are mostly background, so storing the
+    start and end of every run of foreground pixels takes orders of
+    magnitude less memory than a dense array. Union, intersection and area
+    queries work on the runs directly, and `to_dask` only draws dense chunks
+    when they are computed.
+
+    Parameters
+    ----------
+    starts, ends : numpy.ndarray
+        The X coordinates where every run starts, and where it ends
+        (exclusively), sorted by row and then by X. Runs must not overlap or
+        touch.
+    offsets : numpy.ndarray
+        An array with shape (height + 1,), such that the runs of row ``y``
+        are ``starts[offsets[y]:offsets[y + 1]]``.
+    shape : tuple of int
+        The (height, width) of the mask.
+
+    Attributes
+    ----------
+    starts, ends, offsets : numpy.ndarray
+    shape : tuple of int
+
+    Examples
+    --------
+    >>> tissue = RLEMask.from_npy('tissue.npy')
+    >>> tumor = Annotations.from_tcga('tumor.xml').as_mask(tissue.shape)
+    >>> (tissue & tumor).area() / tissue.area()
+    """
+
+    __slots__ = ('starts', 'ends', 'offsets', 'shape')
+
+    def __init__(self, starts, ends, offsets, shape):
+        import numpy as np
+
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.shape = tuple(int(n) for n in shape[:2])
+
+    @classmethod
+    def _from_runs(cls, runs, shape):
+        rows, starts, ends = runs
+        return cls(starts, ends, utils._row_offsets(rows, shape[0]), shape)
+
+    @classmethod
+    def from_dense(cls, mask):
+        """Encode the nonzero pixels of a mask.
+
+        Parameters
+        ----------
+        mask : (M, N[, C]) numpy.ndarray or dask.array.Array
+            The mask. Pixels are foreground if any of their channels is
+            nonzero. A dask array is encoded a row of chunks at a time, so
+            the dense mask never has to fit in memory.
+
+        Returns
+        -------
+        mask : viewmask.RLEMask
+        """
+        import numpy as np
+
+        # a mask without rows has no bands, but must still encode to no runs
+        parts = [(np.empty(0, dtype=np.intp),) * 3]
+        for y, band in utils._iter_row_bands(mask, multiple=1024):
+            rows, starts, ends = utils._encode_runs(band)
+            parts.append((rows + y, starts, ends))
+        rows, starts, ends = (np.concatenate(part) for part in zip(*parts))
+        return cls._from_runs((rows, starts, ends), mask.shape)
+
+    @classmethod
+    def from_npy(cls, path):
+        """Encode the mask in a ``.npy`` or ``.npz`` file.
+
+        The file is memory-mapped with `viewmask.utils.file_to_dask_array`
+        and encoded a band of rows at a time.
+
+        Returns
+        -------
+        mask : viewmask.RLEMask
+        """
+        from dask.array import squeeze
+
+        return cls.from_dense(squeeze(utils.file_to_dask_array(path)))
+
+    @classmethod
+    def from_annotations(cls, contours, shape=None):
+        """Draw and fill contours, like `viewmask.Annotations.as_image`.
+
+        Parameters
+        ----------
+        contours : list of numpy.ndarray or viewmask.PackedAnnotations
+            The contours, where each contour is an array of (X, Y)
+            coordinate pairs.
+        shape : tuple of int, optional
+            The (height, width) of the mask. Defaults to the largest Y and X
+            coordinates of the contours.
+
+        Returns
+        -------
+        mask : viewmask.RLEMask
+            A mask of the pixels that `viewmask.Annotations.as_image` draws.
+        """
+        from numpy import amax
+
+        coordinates, offsets = utils._flatten_contours(contours)
+        if shape is None:
+            x_max, y_max = amax(coordinates, axis=0)
+            shape = (int(y_max), int(x_max))
+        shape = tuple(shape[:2])
+        return cls._from_runs(
+            utils._rasterize_runs(coordinates, offsets, shape), shape)
+
+    def _rows(self):
+        import numpy as np
+
+        return np.repeat(np.arange(self.shape[0]), np.diff(self.offsets))
+
+    def _check_shape(self, other):
+        if other.shape != self.shape:
+            raise ValueError(
+                f"masks have different shapes: {self.shape} and "
+                f"{other.shape}")
+
+    def union(self, other):
+        """Return the pixels that are in either mask."""
+        import numpy as np
+
+        self._check_shape(other)
+        runs = utils._merge_runs(
+            np.concatenate((self._rows(), other._rows())),
+            np.concatenate((self.starts, other.starts)),
+            np.concatenate((self.ends, other.ends)),
+            self.shape[1])
+        return self._from_runs(runs, self.shape)
+
+    def intersection(self, other):
+        """Return the pixels that are in both masks."""
+        self._check_shape(other)
+        runs = utils._intersect_runs(
+            (self._rows(), self.starts, self.ends),
+            (other._rows(), other.starts, other.ends),
+            self.shape[1])
+        return self._from_runs(runs, self.shape)
+
+    __or__ = union
+    __and__ = intersection
+
+    def area(self, bbox=None):
+        """Count the foreground pixels, optionally within a rectangle.
+
+        Parameters
+        ----------
+        bbox : tuple of int, optional
+            The inclusive (x_min, y_min, x_max, y_max) rectangle to count the
+            pixels of.
+
+        Returns
+        -------
+        area : int
+        """
+        import numpy as np
+
+        if bbox is None:
+            return int((self.ends - self.starts).sum())
+        height, width = self.shape
+        x_min, y_min, x_max, y_max = bbox
+        window = (
+            min(max(x_min, 0), width), min(max(y_min, 0), height),
+            min(max(x_max + 1, 0), width), min(max(y_max + 1, 0), height))
+        _, starts, ends = utils._clip_runs(
+            self.starts, self.ends, self.offsets, window)
+        return int(np.maximum(ends - starts, 0).sum())
+
+    @property
+    def nbytes(self):
+        """The number of bytes that the runs take up."""
+        return self.starts.nbytes + self.ends.nbytes + self.offsets.nbytes
+
+    def to_dense(self):
+        """Return the mask as a boolean NumPy array."""
+        height, width = self.shape
+        return utils._decode_runs(
+            self.starts, self.ends, self.offsets, (0, 0, width, height))
+
+    def to_dask(self, chunks=1000):
+        """Return the mask as a lazy boolean dask array.
+
+        Every chunk is drawn from the runs of its rows when it is computed.
+
+        Parameters
+        ----------
+        chunks : tuple or int, optional
+            The chunks of the output, in any form accepted by
+            `dask.array.core.normalize_chunks`.
+
+        Returns
+        -------
+        mask : dask.array.Array
+        """
+        import dask.array as da
+        import numpy as np
+
+        return da.map_blocks(
+            utils._decode_runs_block,
+            starts=self.starts,
+            ends=self.ends,
+            offsets=self.offsets,
+            chunks=da.core.normalize_chunks(chunks, self.shape),
+            dtype=bool,
+            meta=np.empty((0, 0), dtype=bool),
+        )
+
+    def __repr__(self):
+        return (
+            f'{self.__class__.__name__}(shape={self.shape}, '
+            f'runs={len(self.starts)}, area={self.area()})')
@@ -1,20 +1,24 @@
 #!/usr/bin/env python
 
 import click
-import xml.etree.ElementTree as ET
 import numpy as np
 from viewmask.utils import (
     file_to_dask_array,
     centers_of_contours,
     get_stroke_color,
     mask_to_contours,
-    centers_to_image
+    render_overlay,
+    select_pyramid_level,
+    write_image,
+    TilePrefetcher,
 )
+from viewmask import profiling
+from importlib.util import find_spec
 from os.path import splitext
-try:
-    import napari
-except ImportError:
-    napari = None
+
+# napari pulls in Qt, which takes seconds to import, so only check that it is
+# installed here and import it in the commands that open a viewer
+NAPARI_AVAILABLE = find_spec('napari') is not None
 
 
 NAPARI_NOT_INSTALLED_WARNING = "The package `napari` is not installed. " + \
@@ -23,7 +27,7 @@ NAPARI_NOT_INSTALLED_WARNING = "The package `napari` is not installed. " + \
 
 
 def validate_interactive_napari(ctx, param, value):
-    if value is None and napari is None:
+    if value is None and not NAPARI_AVAILABLE:
         raise click.BadParameter(
             'The `interactive` flag cannot be passed '
             'without `napari` in the environment. Please install the `napari` '
@@ -32,12 +36,249 @@ def validate_interactive_napari(ctx, param, value):
     return value
 
 
+def _resize_nearest(arr, shape):
+    # fancy indexing keeps dask masks lazy
+    if arr.shape[:2] == tuple(shape[:2]):
+        return arr
+    rows = np.arange(shape[0]) * arr.shape[0] // shape[0]
+    cols = np.arange(shape[1]) * arr.shape[1] // shape[1]
+    return arr[rows][:, cols]
+
+
+def _prefetch_viewport(viewer, layer, prefetcher):
+    """Prefetch the slide tiles around napari's viewport whenever it moves."""
+    def prefetch(event=None):
+        # corner_pixels are in the coordinates of the level that is on screen
+        (y_min, x_min), (y_max, x_max) = np.asarray(layer.corner_pixels)[:, :2]
+        prefetcher.prefetch(layer.data_level, (x_min, y_min, x_max, y_max))
+
+    viewer.camera.events.center.connect(prefetch)
+    viewer.camera.events.zoom.connect(prefetch)
+    prefetch()
+
+
+def _use_cache():
+    """Whether annotations are read through the cache, see `--no-cache`."""
+    return not click.get_current_context().find_root().params['no_cache']
+
+
+def _load_annotations(annotations, shape=None, scale=(1.0, 1.0), cache=True):
+    """Read the contours of an XML file, or a mask resized to `shape`."""
+    from viewmask import Annotations
+
+    _, annotations_ext = splitext(annotations)
+    if annotations_ext in ('.npy', '.npz', '.png'):
+        from dask.array import squeeze
+
+        # masks are memory-mapped, so only the chunks that are drawn are read
+        mask = squeeze(file_to_dask_array(annotations))
+        return mask if shape is None else _resize_nearest(mask, shape)
+    elif annotations_ext == '.xml':
+        with profiling.stage('parse annotations'):
+            # parsed and fitted once, then memory-mapped from the cache
+            annotations_data = Annotations.from_tcga(
+                annotations, fit_spline=scale == (1.0, 1.0), cache=cache)
+        if scale != (1.0, 1.0):
+            # fitting the scaled contours needs fewer spline points
+            annotations_data = annotations_data.scale(scale)
+            with profiling.stage('fit splines'):
+                annotations_data = annotations_data.fit_spline()
+        return annotations_data
+    raise ValueError(
+        f"cannot read annotations from {annotations_ext or 'extensionless'} "
+        "files")
+
+
+def _render_annotations(annotations, output, cache=True):
+    import dask.array as da
+
+    annotations_data = _load_annotations(annotations, cache=cache)
+    if isinstance(annotations_data, da.Array):
+        shape = annotations_data.shape[:2]
+        chunks = annotations_data.chunks[:2]
+    else:
+        x_max, y_max = np.amax(
+            np.concatenate(annotations_data.export('opencv')), axis=0)
+        shape = (int(y_max), int(x_max))
+        chunks = (1000, 1000)
+    background = da.zeros(shape + (3,), dtype=np.uint8, chunks=chunks + (3,))
+    with profiling.stage('render'):
+        rendered_annotations = render_overlay(background, annotations_data)
+    with profiling.stage('write'):
+        write_image(rendered_annotations, output)
+
+
+def _render_overlay(
+    image, annotations, output, level=None, downsample=None, cache=True
+):
+    from dask.array import squeeze
+
+    pyramid = [
+        squeeze(arr) for arr in file_to_dask_array(image, multiscale=True)]
+    if level is not None and level >= len(pyramid):
+        raise click.BadParameter(
+            f'{image} only has {len(pyramid)} level(s), from 0 to '
+            f'{len(pyramid) - 1}.', param_hint="'--level'")
+    image_data, scale = select_pyramid_level(
+        pyramid, level=level, downsample=downsample)
+    annotations_data = _load_annotations(
+        annotations, shape=image_data.shape, scale=scale, cache=cache)
+    # the slide, the annotations and the markers are composed chunk by chunk
+    # in a single pass, which only runs while the output is written
+    with profiling.stage('render'):
+        rendered_annotations = render_overlay(image_data, annotations_data)
+    # TIFF and PNG outputs are written a row of chunks at a time, so the
+    # overlay of a whole slide is never held in memory
+    with profiling.stage('write'):
+        write_image(rendered_annotations, output)
+
+
+# in order of preference, when a directory has several images of one slide
+SLIDE_EXTENSIONS = (
+    '.svs', '.tif', '.tiff', '.ndpi', '.vms', '.vmu', '.scn', '.mrxs',
+    '.svslide', '.bif', '.png', '.jpg', '.jpeg', '.npy', '.npz', '.zarr',
+)
+
+
+def _read_batch_manifest(manifest, output_dir, extension):
+    """Return the (image, annotations, output) jobs listed in a manifest.
+
+    A CSV manifest has an `annotations` column and optional `image` and
+    `output` columns; relative paths are relative to the manifest. A
+    directory manifest pairs every XML file with the slide that has the same
+    name, if there is one, preferring the formats that come first in
+    `SLIDE_EXTENSIONS`. If the outputs are written to the same directory,
+    files with their `extension` are outputs of an earlier run, and are
+    never paired.
+    """
+    import csv
+    import os
+
+    if os.path.isdir(manifest):
+        base = manifest
+        names = sorted(os.listdir(manifest))
+        outputs_here = output_dir is None or \
+            os.path.abspath(output_dir) == os.path.abspath(manifest)
+        slides = {}
+        for name in names:
+            stem, ext = splitext(name)
+            ext = ext.lower()
+            if ext not in SLIDE_EXTENSIONS or stem.endswith('.partial') \
+                    or (outputs_here and ext == extension.lower()):
+                continue
+            rank = SLIDE_EXTENSIONS.index(ext)
+            if stem not in slides or rank < slides[stem][0]:
+                slides[stem] = (rank, name)
+        slides = {stem: name for stem, (_, name) in slides.items()}
+        rows = [
+            {'image': slides.get(splitext(name)[0], ''), 'annotations': name}
+            for name in names if name.lower().endswith('.xml')
+        ]
+    else:
+        base = os.path.dirname(manifest)
+        with open(manifest, newline='') as f:
+            rows = list(csv.DictReader(f))
+
+    jobs = []
+    for row in rows:
+        annotations = os.path.join(base, row['annotations'])
+        image = row.get('image') or None
+        if image is not None:
+            image = os.path.join(base, image)
+        output = row.get('output') or None
+        if output is None:
+            stem = splitext(os.path.basename(annotations))[0]
+            output = os.path.join(output_dir or base, stem + extension)
+        elif output_dir is not None:
+            output = os.path.join(output_dir, output)
+        else:
+            output = os.path.join(base, output)
+        jobs.append((image, annotations, output))
+    return jobs
+
+
+def _init_batch_worker(max_memory, threads):
+    import dask
+
+    if max_memory is not None:
+        try:
+            import resource
+        except ImportError:  # not available on Windows
+            pass
+        else:
+            limit = max_memory * 2**20
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    dask.config.set(scheduler='threads', num_workers=threads)
+
+
+def _run_batch_job(job, cache=True):
+    """Render one job to a temporary file, then move it into place.
+
+    Returns the job and the error message, if rendering failed. Since the
+    output only appears once it is complete, an interrupted batch can be
+    resumed by skipping the outputs that exist.
+    """
+    import os
+
+    image, annotations, output = job
+    root, ext = splitext(output)
+    partial = f'{root}.partial{ext}'
+    try:
+        with open(partial, 'wb') as f:
+            if image is None:
+                _render_annotations(annotations, f, cache=cache)
+            else:
+                _render_overlay(image, annotations, f, cache=cache)
+        os.replace(partial, output)
+    except Exception as e:  # keep going, the batch reports failures at the end
+        if os.path.exists(partial):
+            os.remove(partial)
+        return job, f'{type(e).__name__}: {e}'
+    return job, None
+
+
 @click.group()
 @click.version_option()
-def cli():
-    if napari is None:
+@click.option(
+    '--profile',
+    'profile_output',
+    default=None,
+    type=click.Path(dir_okay=False, writable=True),
+    help='Record the time, memory and work of every stage of the command '
+         'to this JSON file.',
+)
+@click.option(
+    '--profile-format',
+    type=click.Choice(['json', 'chrome']),
+    default='json',
+    show_default=True,
+    help='Write the profile as a summary of the stages, or as a Chrome '
+         'trace that can be opened in chrome://tracing or Perfetto.',
+)
+@click.option(
+    '--progress',
+    is_flag=True,
+    help='Show the progress of dask computations.',
+)
+@click.option(
+    '--no-cache',
+    is_flag=True,
+    help='Parse XML annotations again instead of reading them from, and '
+         'writing them to, the annotation cache.',
+)
+@click.pass_context
+def cli(ctx, profile_output, profile_format, progress, no_cache):
+    if not NAPARI_AVAILABLE:
         from warnings import warn
         warn(NAPARI_NOT_INSTALLED_WARNING)
+    if progress:
+        from dask.diagnostics import ProgressBar
+        ctx.with_resource(ProgressBar())
+    if profile_output is not None:
+        profiler = ctx.with_resource(
+            profiling.profile(profiling.Profiler(dask_tasks=True)))
+        ctx.call_on_close(
+            lambda: profiler.write(profile_output, format=profile_format))
 
 
 @cli.command(name='annotations')
@@ -56,16 +297,12 @@ def view_annotations(annotations, output):
     from viewmask import Annotations
 
     if output is None:  # interactive viewer
-        try:
-            tree = ET.parse(annotations)
-        except ET.ParseError:
-            # TODO: don't just do nothing, some XMLs might actually be
-            # unparseable
-            pass
-        annotations_data = Annotations.from_tcga(tree)
-        annotations_data = annotations_data.fit_spline()
+        annotations_data = Annotations.from_tcga(
+            annotations, fit_spline=True, cache=_use_cache())
         regions = annotations_data.export('napari')
-        line_color = get_stroke_color(tree)
+        line_color = get_stroke_color(annotations)
+
+        import napari
 
         with napari.gui_qt():
             viewer = napari.Viewer()
@@ -79,57 +316,26 @@ def view_annotations(annotations, output):
                 name='centers',
             )
     else:
-        _, annotations_ext = splitext(annotations)
-        if annotations_ext == '.npy':
-            rendered_annotations = np.load(annotations)
-        elif annotations_ext == '.png':
-            from dask.array import squeeze
-            rendered_annotations = squeeze(file_to_dask_array(annotations))
-        elif annotations_ext == '.xml':
-            try:
-                tree = ET.parse(annotations)
-            except ET.ParseError:
-                # TODO: don't just do nothing, some XMLs might actually be
-                # unparseable
-                pass
-            annotations_data = Annotations.from_tcga(tree)
-            annotations_data = annotations_data.fit_spline()
-            rendered_annotations = annotations_data.as_image()
-        else:
-            # TODO: raise ValueError
-            pass
-
-        from cv2 import inRange as select_color, countNonZero
-        pure_blue = np.asarray([0, 0, 255])
-        mask = select_color(  # select pure blue
-            rendered_annotations,
-            pure_blue,
-            pure_blue,
-        )
-        if countNonZero(mask) == 0:  # if all black
-            # TODO: it'd be nice if we could check this before computing
-            # the blue-based nuclei mask. the current flow control seems
-            # unintuitive
-            mask = rendered_annotations
-
-        centers = centers_of_contours(annotations_data.export('opencv'))
-        # TODO: white pixels over-write red pixels so centers can't be seen
-        rendered_annotations += centers_to_image(
-            centers, shape=rendered_annotations.shape)
-
-        from PIL.Image import fromarray as array_to_pil_image
-        array_to_pil_image(rendered_annotations).save(output)
+        _render_annotations(annotations, output, cache=_use_cache())
 
 
 @cli.command(name='image')
 @click.argument('image', type=click.Path(exists=True, dir_okay=False))
 def view_image(image):
-    if napari is None:
+    if not NAPARI_AVAILABLE:
         raise click.UsageError("The `image` command cannot be used without "
                                "the `napari` package installed.")
-    da_img = file_to_dask_array(image)
-    with napari.gui_qt():
-        napari.view_image(da_img, name='image', multiscale=False)
+    prefetcher = TilePrefetcher()
+    da_pyramid = file_to_dask_array(image, multiscale=True, cache=prefetcher)
+    import napari
+
+    try:
+        with napari.gui_qt():
+            viewer = napari.view_image(
+                da_pyramid, name='image', multiscale=True)
+            _prefetch_viewport(viewer, viewer.layers['image'], prefetcher)
+    finally:
+        prefetcher.close()
 
 
 @cli.command(name='overlay')
@@ -142,85 +348,208 @@ def view_image(image):
     type=click.File(mode='wb'),
     callback=validate_interactive_napari,
 )
-def view_annotations(image, annotations, output):
+@click.option(
+    '--level',
+    type=click.IntRange(min=0),
+    default=None,
+    help='Render the output at this level of the image pyramid.',
+)
+@click.option(
+    '--downsample',
+    type=click.FloatRange(min=1),
+    default=None,
+    help='Render the output downsampled by this factor, reading the closest '
+         'level of the image pyramid.',
+)
+def view_annotations(image, annotations, output, level, downsample):
     from dask.array import squeeze
     from viewmask import Annotations
 
-    da_img = squeeze(file_to_dask_array(image))
+    if output is None and (level is not None or downsample is not None):
+        raise click.UsageError(
+            "`--level` and `--downsample` can only be used with `--output`.")
+    if level is not None and downsample is not None:
+        raise click.UsageError(
+            "`--level` and `--downsample` cannot be used together.")
 
     if output is None:  # interactive viewer
-        try:
-            tree = ET.parse(annotations)
-        except ET.ParseError:
-            # TODO: don't just do nothing, some XMLs might actually be
-            # unparseable
-            pass
-        annotations_data = Annotations.from_tcga(tree)
-        annotations_data = annotations_data.fit_spline()
+        prefetcher = TilePrefetcher()
+        da_pyramid = [
+            squeeze(level) for level in
+            file_to_dask_array(image, multiscale=True, cache=prefetcher)
+        ]
+        annotations_data = Annotations.from_tcga(
+            annotations, fit_spline=True, cache=_use_cache())
         regions = annotations_data.export('napari')
-        line_color = get_stroke_color(tree)
+        line_color = get_stroke_color(annotations)
 
-        with napari.gui_qt():
-            viewer = napari.Viewer()
-            viewer.add_image(
-                da_img,
-                name='image',
-                blending='additive',
-                multiscale=False,
-            )
-            viewer.add_shapes(
-                regions,
-                shape_type='path',
-                edge_color=f"#{line_color}",
-            )
-            viewer.add_points(
-                centers_of_contours(regions),
-                name='centers',
-            )
+        import napari
+
+        try:
+            with napari.gui_qt():
+                viewer = napari.Viewer()
+                layer = viewer.add_image(
+                    da_pyramid,
+                    name='image',
+                    blending='additive',
+                    multiscale=True,
+                )
+                viewer.add_shapes(
+                    regions,
+                    shape_type='path',
+                    edge_color=f"#{line_color}",
+                )
+                viewer.add_points(
+                    centers_of_contours(regions),
+                    name='centers',
+                )
+                _prefetch_viewport(viewer, layer, prefetcher)
+        finally:
+            prefetcher.close()
     else:
-        rendered_annotations = da_img
-
-        _, annotations_ext = splitext(annotations)
-        if annotations_ext == '.npy':
-            rendered_annotations += np.load(annotations)
-        elif annotations_ext == '.png':
-            rendered_annotations += squeeze(file_to_dask_array(annotations))
-        elif annotations_ext == '.xml':
-            try:
-                tree = ET.parse(annotations)
-            except ET.ParseError:
-                # TODO: don't just do nothing, some XMLs might actually be
-                # unparseable
-                pass
-            annotations_data = Annotations.from_tcga(tree)
-            annotations_data = annotations_data.fit_spline()
-            rendered_annotations += annotations_data.as_image()
-        else:
-            # TODO: raise ValueError
-            pass
+        _render_overlay(
+            image, annotations, output, level=level, downsample=downsample,
+            cache=_use_cache())
+
+
+@cli.command(name='batch')
+@click.argument('manifest', type=click.Path(exists=True))
+@click.option(
+    '-o',
+    '--output-dir',
+    default=None,
+    type=click.Path(file_okay=False),
+    help='Where to write the outputs. Defaults to the directory of the '
+         'manifest.',
+)
+@click.option(
+    '-j',
+    '--processes',
+    default=None,
+    type=click.IntRange(min=1),
+    help='The number of worker processes. Defaults to the number of CPUs.',
+)
+@click.option(
+    '--threads-per-worker',
+    default=1,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help='The number of dask threads in every worker process.',
+)
+@click.option(
+    '--max-memory',
+    default=None,
+    type=click.IntRange(min=1),
+    help='The maximum address space of every worker process, in MiB.',
+)
+@click.option(
+    '--max-jobs-per-worker',
+    default=None,
+    type=click.IntRange(min=1),
+    help='Restart worker processes after this many jobs to release memory.',
+)
+@click.option(
+    '--extension',
+    default='.png',
+    show_default=True,
+    help='The file extension of outputs that are not named in the manifest.',
+)
+@click.option(
+    '--overwrite', is_flag=True, help='Render existing outputs again.')
+def run_batch(
+    manifest,
+    output_dir,
+    processes,
+    threads_per_worker,
+    max_memory,
+    max_jobs_per_worker,
+    extension,
+    overwrite
+):
+    """Render overlays or annotations for every entry of a manifest.
+
+    MANIFEST is either a CSV file with an `annotations` column and optional
+    `image` and `output` columns, or a directory, in which case every XML
+    file is paired with the slide that has the same name. Entries without an
+    image are rendered like the `annotations` command, the others like the
+    `overlay` command. Outputs that already exist are skipped, so an
+    interrupted batch can be resumed by running it again.
+
+    When the outputs of a directory are written into it, files with the
+    output extension are never paired with annotations, since they are
+    outputs of an earlier run; use `--output-dir` or `--extension` to pair
+    slides in that format.
+    """
+    import os
+    from functools import partial
+    from multiprocessing import Pool
+
+    jobs = _read_batch_manifest(manifest, output_dir, extension)
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    pending = [
+        job for job in jobs if overwrite or not os.path.exists(job[2])]
+    skipped = len(jobs) - len(pending)
+    if skipped:
+        click.echo(f'Skipping {skipped} existing output(s).')
+
+    failures = []
+    with Pool(
+        processes,
+        initializer=_init_batch_worker,
+        initargs=(max_memory, threads_per_worker),
+        maxtasksperchild=max_jobs_per_worker,
+    ) as pool, click.progressbar(
+        pool.imap_unordered(
+            partial(_run_batch_job, cache=_use_cache()), pending),
+        length=len(pending),
+        label='Rendering',
+    ) as results:
+        for job, error in results:
+            if error is not None:
+                failures.append((job, error))
+    for (_, annotations, _), error in failures:
+        click.echo(f'Failed to render {annotations}: {error}', err=True)
+    if failures:
+        raise click.ClickException(
+            f'{len(failures)} of {len(pending)} job(s) failed.')
+
+
+@cli.command(name='convert')
+@click.argument('image', type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    '-o',
+    '--output',
+    default=None,
+    type=click.Path(file_okay=False),
+    help='Where to write the Zarr store. Defaults to IMAGE.zarr, which the '
+         'other commands pick up automatically.',
+)
+@click.option('--tile-size', default=1000, show_default=True, type=int)
+@click.option('--overwrite', is_flag=True, help='Replace an existing store.')
+def convert_image(image, output, tile_size, overwrite):
+    """Convert a slide or mask to a chunked, multiscale Zarr store."""
+    from viewmask.utils import convert_to_zarr
+
+    if find_spec('zarr') is None:
+        raise click.UsageError(
+            "The `convert` command needs the `zarr` package; install it with "
+            "`pip install viewmask[zarr]`.")
+    try:
+        store = convert_to_zarr(
+            image, output, tile_size=tile_size, overwrite=overwrite)
+    except FileExistsError as e:
+        raise click.UsageError(f'{e}; pass --overwrite to replace it.')
+    click.echo(store)
+
+
+@cli.command(name='clear-cache')
+def clear_cache():
+    """Remove the parsed annotations from the annotation cache."""
+    from viewmask.utils import annotation_cache_dir, clear_annotation_cache
 
-        from cv2 import inRange as select_color
-        from dask.array import asarray as as_da_array, from_delayed as delayed_to_da, count_nonzero
-        from dask import delayed
-        pure_blue = as_da_array((0, 0, 255))
-        mask = delayed_to_da(delayed(select_color, pure=True)(  # select pure blue
-            rendered_annotations,
-            pure_blue,
-            pure_blue,
-        ), rendered_annotations.shape[:2], dtype=int)
-        if count_nonzero(mask) == 0:  # if no blue
-            # TODO: it'd be nice if we could check this before computing
-            # the blue-based nuclei mask. the current flow control seems
-            # unintuitive
-            mask = rendered_annotations
-
-        centers = centers_of_contours(annotations_data.export('opencv'))
-        # TODO: displays bright green heatmap instead of mask
-        rendered_annotations += centers_to_image(
-            centers, shape=rendered_annotations.shape)
-
-        from PIL.Image import fromarray as array_to_pil_image
-        array_to_pil_image(rendered_annotations.compute()).save(output)
+    removed = clear_annotation_cache()
+    click.echo(f'Removed {removed} entries from {annotation_cache_dir()}.')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,251 @@
+"""Per-stage profiling of viewmask's library functions and CLI.
+
+A `Profiler` records the wall time, CPU time and peak memory of named stages,
+together with counters of the work done in each stage, such as the number of
+slide tiles read or contours drawn. The library reports stages and counts
+through the module-level `stage` and `count` functions, which do nothing
+unless a profiler has been activated with `profile`.
+
+Examples
+--------
+>>> from viewmask import profiling
+>>> profiler = profiling.Profiler()
+>>> with profiling.profile(profiler):
+...     annotations = Annotations.from_tcga('annotations.xml')
+...     annotations.as_image()
+>>> profiler.write('profile.json', format='chrome')
+"""
+from contextlib import contextmanager, nullcontext
+
+_active_profiler = None
+_inactive_stage = nullcontext()
+
+
+def _peak_rss():
+    """Return the peak resident set size of this process, in bytes."""
+    try:
+        import resource
+    except ImportError:  # not available on Windows
+        return None
+    import sys
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Profiler:
+    """Record the cost of every stage of a computation.
+
+    Parameters
+    ----------
+    dask_tasks : bool, optional
+        Whether to also count the dask tasks that are executed in every
+        stage, grouped by the name of the task, such as ``read-slide`` or
+        ``rasterize_block``.
+
+    Attributes
+    ----------
+    stages : list of dict
+        One record per completed stage, in the order in which the stages
+        started. Every record has the ``name``, ``start`` and ``wall_time``
+        of the stage, in seconds since the profiler was created, its
+        ``cpu_time`` in seconds, the ``peak_rss`` of the process in bytes
+        when the stage ended, its nesting ``depth``, and the ``counts``
+        reported while it was the innermost stage.
+    counts : dict
+        The counts of the whole run.
+    """
+
+    def __init__(self, dask_tasks=False):
+        from threading import Lock
+        from time import perf_counter
+
+        self.dask_tasks = dask_tasks
+        self.stages = []
+        self.counts = {}
+        self._open = []
+        self._lock = Lock()
+        self._origin = perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        """Record the stage `name` while the context is active."""
+        from time import perf_counter, process_time
+
+        record = {
+            'name': name,
+            'start': perf_counter() - self._origin,
+            'depth': len(self._open),
+            'counts': {},
+        }
+        with self._lock:
+            self.stages.append(record)
+            self._open.append(record)
+        cpu_start = process_time()
+        try:
+            yield record
+        finally:
+            record['wall_time'] = \
+                perf_counter() - self._origin - record['start']
+            record['cpu_time'] = process_time() - cpu_start
+            record['peak_rss'] = _peak_rss()
+            with self._lock:
+                self._open.remove(record)
+
+    def count(self, name, n=1):
+        """Add `n` to the counter `name` of the run and innermost stage.
+
+        This can be called from any thread, such as the dask workers that
+        read slide tiles while the main thread is in a stage.
+        """
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+            if self._open:
+                counts = self._open[-1]['counts']
+                counts[name] = counts.get(name, 0) + n
+
+    def summary(self):
+        """Return the total wall and CPU time and counts of every stage name.
+
+        Returns
+        -------
+        summary : dict
+            The ``calls``, ``wall_time``, ``cpu_time``, largest ``peak_rss``
+            and ``counts`` of every stage name, in order of first use.
+        """
+        summary = {}
+        for record in self.stages:
+            if 'wall_time' not in record:
+                continue
+            total = summary.setdefault(record['name'], {
+                'calls': 0, 'wall_time': 0.0, 'cpu_time': 0.0,
+                'peak_rss': record['peak_rss'], 'counts': {},
+            })
+            total['calls'] += 1
+            total['wall_time'] += record['wall_time']
+            total['cpu_time'] += record['cpu_time']
+            if record['peak_rss'] is not None:
+                total['peak_rss'] = max(total['peak_rss'], record['peak_rss'])
+            for name, n in record['counts'].items():
+                total['counts'][name] = total['counts'].get(name, 0) + n
+        return summary
+
+    def to_dict(self):
+        """Return the stages, their summary and the counts of the run."""
+        return {
+            'stages': [dict(record) for record in self.stages],
+            'summary': self.summary(),
+            'counts': dict(self.counts),
+            'peak_rss': _peak_rss(),
+        }
+
+    def to_chrome_trace(self):
+        """Return the stages as a Chrome trace.
+
+        The trace can be opened in ``chrome://tracing`` or Perfetto; every
+        stage is a complete (``X``) event, with its CPU time, peak memory
+        and counts as arguments.
+        """
+        import os
+
+        events = []
+        for record in self.stages:
+            if 'wall_time' not in record:
+                continue
+            events.append({
+                'name': record['name'],
+                'ph': 'X',
+                'ts': record['start'] * 1e6,
+                'dur': record['wall_time'] * 1e6,
+                'pid': os.getpid(),
+                'tid': 0,
+                'args': dict(
+                    record['counts'],
+                    cpu_time=record['cpu_time'],
+                    peak_rss=record['peak_rss'],
+                ),
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write(self, output, format='json'):
+        """Write the profile to a file.
+
+        Parameters
+        ----------
+        output : str or file object
+            The path of the file, or a file object opened in text mode.
+        format : {'json', 'chrome'}, optional
+            Whether to write the output of `to_dict` or `to_chrome_trace`.
+        """
+        import json
+
+        if format == 'json':
+            data = self.to_dict()
+        elif format == 'chrome':
+            data = self.to_chrome_trace()
+        else:
+            raise ValueError(f"invalid format: {format}")
+        if isinstance(output, str):
+            with open(output, 'w') as f:
+                json.dump(data, f, indent=1)
+        else:
+            json.dump(data, output, indent=1)
+
+
+@contextmanager
+def profile(profiler=None):
+    """Activate a profiler for the library while the context is active.
+
+    Parameters
+    ----------
+    profiler : viewmask.profiling.Profiler, optional
+        The profiler to record to. By default, a new one is created.
+
+    Yields
+    ------
+    profiler : viewmask.profiling.Profiler
+    """
+    global _active_profiler
+
+    if profiler is None:
+        profiler = Profiler()
+    previous, _active_profiler = _active_profiler, profiler
+    callback = nullcontext()
+    if profiler.dask_tasks:
+        from dask.callbacks import Callback
+        from dask.utils import key_split
+
+        def count_task(key, result, dsk, state, worker_id):
+            profiler.count('dask_tasks.' + key_split(key))
+
+        callback = Callback(posttask=count_task)
+    try:
+        with callback:
+            yield profiler
+    finally:
+        _active_profiler = previous
+
+
+def get_profiler():
+    """Return the active profiler, or `None` if profiling is inactive."""
+    return _active_profiler
+
+
+def stage(name):
+    """Return a context manager that records the stage `name`, if profiling.
+
+    When no profiler is active, a shared no-op context manager is returned,
+    so stages can be left in hot code paths.
+    """
+    profiler = _active_profiler
+    if profiler is None:
+        return _inactive_stage
+    return profiler.stage(name)
+
+
+def count(name, n=1):
+    """Add `n` to the counter `name` of the active profiler, if any."""
+    profiler = _active_profiler
+    if profiler is not None:
+        profiler.count(name, n)
@@ -1,15 +1,591 @@
-import cv2
 import numpy as np
+from functools import lru_cache
+from viewmask import profiling
 
 
-# https://github.com/jlevy44/PathFlowAI/blob/888f0867eeed4e1265cafed9b9f0f42bebd6a6ae/pathflowai/utils.py#L86-L129
-def file_to_dask_array(
-    path,
-    tile_size=1000,
-    overlap=0,
-    remove_last=True,
-    allow_unknown_chunksizes=False
-):
+class TileCache:
+    """A thread-safe LRU cache of decoded slide tiles with a byte budget.
+
+    Tiles are keyed by ``(path, level, x, y, width, height)``, where the
+    coordinates are in the pixel space of `level`. When storing a tile would
+    exceed `max_bytes`, the least recently used tiles are evicted first.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        The maximum total size of the cached tiles, in bytes. Defaults to
+        512 MiB.
+
+    Attributes
+    ----------
+    hits : int
+        The number of lookups that were served from the cache.
+    misses : int
+        The number of lookups that were not in the cache.
+    evictions : int
+        The number of tiles that were evicted to stay within `max_bytes`.
+
+    Notes
+    -----
+    Pickling a cache (for example, when a dask graph is sent to another
+    process) produces an empty cache with the same byte budget; the tiles
+    themselves are never copied between processes.
+    """
+
+    def __init__(self, max_bytes=512 * 2**20):
+        from collections import OrderedDict
+        from threading import Lock
+
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._tiles = OrderedDict()
+        self._lock = Lock()
+
+    def __reduce__(self):
+        return self.__class__, (self.max_bytes,)
+
+    def __len__(self):
+        return len(self._tiles)
+
+    def __contains__(self, key):
+        return key in self._tiles
+
+    def get(self, key):
+        """Return the cached tile for `key`, or `None` if it is missing."""
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._tiles.move_to_end(key)
+            return tile
+
+    def put(self, key, tile):
+        """Store `tile` under `key`, evicting old tiles if necessary.
+
+        The tile is marked read-only, since it will be shared by every
+        consumer that reads the same region.
+        """
+        tile.flags.writeable = False
+        if tile.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._tiles.pop(key, None)
+            if previous is not None:
+                self.nbytes -= previous.nbytes
+            self._tiles[key] = tile
+            self.nbytes += tile.nbytes
+            self._evict()
+
+    def resize(self, max_bytes):
+        """Change the byte budget, evicting tiles if it shrinks."""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        """Remove all tiles and reset the counters."""
+        with self._lock:
+            self._tiles.clear()
+            self.nbytes = self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """Return the cache counters as a dict."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'tiles': len(self._tiles),
+                'nbytes': self.nbytes,
+                'max_bytes': self.max_bytes,
+            }
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes:
+            _, tile = self._tiles.popitem(last=False)
+            self.nbytes -= tile.nbytes
+            self.evictions += 1
+
+
+# shared by every slide array that is created with the default `cache=True`
+tile_cache = TileCache()
+
+
+@lru_cache(maxsize=16)
+def _open_slide(path):
+    # OpenSlide handles are thread-safe, so every dask task that reads from
+    # the same slide shares one handle per process
+    import openslide
+
+    return openslide.OpenSlide(path)
+
+
+def _read_slide_region(path, level, x, y, width, height):
+    """Read an RGB region of a slide, in the coordinates of `level`."""
+    slide = _open_slide(path)
+    downsample = slide.level_downsamples[level]
+    rgba = np.asarray(slide.read_region(
+        (int(x * downsample), int(y * downsample)),
+        level,
+        (width, height)
+    ))
+    # composite transparent (out-of-bounds) pixels onto the slide background,
+    # like openslide.deepzoom does
+    background = slide.properties.get(
+        'openslide.background-color', 'ffffff')
+    background = np.array(
+        [int(background[i:i + 2], 16) for i in (0, 2, 4)], dtype=np.uint16)
+    alpha = rgba[..., 3:].astype(np.uint16)
+    rgb = (rgba[..., :3] * alpha + background * (255 - alpha) + 127) // 255
+    return rgb.astype(np.uint8)
+
+
+def _read_slide_tile(path, level, x, y, width, height, cache=None):
+    if cache is None:
+        profiling.count('tiles_read')
+        return _read_slide_region(path, level, x, y, width, height)
+    key = (path, level, x, y, width, height)
+    tile = cache.get(key)
+    if tile is None:
+        profiling.count('tiles_read')
+        tile = _read_slide_region(path, level, x, y, width, height)
+        cache.put(key, tile)
+    else:
+        profiling.count('tile_cache_hits')
+    return tile
+
+
+def _read_slide_block(path, level, cache=None, block_info=None):
+    (y0, y1), (x0, x1), _ = block_info[None]['array-location']
+    return _read_slide_tile(path, level, x0, y0, x1 - x0, y1 - y0, cache)
+
+
+class TilePrefetcher:
+    """Read the slide tiles around a viewport ahead of time, in the background.
+
+    An interactive viewer only asks dask for the chunks that it is about to
+    show, one at a time, so panning across a slide stalls on every tile that
+    has not been decoded yet. A prefetcher can be passed as the `cache` of
+    `file_to_dask_array` in place of a `TileCache`; whenever the viewport
+    moves, `prefetch` reads the tiles in and around the viewport, followed by
+    the same region of the neighbouring pyramid levels, on a pool of
+    background threads. Tiles that leave the viewport before they are read
+    are cancelled, and a chunk that is requested while its tile is being
+    read waits for that read instead of decoding the tile again.
+
+    Parameters
+    ----------
+    cache : viewmask.utils.TileCache, optional
+        The cache to fill. Defaults to the shared `viewmask.utils.tile_cache`.
+    max_workers : int, optional
+        The number of background threads.
+    margin : int, optional
+        The number of tiles to prefetch on every side of the viewport.
+
+    Attributes
+    ----------
+    prefetched : int
+        The number of tiles that were read in the background.
+    cancelled : int
+        The number of reads that were cancelled before they started.
+
+    Notes
+    -----
+    At most half of the byte budget of `cache` is prefetched at once, so
+    prefetching never evicts the tiles that are on screen. Pickling a
+    prefetcher produces an empty `TileCache`, like pickling `cache` does.
+
+    Examples
+    --------
+    >>> prefetcher = TilePrefetcher()
+    >>> pyramid = file_to_dask_array(path, multiscale=True, cache=prefetcher)
+    >>> prefetcher.prefetch(2, (0, 0, 1999, 1499))  # on every camera move
+    """
+
+    def __init__(self, cache=None, max_workers=4, margin=1):
+        from concurrent.futures import ThreadPoolExecutor
+        from threading import RLock
+
+        self.cache = tile_cache if cache is None else cache
+        self.margin = margin
+        self.path = None
+        self.tile_size = None
+        self.prefetched = 0
+        self.cancelled = 0
+        self._pending = {}
+        # reentrant, since cancelling a future runs its callback immediately
+        self._lock = RLock()
+        self._executor = ThreadPoolExecutor(
+            max_workers, thread_name_prefix='viewmask-prefetch')
+
+    def __reduce__(self):
+        return self.cache.__reduce__()
+
+    def bind(self, path, tile_size):
+        """Prefetch the tiles of `path`, as `file_to_dask_array` chunks it.
+
+        This is called by `file_to_dask_array`, and cancels the tiles that
+        are pending for the previously bound slide.
+        """
+        self.cancel()
+        self.path = path
+        self.tile_size = tile_size
+
+    def get(self, key):
+        """Return the tile for `key`, waiting for it if it is being read."""
+        tile = self.cache.get(key)
+        if tile is not None:
+            return tile
+        with self._lock:
+            future = self._pending.get(key)
+        if future is not None and not future.cancel():
+            return future.result()
+        return None
+
+    def put(self, key, tile):
+        """Store `tile` under `key` in the cache."""
+        self.cache.put(key, tile)
+
+    def tiles(self, level, bbox, margin=0):
+        """Return the keys of the tiles of a level that intersect a rectangle.
+
+        Parameters
+        ----------
+        level : int
+            The pyramid level of the bound slide.
+        bbox : tuple of int
+            The inclusive (x_min, y_min, x_max, y_max) rectangle, in the
+            coordinates of `level`.
+        margin : int, optional
+            The number of extra tiles to include on every side.
+
+        Returns
+        -------
+        keys : list of tuple
+            The `TileCache` keys of the tiles, from the center of `bbox`
+            outwards.
+        """
+        width, height = _open_slide(self.path).level_dimensions[level]
+        size = self.tile_size
+        x_min, y_min, x_max, y_max = bbox
+        cols = np.arange(
+            max(int(x_min) // size - margin, 0),
+            min(int(x_max) // size + margin, (width - 1) // size) + 1)
+        rows = np.arange(
+            max(int(y_min) // size - margin, 0),
+            min(int(y_max) // size + margin, (height - 1) // size) + 1)
+        cols, rows = (grid.ravel() for grid in np.meshgrid(cols, rows))
+        distances = np.hypot(
+            (cols + 0.5) * size - (x_min + x_max + 1) / 2,
+            (rows + 0.5) * size - (y_min + y_max + 1) / 2)
+        keys = []
+        for i in np.argsort(distances, kind='stable'):
+            x, y = int(cols[i]) * size, int(rows[i]) * size
+            keys.append((
+                self.path, level, x, y,
+                min(size, width - x), min(size, height - y)))
+        return keys
+
+    def prefetch(self, level, bbox):
+        """Read the tiles around a viewport, and cancel the tiles outside it.
+
+        Parameters
+        ----------
+        level : int
+            The pyramid level that is on screen.
+        bbox : tuple of int
+            The inclusive (x_min, y_min, x_max, y_max) rectangle that is on
+            screen, in the coordinates of `level`.
+        """
+        from functools import partial
+
+        if self.path is None:  # the image is not read from a slide
+            return
+        slide = _open_slide(self.path)
+        keys = self.tiles(level, bbox, self.margin)
+        for neighbour in (level - 1, level + 1):
+            if 0 <= neighbour < slide.level_count:
+                scale = slide.level_downsamples[level] \
+                    / slide.level_downsamples[neighbour]
+                keys += self.tiles(
+                    neighbour, tuple(int(v * scale) for v in bbox))
+        budget = self.cache.max_bytes // 2
+        for n, key in enumerate(keys):
+            budget -= key[4] * key[5] * 3
+            if budget < 0:
+                keys = keys[:n]
+                break
+
+        with self._lock:
+            wanted = set(keys)
+            for key, future in list(self._pending.items()):
+                if key not in wanted and future.cancel():
+                    self.cancelled += 1
+            for key in keys:
+                if key in self._pending or key in self.cache:
+                    continue
+                future = self._executor.submit(self._read, key)
+                self._pending[key] = future
+                future.add_done_callback(partial(self._forget, key))
+
+    def cancel(self):
+        """Cancel every read that has not started yet."""
+        with self._lock:
+            for future in list(self._pending.values()):
+                if future.cancel():
+                    self.cancelled += 1
+
+    def close(self):
+        """Cancel the pending reads and stop the background threads."""
+        self.cancel()
+        self._executor.shutdown(wait=False)
+
+    def stats(self):
+        """Return the prefetching counters as a dict."""
+        with self._lock:
+            return {
+                'prefetched': self.prefetched,
+                'cancelled': self.cancelled,
+                'pending': len(self._pending),
+            }
+
+    def _read(self, key):
+        tile = _read_slide_region(*key)
+        self.cache.put(key, tile)
+        with self._lock:
+            self.prefetched += 1
+        profiling.count('tiles_prefetched')
+        return tile
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._pending.get(key) is future:
+                del self._pending[key]
+
+
+def _slide_level_to_dask_array(path, level, tile_size, cache=None):
+    import dask.array as da
+    from dask.base import tokenize
+    from os.path import getmtime
+
+    width, height = _open_slide(path).level_dimensions[level]
+    shape = (height, width, 3)
+    # every chunk maps onto exactly one OpenSlide.read_region call, so the
+    # graph is a single blockwise layer no matter how large the slide is
+    return da.map_blocks(
+        _read_slide_block,
+        path=path,
+        level=level,
+        cache=cache,
+        name='read-slide-' + tokenize(path, getmtime(path), level, tile_size),
+        chunks=da.core.normalize_chunks((tile_size, tile_size, 3), shape),
+        dtype=np.uint8,
+        meta=np.empty((0, 0, 0), dtype=np.uint8),
+    )
+
+
+def _downsample_pyramid(arr, axes=(0, 1), min_size=256):
+    # strided views are lazy, so coarser levels only touch the pixels they show
+    index = tuple(
+        slice(None, None, 2) if axis in axes else slice(None)
+        for axis in range(arr.ndim)
+    )
+    pyramid = [arr]
+    while min(pyramid[-1].shape[axis] for axis in axes) // 2 >= min_size:
+        pyramid.append(pyramid[-1][index])
+    return pyramid
+
+
+def _zarr_store_for(path):
+    """Return the converted store for `path`, if there is an up-to-date one."""
+    import os
+
+    if path.rstrip('/\\').endswith('.zarr') and os.path.isdir(path):
+        return path
+    store = path + '.zarr'
+    if os.path.isdir(store) \
+            and os.path.getmtime(store) >= os.path.getmtime(path):
+        return store
+    return None
+
+
+def _open_zarr_pyramid(store):
+    import dask.array as da
+    import zarr
+
+    group = zarr.open_group(store, mode='r')
+    datasets = group.attrs['multiscales'][0]['datasets']
+    return [
+        da.from_zarr(store, component=dataset['path'])
+        for dataset in datasets
+    ]
+
+
+def convert_to_zarr(path, store=None, tile_size=1000, overwrite=False):
+    """Convert an image or mask to a chunked, compressed, multiscale store.
+
+    The image is read once, level by level, and every level of its pyramid
+    is written as a separate Zarr array, chunked like `file_to_dask_array`
+    chunks the image and compressed with Zarr's default compressor. Once the
+    store exists, `file_to_dask_array` opens it instead of decoding the
+    original file again.
+
+    Parameters
+    ----------
+    path : str
+        The path to a slide, image or ``.npy`` mask that
+        `file_to_dask_array` can read.
+    store : str, optional
+        The path of the Zarr store to create. Defaults to `path` followed by
+        ``.zarr``, which is where `file_to_dask_array` looks for it.
+    tile_size : int, optional
+        The height and width of every chunk in the store.
+    overwrite : bool, optional
+        Whether to replace `store` if it already exists.
+
+    Returns
+    -------
+    store : str
+        The path of the created store.
+
+    Notes
+    -----
+    The levels are listed in the ``multiscales`` attribute of the root
+    group, using the layout of the OME-NGFF specification, but the axes are
+    kept in the order of `file_to_dask_array`: (y, x[, c]), or (t, y, x[, c])
+    for images that it reads with a leading frame axis. The store is
+    written to a temporary directory next to `store` and then renamed, so a
+    store that exists is always complete, even if the conversion fails.
+
+    This requires the optional ``zarr`` package, which is installed with
+    ``pip install viewmask[zarr]``.
+    """
+    import os
+    import shutil
+    import tempfile
+    import dask.array as da
+    import openslide
+    import zarr
+
+    if store is None:
+        store = path + '.zarr'
+    if os.path.exists(store):
+        if not overwrite:
+            raise FileExistsError(f'{store} already exists')
+        # otherwise file_to_dask_array would read the old store back
+        shutil.rmtree(store)
+
+    pyramid = file_to_dask_array(path, tile_size=tile_size, multiscale=True)
+    # images read with dask_image have a leading frame axis, which is kept so
+    # that the store reads back with the shape of the original file
+    frames = int(
+        not path.endswith(('.npy', '.npz'))
+        and openslide.OpenSlide.detect_format(path) is None)
+    axes = ['t'] * frames + ['y', 'x', 'c'][:pyramid[0].ndim - frames]
+
+    temporary = tempfile.mkdtemp(
+        prefix='.' + os.path.basename(store) + '-',
+        dir=os.path.dirname(os.path.abspath(store)))
+    try:
+        datasets = []
+        for level, arr in enumerate(pyramid):
+            chunks = (1,) * frames + (tile_size, tile_size) \
+                + arr.shape[frames + 2:]
+            da.to_zarr(
+                arr.rechunk(chunks), temporary, component=str(level),
+                overwrite=True)
+            datasets.append({
+                'path': str(level),
+                'coordinateTransformations': [{
+                    'type': 'scale',
+                    'scale': [1] * frames + [
+                        pyramid[0].shape[frames] / arr.shape[frames],
+                        pyramid[0].shape[frames + 1] / arr.shape[frames + 1],
+                    ] + [1] * (arr.ndim - frames - 2),
+                }],
+            })
+        zarr.open_group(temporary, mode='a').attrs.update({'multiscales': [{
+            'version': '0.4',
+            'name': os.path.basename(path),
+            'axes': [{'name': axis} for axis in axes],
+            'datasets': datasets,
+        }]})
+        os.rename(temporary, store)
+    except BaseException:
+        shutil.rmtree(temporary, ignore_errors=True)
+        raise
+    return store
+
+
+def _read_npy_header(f):
+    """Return the (shape, fortran_order, dtype) of a ``.npy`` stream."""
+    if np.lib.format.read_magic(f) == (1, 0):
+        return np.lib.format.read_array_header_1_0(f)
+    # version 3.0 only differs from 2.0 in allowing UTF-8 field names
+    return np.lib.format.read_array_header_2_0(f)
+
+
+def _memmap_npz_member(path, name):
+    """Memory-map an uncompressed member of a ``.npz`` file.
+
+    Returns `None` if the member is compressed or holds Python objects.
+    """
+    import struct
+    import zipfile
+
+    with zipfile.ZipFile(path) as archive:
+        info = archive.getinfo(name)
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+    with open(path, 'rb') as f:
+        # the lengths in the local header can differ from the central
+        # directory's, so the data offset has to be read from it
+        f.seek(info.header_offset)
+        name_length, extra_length = struct.unpack('<HH', f.read(30)[26:])
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+        shape, fortran_order, dtype = _read_npy_header(f)
+        offset = f.tell()
+    if dtype.hasobject:
+        return None
+    return np.memmap(
+        path, dtype=dtype, mode='r', offset=offset, shape=shape,
+        order='F' if fortran_order else 'C')
+
+
+def _numpy_file_to_dask_array(path, tile_size):
+    """Open a ``.npy`` file, or the first array of a ``.npz`` file, lazily.
+
+    Arrays are memory-mapped, so only the chunks that are computed are ever
+    read from disk. Compressed ``.npz`` members cannot be memory-mapped, and
+    are decompressed into memory once, when the file is opened; a lazy load
+    would decompress the whole member again on every compute.
+    """
+    import dask.array as da
+    from dask.base import tokenize
+    from os.path import getmtime
+
+    name = 'numpy-file-' + tokenize(path, getmtime(path), tile_size)
+    if path.endswith('.npy'):
+        arr = np.load(path, mmap_mode='r')
+    else:
+        import zipfile
+
+        with zipfile.ZipFile(path) as archive:
+            member = archive.namelist()[0]
+        arr = _memmap_npz_member(path, member)
+        if arr is None:
+            with np.load(path) as npz:
+                arr = npz[member[:-len('.npy')]]
+    chunks = (tile_size,) * min(arr.ndim, 2) + arr.shape[2:]
+    return da.from_array(arr, chunks=chunks, name=name)
+
+
+def file_to_dask_array(path, tile_size=1000, multiscale=False, cache=True):
     """Load an image to a dask array.
 
     Parameters
@@ -17,18 +593,28 @@ def file_to_dask_array(
     path : str
         The path to the image file as a string.
     tile_size : int, optional
-        Size of chunk to be read in.
-    overlap : int, optional
-        Do not modify, overlap between neighboring tiles.
-    remove_last : bool, optional
-        Remove last tile because it has a custom size.
-    allow_unknown_chunksizes : bool, optional
-        Allow different chunk sizes, more flexible, but slowdown.
+        Size of chunk to be read in. Each chunk of a slide is read with a
+        single call to `openslide.OpenSlide.read_region`; chunks on the right
+        and bottom edges of the slide are smaller.
+    multiscale : bool, optional
+        Whether to return an image pyramid instead of a single array. Defaults
+        to `False`.
+    cache : bool or viewmask.utils.TileCache, optional
+        The cache that decoded slide tiles are kept in, so that recomputing
+        the array (for example, while panning in napari) does not decode the
+        same tiles again. If `True` (the default), the shared
+        `viewmask.utils.tile_cache` is used. If `False`, tiles are not cached.
+        A `viewmask.utils.TilePrefetcher` is bound to the slide, so that it
+        can read tiles ahead of the viewer.
 
     Returns
     -------
-    arr : dask.array.Array
-        A Dask Array representing the contents of the image file.
+    arr : dask.array.Array or list of dask.array.Array
+        A Dask Array representing the contents of the image file. If
+        `multiscale` is `True`, a list of Dask Arrays is returned instead, one
+        per pyramid level, ordered from the highest resolution to the lowest
+        resolution. This list can be passed directly to napari with
+        ``multiscale=True``.
 
     Examples
     --------
@@ -40,58 +626,386 @@ def file_to_dask_array(
     ...     interpolation=cv2.INTER_CUBIC
     ... ))
     >>> pil_img.save(test_image_name)
-    """
-    if path.endswith('.npy'):
-        import dask.array as da
 
-        return da.from_array(np.load(path))
+    >>> pyramid = file_to_dask_array(path, multiscale=True)
+    >>> napari.view_image(pyramid, multiscale=True)
+
+    Notes
+    -----
+    If `path` is a Zarr store created by `convert_to_zarr`, or if such a
+    store exists at `path` followed by ``.zarr`` and is newer than `path`,
+    the store is read instead, and no tiles have to be decoded.
+
+    A ``.npy`` file, or the first array of a ``.npz`` file, is memory-mapped
+    and split into chunks of `tile_size`, so opening it takes no memory and
+    only the chunks that are computed are read. Members of ``.npz`` files
+    that were saved with `numpy.savez_compressed` cannot be memory-mapped,
+    and are decompressed into memory as a whole when the file is opened.
+    """
+    store = _zarr_store_for(path)
+    if store is not None:
+        pyramid = _open_zarr_pyramid(store)
+        return pyramid if multiscale else pyramid[0]
+    if path.endswith(('.npy', '.npz')):
+        arr = _numpy_file_to_dask_array(path, tile_size)
+        return _downsample_pyramid(arr) if multiscale else arr
     else:
         import openslide
 
         img = openslide.open_slide(path)
         if isinstance(img, openslide.OpenSlide):
-            from openslide import deepzoom
-            import dask.array as da
-            import dask.delayed
-
-            gen = deepzoom.DeepZoomGenerator(
-                img,
-                tile_size=tile_size,
-                overlap=overlap,
-                limit_bounds=True
-            )
-            max_level = len(gen.level_dimensions) - 1
-            n_tiles_x, n_tiles_y = gen.level_tiles[max_level]
-
-            @dask.delayed(pure=True)
-            def get_tile(level, column, row):
-                tile = gen.get_tile(level, (column, row))  # PIL.Image
-                return da.transpose(
-                    da.from_array(np.array(tile)),
-                    axes=(1, 0, 2)
-                )
-
-            sample_tile_shape = get_tile(max_level, 0, 0).shape.compute()
-            rows = range(n_tiles_y - (0 if not remove_last else 1))
-            cols = range(n_tiles_x - (0 if not remove_last else 1))
-            tiles = [da.concatenate(
-                [da.from_delayed(
-                    get_tile(max_level, col, row),
-                    sample_tile_shape,
-                    np.uint8
-                ) for row in rows],
-                allow_unknown_chunksizes=allow_unknown_chunksizes,
-                axis=1
-            ) for col in cols]
-            arr = da.concatenate(
-                tiles,
-                allow_unknown_chunksizes=allow_unknown_chunksizes
-            ).transpose([1, 0, 2])
-            return arr
+            if cache is True:
+                cache = tile_cache
+            elif cache is False:
+                cache = None
+            elif isinstance(cache, TilePrefetcher):
+                cache.bind(path, tile_size)
+            if not multiscale:
+                return _slide_level_to_dask_array(path, 0, tile_size, cache)
+            return [
+                _slide_level_to_dask_array(path, level, tile_size, cache)
+                for level in range(img.level_count)
+            ]
         else:  # img is instance of openslide.ImageSlide
             import dask_image.imread
 
-            return dask_image.imread.imread(path)
+            arr = dask_image.imread.imread(path)  # (frames, y, x, ...)
+            return _downsample_pyramid(arr, axes=(1, 2)) if multiscale else arr
+
+
+def select_pyramid_level(pyramid, level=None, downsample=None):
+    """Pick the level of an image pyramid to render at a resolution.
+
+    Parameters
+    ----------
+    pyramid : list of array_like
+        The levels of an image, from the highest resolution to the lowest,
+        with shape (M, N[, C]), such as the output of `file_to_dask_array`
+        with ``multiscale=True``.
+    level : int, optional
+        The index of the level to return.
+    downsample : float, optional
+        The downsample factor, relative to the first level, to render at.
+        The coarsest level that is at least as fine as `downsample` is read,
+        and strided down further if it is more than twice as fine. Only one
+        of `level` and `downsample` can be given.
+
+    Returns
+    -------
+    arr : array_like
+        The selected level.
+    scale : (float, float)
+        The factors that map X and Y coordinates in the first level onto
+        `arr`, which can be passed to `viewmask.Annotations.scale`.
+
+    Raises
+    ------
+    ValueError
+        If both `level` and `downsample` are given, if `level` is not a
+        level of `pyramid`, or if `downsample` is smaller than 1.
+    """
+    if level is not None and downsample is not None:
+        raise ValueError("only one of `level` and `downsample` can be given")
+    base = pyramid[0]
+    if level is not None:
+        if not 0 <= level < len(pyramid):
+            raise ValueError(
+                f"`level` must be between 0 and {len(pyramid) - 1}")
+        arr = pyramid[level]
+    elif downsample is not None:
+        if downsample < 1:
+            raise ValueError("`downsample` must be at least 1")
+        # allow for the rounding of odd level sizes
+        candidates = [
+            arr for arr in pyramid
+            if base.shape[0] / arr.shape[0] <= downsample * 1.01
+        ]
+        arr = candidates[-1]
+        stride = int(downsample * arr.shape[0] / base.shape[0] * 1.01)
+        if stride > 1:
+            arr = arr[::stride, ::stride]
+    else:
+        arr = base
+    return arr, (arr.shape[1] / base.shape[1], arr.shape[0] / base.shape[0])
+
+
+def _flatten_contours(contours):
+    """Return the (coordinates, offsets) columns of a sequence of contours."""
+    if hasattr(contours, 'coordinates') and hasattr(contours, 'offsets'):
+        return contours.coordinates, contours.offsets  # PackedAnnotations
+    contours = [np.asarray(contour).reshape(-1, 2) for contour in contours]
+    lengths = [len(contour) for contour in contours]
+    offsets = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+    if not contours:
+        return np.empty((0, 2), dtype=np.int32), offsets
+    return np.concatenate(contours), offsets
+
+
+def _segment_reduce(values, offsets, ufunc=np.add, empty=0):
+    # ufunc.reduceat misbehaves on empty segments, so only reduce the others
+    starts, lengths = offsets[:-1], np.diff(offsets)
+    reduced = np.full(
+        (len(lengths),) + values.shape[1:], empty, dtype=values.dtype)
+    nonempty = lengths > 0
+    if nonempty.any():
+        reduced[nonempty] = ufunc.reduceat(values, starts[nonempty])
+    return reduced
+
+
+def _next_vertex_indices(offsets):
+    # the index of the following vertex, wrapping around within each contour
+    lengths = np.diff(offsets)
+    indices = np.arange(1, offsets[-1] + 1)
+    nonempty = lengths > 0
+    indices[offsets[1:][nonempty] - 1] = offsets[:-1][nonempty]
+    return indices
+
+
+def _contour_extents(coordinates, offsets):
+    """Return the bounding box and the longest segment of every contour.
+
+    The bounding boxes are (x_min, y_min, x_max, y_max) rows, inclusive.
+    Empty contours get an empty box, which does not intersect anything.
+    """
+    coordinates = coordinates.astype(np.int64)
+    limits = np.iinfo(np.int64)
+    bboxes = np.hstack((
+        _segment_reduce(coordinates, offsets, np.minimum, limits.max),
+        _segment_reduce(coordinates, offsets, np.maximum, limits.min),
+    ))
+    steps = np.abs(coordinates[_next_vertex_indices(offsets)] - coordinates)
+    longest_segments = _segment_reduce(steps.max(axis=1, initial=0), offsets)
+    return bboxes, longest_segments
+
+
+class BoundingBoxIndex:
+    """A uniform grid over bounding boxes for fast rectangle queries.
+
+    Every box is registered in each grid cell it overlaps, so a query only has
+    to look at the boxes in the cells that the query rectangle covers. Boxes
+    that would span more than `max_cells` cells are kept aside and checked
+    directly on every query, so a few huge regions do not bloat the grid.
+
+    Parameters
+    ----------
+    bboxes : array_like of int
+        An array with shape (M, 4) of inclusive (x_min, y_min, x_max, y_max)
+        boxes. Boxes with x_min > x_max or y_min > y_max are empty and never
+        match a query.
+    cell_size : int, optional
+        The width and height of a grid cell, in pixels. Defaults to twice the
+        median box size, but large enough that there are at most about four
+        cells per box.
+    max_cells : int, optional
+        The maximum number of cells a single box is registered in.
+
+    Examples
+    --------
+    >>> index = BoundingBoxIndex([[0, 0, 9, 9], [50, 50, 60, 60]])
+    >>> index.query((5, 5, 20, 20))
+    array([0])
+    """
+
+    def __init__(self, bboxes, cell_size=None, max_cells=64):
+        bboxes = np.asarray(bboxes, dtype=np.int64).reshape(-1, 4)
+        self.bboxes = bboxes
+        valid = (bboxes[:, 0] <= bboxes[:, 2]) & (bboxes[:, 1] <= bboxes[:, 3])
+        sizes = (bboxes[valid, 2:] - bboxes[valid, :2] + 1).max(axis=1)
+        self.origin = bboxes[valid, :2].min(axis=0) if valid.any() else (0, 0)
+        if cell_size is None and len(sizes):
+            extent = bboxes[valid, 2:].max(axis=0) - self.origin + 1
+            cell_size = max(
+                2 * np.median(sizes),
+                np.sqrt(np.prod(extent, dtype=np.float64) / (4 * len(sizes)))
+            )
+        self.cell_size = max(int(cell_size or 1), 1)
+
+        cells = self._cells(bboxes)
+        n_x = cells[:, 2] - cells[:, 0] + 1
+        n_y = cells[:, 3] - cells[:, 1] + 1
+        self.shape = (
+            int(cells[valid, 3].max()) + 1 if valid.any() else 0,
+            int(cells[valid, 2].max()) + 1 if valid.any() else 0,
+        )
+        gridded = valid & (n_x * n_y <= max_cells)
+        self.oversized = np.flatnonzero(valid & ~gridded)
+
+        # register every gridded box in every cell it overlaps
+        ids = np.flatnonzero(gridded)
+        counts = (n_x * n_y)[ids]
+        box = np.repeat(ids, counts)
+        local = np.arange(counts.sum()) - np.repeat(
+            np.cumsum(counts) - counts, counts)
+        cell_x = cells[box, 0] + local % n_x[box]
+        cell_y = cells[box, 1] + local // n_x[box]
+        cell_ids = cell_y * self.shape[1] + cell_x
+        order = np.argsort(cell_ids, kind='stable')
+        self.cell_boxes = box[order]
+        self.cell_offsets = np.concatenate(([0], np.cumsum(
+            np.bincount(cell_ids, minlength=self.shape[0] * self.shape[1]))))
+
+    def __len__(self):
+        return len(self.bboxes)
+
+    def _cells(self, bboxes):
+        return np.hstack((
+            (bboxes[:, :2] - self.origin) // self.cell_size,
+            (bboxes[:, 2:] - self.origin) // self.cell_size,
+        ))
+
+    def query(self, bbox):
+        """Find the boxes that intersect a rectangle.
+
+        Parameters
+        ----------
+        bbox : tuple of int
+            The inclusive (x_min, y_min, x_max, y_max) rectangle to query.
+
+        Returns
+        -------
+        indices : numpy.ndarray
+            The sorted indices of the boxes that intersect `bbox`.
+        """
+        bbox = np.asarray(bbox, dtype=np.int64).reshape(1, 4)
+        cell_x0, cell_y0, cell_x1, cell_y1 = self._cells(bbox)[0]
+        cell_x0, cell_y0 = max(cell_x0, 0), max(cell_y0, 0)
+        cell_x1 = min(cell_x1, self.shape[1] - 1)
+        cell_y1 = min(cell_y1, self.shape[0] - 1)
+        candidates = self.oversized
+        if cell_x0 <= cell_x1 and cell_y0 <= cell_y1:
+            cell_ids = (
+                np.arange(cell_y0, cell_y1 + 1)[:, None] * self.shape[1]
+                + np.arange(cell_x0, cell_x1 + 1)[None, :]
+            ).ravel()
+            starts = self.cell_offsets[cell_ids]
+            counts = self.cell_offsets[cell_ids + 1] - starts
+            gather = np.arange(counts.sum()) + np.repeat(
+                starts - (np.cumsum(counts) - counts), counts)
+            candidates = np.concatenate(
+                (candidates, self.cell_boxes[gather]))
+        candidates = np.unique(candidates)
+        x_min, y_min, x_max, y_max = bbox[0]
+        boxes = self.bboxes[candidates]
+        return candidates[
+            (boxes[:, 0] <= x_max) & (boxes[:, 2] >= x_min)
+            & (boxes[:, 1] <= y_max) & (boxes[:, 3] >= y_min)
+        ]
+
+
+def _rasterize_window(
+    coordinates,
+    offsets,
+    index,
+    longest_segments,
+    window,
+    outline_color,
+    fill_color,
+    max_padding
+):
+    import cv2
+
+    x0, y0, x1, y1 = window
+    hits = index.query((x0, y0, x1 - 1, y1 - 1))
+    # cv2 rasterizes a clipped line differently from the unclipped line, so
+    # pad the canvas until no segment of an intersecting contour is clipped;
+    # that way, neighbouring windows line up pixel for pixel
+    padding = 0
+    if len(hits):
+        padding = min(int(longest_segments[hits].max()) + 1, max_padding)
+    canvas = np.zeros(
+        (y1 - y0 + 2 * padding, x1 - x0 + 2 * padding, 3), dtype=np.uint8)
+    contours = [coordinates[offsets[i]:offsets[i + 1]] for i in hits]
+    profiling.count('contours_drawn', len(contours))
+    shift = (padding - x0, padding - y0)
+    cv2.drawContours(canvas, contours, -1, outline_color, offset=shift)
+    for contour in contours:
+        cv2.fillPoly(canvas, [contour], fill_color, offset=shift)
+    if padding:
+        canvas = canvas[padding:-padding, padding:-padding].copy()
+    return canvas
+
+
+def _rasterize_kwargs(contours, outline_color, fill_color, max_padding):
+    """Return the keyword arguments of `_rasterize_window` for contours."""
+    coordinates, offsets = _flatten_contours(contours)
+    # np.int32 is necessary for cv2.drawContours
+    coordinates = coordinates.astype(np.int32, copy=False)
+    bboxes, longest_segments = _contour_extents(coordinates, offsets)
+    return dict(
+        coordinates=coordinates,
+        offsets=offsets,
+        index=BoundingBoxIndex(bboxes),
+        longest_segments=longest_segments,
+        outline_color=tuple(int(c) for c in outline_color),
+        fill_color=tuple(int(c) for c in fill_color),
+        max_padding=max_padding,
+    )
+
+
+def _rasterize_block(block_info=None, **kwargs):
+    (y0, y1), (x0, x1), _ = block_info[None]['array-location']
+    return _rasterize_window(window=(x0, y0, x1, y1), **kwargs)
+
+
+def rasterize_contours(
+    contours,
+    shape,
+    chunks=None,
+    outline_color=(0, 255, 0),
+    fill_color=(230, 230, 230),
+    max_padding=1024
+):
+    """Draw and fill contours, optionally as a lazy, chunked dask array.
+
+    Each contour's outline is drawn in `outline_color`, and then every contour
+    is filled with `fill_color`. When `chunks` is given, every chunk is
+    rendered independently, and only the contours whose bounding boxes
+    intersect that chunk are drawn, so the full image never has to exist in
+    memory.
+
+    Parameters
+    ----------
+    contours : list of numpy.ndarray or viewmask.PackedAnnotations
+        The contours to draw, where each contour is an array of (X, Y)
+        coordinate pairs.
+    shape : tuple of int
+        The (height, width) of the output image.
+    chunks : tuple, optional
+        The chunks of the output along the Y and X axes, in any form accepted
+        by `dask.array.core.normalize_chunks`. Passing ``arr.chunks[:2]``
+        lines the output up with the chunks of `arr`. If `None` (the default),
+        the image is drawn eagerly into a NumPy array.
+    outline_color : array_like of int, optional
+        The RGB color of the contour outlines.
+    fill_color : array_like of int, optional
+        The RGB color that the contours are filled with.
+    max_padding : int, optional
+        Every chunk is drawn on a canvas that is padded by the longest segment
+        of the contours that it intersects, so that lines are not clipped at
+        chunk borders, which would make them shift by a pixel. The padding is
+        capped at this many pixels.
+
+    Returns
+    -------
+    rendered_annotations : numpy.ndarray or dask.array.Array
+        An array with shape ``(height, width, 3)`` and dtype `numpy.uint8`.
+    """
+    kwargs = _rasterize_kwargs(
+        contours, outline_color, fill_color, max_padding)
+    height, width = shape[:2]
+    if chunks is None:
+        return _rasterize_window(window=(0, 0, width, height), **kwargs)
+
+    import dask.array as da
+
+    chunks = da.core.normalize_chunks(chunks, (height, width)) + ((3,),)
+    return da.map_blocks(
+        _rasterize_block,
+        chunks=chunks,
+        dtype=np.uint8,
+        meta=np.empty((0, 0, 0), dtype=np.uint8),
+        **kwargs,
+    )
 
 
 def centers_of_contours(contours):
@@ -99,7 +1013,7 @@ def centers_of_contours(contours):
 
     Parameters
     ----------
-    contours : list of numpy.ndarray
+    contours : list of numpy.ndarray or viewmask.PackedAnnotations
         A list of cv2 contours; each contour's center will be calculated. Each
         contour is a list with 1 element, which is a list with 2 elements,
         representing the X and Y coordinates as integers, respectively.
@@ -113,19 +1027,46 @@ def centers_of_contours(contours):
         `contours`. In this method, the center is defined as the centroid of
         the contour. If the centroid cannot be calculated, the circumcenter of
         the center is used.
+
+    Notes
+    -----
+    The centroids of all contours are computed at once with the shoelace
+    formula over a single flat array of coordinates, which gives the same
+    result as ``cv2.moments``. Only contours with a zero area fall back to
+    ``cv2.minEnclosingCircle`` one at a time.
     """
-    centers = []
-    for contour in contours:
-        M = cv2.moments(contour)
-        if M["m00"] != 0:
-            # centroid of contour:
-            center_x = M["m10"] / M["m00"]
-            center_y = M["m01"] / M["m00"]
-        else:
-            # circumcenter of contour:
-            (center_x, center_y), _ = cv2.minEnclosingCircle(contour)
-        centers.append((int(center_x), int(center_y)))
-    return centers
+    _, center_x, center_y = _contour_centroids(*_flatten_contours(contours))
+    return list(zip(
+        center_x.astype(int).tolist(),
+        center_y.astype(int).tolist()
+    ))
+
+
+def _contour_centroids(coordinates, offsets):
+    """Return the signed doubled area and the centroid of every contour."""
+    import cv2
+
+    x = coordinates[:, 0].astype(np.float64)
+    y = coordinates[:, 1].astype(np.float64)
+    following = _next_vertex_indices(offsets)
+    x_next, y_next = x[following], y[following]
+    cross = x * y_next - x_next * y
+    double_area = _segment_reduce(cross, offsets)
+    moment_x = _segment_reduce(cross * (x + x_next), offsets)
+    moment_y = _segment_reduce(cross * (y + y_next), offsets)
+
+    # cv2.moments treats contours this small as having no area at all
+    degenerate = np.abs(double_area) <= np.finfo(np.float32).eps
+    with np.errstate(divide='ignore', invalid='ignore'):
+        center_x = moment_x / (3 * double_area)
+        center_y = moment_y / (3 * double_area)
+    for i in np.flatnonzero(degenerate):
+        contour = coordinates[offsets[i]:offsets[i + 1]]
+        if contour.dtype != np.int32:
+            contour = contour.astype(np.float32)
+        # circumcenter of contour:
+        (center_x[i], center_y[i]), _ = cv2.minEnclosingCircle(contour)
+    return double_area, center_x, center_y
 
 
 def get_stroke_color(xml_tree):
@@ -133,8 +1074,9 @@ def get_stroke_color(xml_tree):
 
     Parameters
     ----------
-    xml_tree : xml.etree.ElementTree
-        The XML tree of the TCGA annotations file.
+    xml_tree : xml.etree.ElementTree or str
+        The XML tree of the TCGA annotations file, or the path to the file. If
+        a path is given, the file is only read up to the first annotation.
 
     Returns
     -------
@@ -143,50 +1085,799 @@ def get_stroke_color(xml_tree):
         The output is always 6 characters and does not include the hashtag.
     """
     # TODO: verify that the output actually is always 6 characters
-    decimal_color = xml_tree.find('./Annotation').attrib['LineColor']
+    if isinstance(xml_tree, str):
+        from xml.etree.ElementTree import iterparse
+
+        for _, elem in iterparse(xml_tree, events=('start',)):
+            if elem.tag == 'Annotation':
+                decimal_color = elem.attrib['LineColor']
+                break
+    else:
+        decimal_color = xml_tree.find('./Annotation').attrib['LineColor']
     line_color = hex(int(decimal_color)).replace('0x', '').zfill(6)
     return line_color
 
 
-def mask_to_contours(mask):
-    """Determine the line color for annotations from a TCGA annotations file.
+def parse_tcga_xml(source, initial_capacity=4096):
+    """Stream the regions of a TCGA XML annotations file into flat arrays.
+
+    Unlike `xml.etree.ElementTree.parse`, the document is never held in
+    memory: elements are discarded as soon as they have been read, and the
+    vertices are written directly into NumPy buffers that grow as needed.
 
     Parameters
     ----------
-    mask : numpy.ndarray
-        A NumPy N-dimensional array representing the image. If `mask` has 3
-        dimensions, the image is assumed to be RGB, and will be converted to
-        grayscale. If `mask` only has 2 dimensions, the image is assumed to be
-        grayscale. The values in the input should be in the range [0, 255].
+    source : str or file object
+        The path to the TCGA annotations file, or a file object containing it.
+    initial_capacity : int, optional
+        The number of vertices to allocate room for up front.
 
     Returns
     -------
-    contours : list of numpy.ndarray
-        A list of contours, where each contour is a list of coordinates, where
-        each coordinate is a list of a list of X and Y integers.
+    coordinates : numpy.ndarray
+        A float64 array with shape (N, 2) of all N vertices in the file, in
+        document order; each row is an (X, Y) coordinate pair.
+    offsets : numpy.ndarray
+        An int64 array with shape (M + 1,) for the M regions in the file. The
+        vertices of region ``i`` are ``coordinates[offsets[i]:offsets[i + 1]]``.
+
+    See Also
+    --------
+    region_to_contour : Convert a single parsed XML region to a contour.
     """
-    import dask.array as da
-    if isinstance(mask, da.Array):
-        mask = mask.compute()  # convert to numpy array
+    from xml.etree.ElementTree import iterparse
+
+    coordinates = np.empty((max(initial_capacity, 1), 2), dtype=np.float64)
+    offsets = [0]
+    n_vertices = 0
+    parents = []
+    for event, elem in iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            parents.append(elem)
+            continue
+        parents.pop()
+        if elem.tag == 'Vertex':
+            if n_vertices == len(coordinates):
+                coordinates = np.resize(coordinates, (2 * n_vertices, 2))
+            coordinates[n_vertices] = elem.get('X'), elem.get('Y')
+            n_vertices += 1
+        elif elem.tag == 'Vertices':
+            offsets.append(n_vertices)
+        # every element is fully processed by the time it ends, so drop it
+        # from the tree to keep memory proportional to the vertex count
+        elem.clear()
+        if parents:
+            parents[-1].remove(elem)
+    profiling.count('vertices_parsed', n_vertices)
+    profiling.count('regions_parsed', len(offsets) - 1)
+    return coordinates[:n_vertices].copy(), np.array(offsets, dtype=np.int64)
+
+
+# bump when the layout or the contents of the cached columns change
+_ANNOTATION_CACHE_VERSION = b'1'
+
+
+def annotation_cache_dir():
+    """Return the directory of the on-disk annotation cache.
+
+    This is ``$VIEWMASK_CACHE_DIR`` if it is set, and the ``viewmask``
+    directory of ``$XDG_CACHE_HOME``, or of ``~/.cache``, otherwise.
+    """
+    import os
+
+    return os.environ.get('VIEWMASK_CACHE_DIR') or os.path.join(
+        os.environ.get('XDG_CACHE_HOME')
+        or os.path.join(os.path.expanduser('~'), '.cache'),
+        'viewmask')
+
+
+def clear_annotation_cache(cache_dir=None):
+    """Remove every entry of the on-disk annotation cache.
+
+    Parameters
+    ----------
+    cache_dir : str, optional
+        The directory of the cache. Defaults to `annotation_cache_dir`.
+
+    Returns
+    -------
+    removed : int
+        The number of entries that were removed.
+
+    See Also
+    --------
+    cached_tcga_columns
+    """
+    import os
+    import shutil
+
+    if cache_dir is None:
+        cache_dir = annotation_cache_dir()
+    entries = os.path.join(cache_dir, 'annotations')
+    if not os.path.isdir(entries):
+        return 0
+    # entries that are being written start with a dot and are left alone
+    removed = 0
+    for name in os.listdir(entries):
+        if not name.startswith('.'):
+            shutil.rmtree(os.path.join(entries, name), ignore_errors=True)
+            removed += 1
+    return removed
+
+
+def cached_tcga_columns(path, fit_spline=False, cache_dir=None):
+    """Parse a TCGA XML file into flat columns, through an on-disk cache.
+
+    The columns are cached under the SHA-256 hash of the file's contents, so
+    a file that is renamed, copied or touched is still found in the cache,
+    and a file that is edited is parsed again. Cached columns are
+    memory-mapped instead of read, so opening them again is nearly instant,
+    and every process that opens the same annotations shares one copy of
+    them in the page cache.
+
+    Parameters
+    ----------
+    path : str
+        The path to the TCGA XML file.
+    fit_spline : bool, optional
+        Whether to cache and return the contours after fitting a spline
+        through each of them with `fit_splines`.
+    cache_dir : str, optional
+        The directory of the cache. Defaults to `annotation_cache_dir`.
+
+    Returns
+    -------
+    coordinates : (N, 2) numpy.ndarray
+        The int32 (X, Y) coordinates of all contours, as a read-only
+        memory map.
+    offsets : (M + 1,) numpy.ndarray
+        The int64 offsets of the contours in `coordinates`, as a read-only
+        memory map.
+
+    Notes
+    -----
+    Every entry is a directory with a ``coordinates.npy`` and an
+    ``offsets.npy`` file. It is written to a temporary directory and then
+    renamed, so concurrent processes never see a partial entry. If the cache
+    cannot be written, the columns are returned from memory. Entries are
+    never evicted; remove them with `clear_annotation_cache`.
+    """
+    import hashlib
+    import os
+    import shutil
+    import tempfile
+
+    if cache_dir is None:
+        cache_dir = annotation_cache_dir()
+    digest = hashlib.sha256(_ANNOTATION_CACHE_VERSION)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            digest.update(block)
+    name = digest.hexdigest() + ('-spline' if fit_spline else '')
+    entries = os.path.join(cache_dir, 'annotations')
+    entry = os.path.join(entries, name)
+
+    def load(entry):
+        return tuple(
+            np.load(os.path.join(entry, f'{column}.npy'), mmap_mode='r')
+            for column in ('coordinates', 'offsets')
+        )
+
+    if os.path.isdir(entry):
+        profiling.count('annotation_cache_hits')
+        return load(entry)
+
+    coordinates, offsets = parse_tcga_xml(path)
+    if fit_spline and len(offsets) > 1:
+        coordinates, offsets = _flatten_contours(
+            fit_splines(np.split(coordinates, offsets[1:-1])))
+    # np.int32 is necessary for cv2.drawContours
+    coordinates = coordinates.astype(np.int32)
+    temporary = None
+    try:
+        os.makedirs(entries, exist_ok=True)
+        temporary = tempfile.mkdtemp(prefix=f'.{name}-', dir=entries)
+        np.save(os.path.join(temporary, 'coordinates.npy'), coordinates)
+        np.save(os.path.join(temporary, 'offsets.npy'), offsets)
+        os.rename(temporary, entry)
+    except OSError as e:
+        if temporary is not None:
+            shutil.rmtree(temporary, ignore_errors=True)
+        # unless another process has written the same entry in the meantime
+        if not os.path.isdir(entry):
+            from warnings import warn
+            warn(f'cannot write to the annotation cache: {e}')
+            return coordinates, offsets
+    return load(entry)
+
+
+def _to_graymask(mask):
     if mask.ndim == 3:
         if mask.shape[2] == 3:
-            graymask = cv2.cvtColor(mask, cv2.COLOR_RGB2GRAY)
+            import cv2
+            return cv2.cvtColor(mask, cv2.COLOR_RGB2GRAY)
         else:
             raise ValueError("If mask has 3 dimensions, it must be RGB.")
     elif mask.ndim == 2:
-        graymask = np.uint8(mask)
+        return np.uint8(mask)
     else:
         raise ValueError("mask must be 2-D or 3-D.")
 
+
+def _find_contours(mask, x0=0, y0=0):
+    import cv2
+
     contours, _ = cv2.findContours(
-        graymask,
+        _to_graymask(np.asarray(mask)),
         cv2.RETR_LIST,
-        cv2.CHAIN_APPROX_NONE
+        cv2.CHAIN_APPROX_NONE,
+        offset=(int(x0), int(y0))
     )
     return contours
 
 
-def centers_to_image(centers, radius=4, write_color=[255, 0, 0], shape=None):
+def _contour_bbox(contour):
+    points = contour.reshape(-1, 2)
+    return tuple(int(v) for v in (*points.min(axis=0), *points.max(axis=0)))
+
+
+def _touches_edge(bbox, window, size):
+    # whether a contour reaches a side of the window that is not also a side
+    # of the whole image, in which case it may continue outside the window
+    (x_min, y_min, x_max, y_max), (x0, y0, x1, y1) = bbox, window
+    return (x_min <= x0 and x0 > 0) or (y_min <= y0 and y0 > 0) \
+        or (x_max >= x1 - 1 and x1 < size[0]) \
+        or (y_max >= y1 - 1 and y1 < size[1])
+
+
+class _TileGrid:
+    def __init__(self, chunks, halo):
+        self.y_edges = np.cumsum((0,) + tuple(chunks[0]))
+        self.x_edges = np.cumsum((0,) + tuple(chunks[1]))
+        self.size = (int(self.x_edges[-1]), int(self.y_edges[-1]))
+        self.halo = halo
+
+    def tiles(self):
+        for i in range(len(self.y_edges) - 1):
+            for j in range(len(self.x_edges) - 1):
+                yield i, j
+
+    def window(self, i, j):
+        return (
+            max(int(self.x_edges[j]) - self.halo, 0),
+            max(int(self.y_edges[i]) - self.halo, 0),
+            min(int(self.x_edges[j + 1]) + self.halo, self.size[0]),
+            min(int(self.y_edges[i + 1]) + self.halo, self.size[1]),
+        )
+
+    def owner(self, bbox):
+        # the tile whose core holds the top-left corner of the bounding box
+        i = np.searchsorted(self.y_edges, bbox[1], side='right') - 1
+        j = np.searchsorted(self.x_edges, bbox[0], side='right') - 1
+        return int(i), int(j)
+
+    def owned_by(self, bboxes, tile):
+        # whether `tile` is the owner of each of the bounding boxes
+        i = np.searchsorted(self.y_edges, bboxes[:, 1], side='right') - 1
+        j = np.searchsorted(self.x_edges, bboxes[:, 0], side='right') - 1
+        return (i == tile[0]) & (j == tile[1])
+
+    def linear(self, x, y):
+        return np.asarray(y, dtype=np.int64) * self.size[0] + x
+
+    def found_by_owner(self, bbox):
+        window = self.window(*self.owner(bbox))
+        return not _touches_edge(bbox, window, self.size)
+
+
+def _tile_contours(mask, grid, tile):
+    """Find the contours in one tile, and the ones that need stitching.
+
+    Contours that are cut by the tile's window are returned as ``(bbox,
+    window, points)``, where `points` are the linear indices of the
+    contour's points that are not on the edge of the window (or of all of
+    its points, if they all are), so that the contours which another tile
+    finds whole can be recognized.
+    """
+    window = grid.window(*tile)
+    x0, y0, x1, y1 = window
+    complete, cut = [], []
+    contours = _find_contours(mask, x0, y0)
+    bboxes, _ = _contour_extents(*_flatten_contours(contours))
+    owned = grid.owned_by(bboxes, tile)
+    for contour, bbox, is_owner in zip(contours, bboxes.tolist(), owned):
+        bbox = tuple(bbox)
+        if _touches_edge(bbox, window, grid.size):
+            x, y = contour.reshape(-1, 2).T
+            inner = (x > x0) & (x < x1 - 1) & (y > y0) & (y < y1 - 1)
+            if not inner.any():  # a sliver along the edge of the window
+                inner[:] = True
+            cut.append((bbox, window, grid.linear(x[inner], y[inner])))
+        elif is_owner:
+            complete.append(contour)
+        elif not grid.found_by_owner(bbox):
+            # this tile sees the whole contour, but its owner does not
+            cut.append((bbox, window, None))
+    return complete, cut
+
+
+def _found_whole(cut, contours, grid):
+    """Return whether every cut contour is one of the whole `contours`.
+
+    A cut contour is the same as a whole contour if the whole contour
+    reaches past every edge of the window that cuts it, and runs through
+    all of the cut contour's points inside the window.
+    """
+    bboxes, _ = _contour_extents(*_flatten_contours(contours))
+    index = BoundingBoxIndex(bboxes)
+    points = {}
+    found = np.zeros(len(cut), dtype=bool)
+    for k, (bbox, window, inner) in enumerate(cut):
+        if inner is None:
+            continue
+        (x_min, y_min, x_max, y_max), (x0, y0, x1, y1) = bbox, window
+        for i in index.query(bbox):
+            whole = bboxes[i]
+            if (x_min <= x0 and x0 > 0 and whole[0] >= x0) \
+                    or (y_min <= y0 and y0 > 0 and whole[1] >= y0) \
+                    or (x_max >= x1 - 1 and x1 < grid.size[0]
+                        and whole[2] <= x1 - 1) \
+                    or (y_max >= y1 - 1 and y1 < grid.size[1]
+                        and whole[3] <= y1 - 1):
+                continue
+            if i not in points:
+                x, y = contours[i].reshape(-1, 2).T
+                points[i] = np.unique(grid.linear(x, y))
+            if np.isin(inner, points[i]).all():
+                found[k] = True
+                break
+    return found
+
+
+def _merge_boxes(boxes):
+    """Group boxes that overlap or touch, and return each group's extent."""
+    def find(parents, i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+    groups = [[i] for i in range(len(boxes))]
+    while True:
+        parents = np.arange(len(boxes))
+        index = BoundingBoxIndex(boxes)
+        for i, (x_min, y_min, x_max, y_max) in enumerate(boxes):
+            touching = index.query((x_min - 1, y_min - 1, x_max + 1, y_max + 1))
+            for j in touching:
+                parents[find(parents, j)] = find(parents, i)
+        roots = np.array([find(parents, i) for i in range(len(boxes))])
+        if len(boxes) == 0 or len(np.unique(roots)) == len(boxes):
+            return boxes, groups
+        merged_boxes, merged_groups = [], []
+        for root in np.unique(roots):
+            members = np.flatnonzero(roots == root)
+            merged_boxes.append(np.concatenate((
+                boxes[members, :2].min(axis=0),
+                boxes[members, 2:].max(axis=0),
+            )))
+            merged_groups.append(sum((groups[i] for i in members), []))
+        boxes, groups = np.array(merged_boxes), merged_groups
+
+
+def _mask_to_contours_tiled(mask, halo):
+    import dask
+    import dask.array as da
+
+    mask = da.asarray(mask)
+    if mask.ndim not in (2, 3):
+        raise ValueError("mask must be 2-D or 3-D.")
+    if mask.ndim == 3:
+        if mask.shape[2] != 3:
+            raise ValueError("If mask has 3 dimensions, it must be RGB.")
+        mask = mask.rechunk({2: 3})
+    grid = _TileGrid(mask.chunks, halo)
+
+    # first pass: every tile, plus a halo, in parallel
+    tasks = []
+    for tile in grid.tiles():
+        x0, y0, x1, y1 = grid.window(*tile)
+        tasks.append(
+            dask.delayed(_tile_contours)(mask[y0:y1, x0:x1], grid, tile))
+    contours, cut = [], []
+    for complete, tile_cut in dask.compute(*tasks):
+        contours.extend(complete)
+        cut.extend(tile_cut)
+    # most cut contours are found whole by the tile that owns them
+    seeds = [
+        bbox for (bbox, _, _), found in zip(
+            cut, _found_whole(cut, contours, grid)) if not found]
+
+    # second pass: contours that were cut by a window are found again in a
+    # region that is grown until they fit, then stitched into one polygon;
+    # the regions of every round are searched in parallel
+    found = set()
+    seeds = np.asarray(seeds, dtype=np.int64).reshape(-1, 4)
+    regions, groups = _merge_boxes(seeds)
+    pending = [(tuple(region), seeds[group]) for region, group in zip(
+        regions.tolist(), groups)]
+    while pending:
+        windows = [
+            (
+                max(x_min - 1, 0),
+                max(y_min - 1, 0),
+                min(x_max + 2, grid.size[0]),
+                min(y_max + 2, grid.size[1]),
+            )
+            for (x_min, y_min, x_max, y_max), _ in pending
+        ]
+        results = dask.compute(*[
+            dask.delayed(_find_contours)(mask[y0:y1, x0:x1], x0, y0)
+            for x0, y0, x1, y1 in windows
+        ])
+        grown = []
+        for (region, group_seeds), window, region_contours in zip(
+                pending, windows, results):
+            x_min, y_min, x_max, y_max = region
+            grow = None
+            for contour in region_contours:
+                bbox = _contour_bbox(contour)
+                if not ((group_seeds[:, 0] <= bbox[2])
+                        & (group_seeds[:, 2] >= bbox[0])
+                        & (group_seeds[:, 1] <= bbox[3])
+                        & (group_seeds[:, 3] >= bbox[1])).any():
+                    continue  # not one of the contours that need stitching
+                if _touches_edge(bbox, window, grid.size):
+                    grow = bbox if grow is None else (
+                        min(grow[0], bbox[0]), min(grow[1], bbox[1]),
+                        max(grow[2], bbox[2]), max(grow[3], bbox[3]))
+                    continue
+                key = bbox + (len(contour),) + tuple(contour[0, 0].tolist())
+                if key not in found and not grid.found_by_owner(bbox):
+                    found.add(key)
+                    contours.append(contour)
+            if grow is not None:
+                grown.append(((
+                    min(x_min, grow[0] - halo), min(y_min, grow[1] - halo),
+                    max(x_max, grow[2] + halo), max(y_max, grow[3] + halo),
+                ), group_seeds))
+        pending = grown
+    return contours
+
+
+def mask_to_contours(mask, tiled=False, halo=32):
+    """Find the contours of the objects in a mask.
+
+    Parameters
+    ----------
+    mask : numpy.ndarray or dask.array.Array
+        A NumPy N-dimensional array representing the image. If `mask` has 3
+        dimensions, the image is assumed to be RGB, and will be converted to
+        grayscale. If `mask` only has 2 dimensions, the image is assumed to be
+        grayscale. The values in the input should be in the range [0, 255].
+    tiled : bool, optional
+        Whether to find contours chunk by chunk instead of in the whole mask
+        at once. Each chunk of `mask` (which is converted to a dask array if
+        needed) is processed in parallel, together with a surrounding halo;
+        contours that cross the edge of a chunk's halo are then found again in
+        a region that is grown until they fit, so that they are returned as
+        single polygons. Memory use is bounded by the chunk size, unless
+        there are objects that are much larger than a chunk. Defaults to
+        `False`.
+    halo : int, optional
+        The number of pixels that are added around every chunk when `tiled`
+        is `True`. Objects that fit within a chunk and its halo never need to
+        be stitched.
+
+    Returns
+    -------
+    contours : list of numpy.ndarray
+        A list of contours, where each contour is a list of coordinates, where
+        each coordinate is a list of a list of X and Y integers. When `tiled`
+        is `True`, the same contours are found, but in a different order.
+    """
+    if tiled:
+        contours = _mask_to_contours_tiled(mask, halo)
+    else:
+        import dask.array as da
+        if isinstance(mask, da.Array):
+            mask = mask.compute()  # convert to numpy array
+        contours = list(_find_contours(mask))
+    profiling.count('contours_found', len(contours))
+    return contours
+
+
+def _encode_runs(mask):
+    """Return the (rows, starts, ends) of the runs of nonzero mask pixels.
+
+    A 3-D mask is nonzero wherever any of its channels is. The runs are
+    sorted, and `ends` are exclusive.
+    """
+    nonzero = np.asarray(mask) != 0
+    if nonzero.ndim == 3:
+        nonzero = nonzero.any(axis=2)
+    edges = np.diff(nonzero.view(np.int8), axis=1, prepend=0, append=0)
+    rows, starts = np.nonzero(edges == 1)
+    ends = np.nonzero(edges == -1)[1]
+    return rows, starts, ends
+
+
+def _merge_runs(rows, starts, ends, width):
+    """Sort runs, and merge the runs that overlap or touch.
+
+    Every row is laid out on one line, followed by a gap, so that runs of
+    different rows can never touch; merging is then a single sweep over the
+    line.
+    """
+    nonempty = ends > starts
+    stride = width + 1
+    line_starts = (rows * stride + starts)[nonempty]
+    line_ends = (rows * stride + ends)[nonempty]
+    if not len(line_starts):
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+    order = np.argsort(line_starts, kind='stable')
+    line_starts = line_starts[order]
+    reach = np.maximum.accumulate(line_ends[order])
+    first = np.ones(len(line_starts), dtype=bool)
+    first[1:] = line_starts[1:] > reach[:-1]
+    last = np.append(first[1:], True)
+    rows = line_starts[first] // stride
+    return rows, line_starts[first] - rows * stride, \
+        reach[last] - rows * stride
+
+
+def _intersect_runs(a, b, width):
+    """Return the (rows, starts, ends) of the overlap of two sets of runs.
+
+    Both sets must be merged. The starts and ends of all runs are swept in
+    order, counting how many runs cover the line; the overlap is where both
+    do.
+    """
+    stride = width + 1
+    points = [
+        rows * stride + runs
+        for rows, starts, ends in (a, b) for runs in (starts, ends)
+    ]
+    coords = np.concatenate(points)
+    deltas = np.repeat(
+        np.array([1, -1, 1, -1], dtype=np.int8),
+        [len(point) for point in points])
+    # ends sort before starts, so runs that only touch do not overlap
+    order = np.lexsort((deltas, coords))
+    coords = coords[order]
+    inside = np.flatnonzero(np.cumsum(deltas[order]) == 2)
+    rows = coords[inside] // stride
+    return rows, coords[inside] - rows * stride, \
+        coords[inside + 1] - rows * stride
+
+
+def _row_offsets(rows, height):
+    """Return the offsets of the runs of every row, like CSR indptr."""
+    return np.concatenate(([0], np.cumsum(
+        np.bincount(rows, minlength=height), dtype=np.int64)))
+
+
+def _clip_runs(starts, ends, offsets, window):
+    """Return the rows and clipped starts and ends of the runs in a window."""
+    x0, y0, x1, y1 = window
+    rows = np.repeat(
+        np.arange(y1 - y0), np.diff(offsets[y0:y1 + 1]))
+    lo, hi = offsets[y0], offsets[y1]
+    starts = np.clip(starts[lo:hi], x0, x1) - x0
+    ends = np.clip(ends[lo:hi], x0, x1) - x0
+    return rows, starts, ends
+
+
+def _decode_runs(starts, ends, offsets, window):
+    """Draw the runs that intersect a window into a boolean array."""
+    x0, y0, x1, y1 = window
+    rows, starts, ends = _clip_runs(starts, ends, offsets, window)
+    nonempty = ends > starts
+    rows, starts, ends = rows[nonempty], starts[nonempty], ends[nonempty]
+    # runs never touch, so every edge is marked once; filling in between
+    # the edges of every row is then a cumulative sum
+    edges = np.zeros((y1 - y0, x1 - x0 + 1), dtype=np.int8)
+    edges[rows, starts] = 1
+    edges[rows, ends] = -1
+    return np.cumsum(edges, axis=1, dtype=np.int8)[:, :-1].view(bool)
+
+
+def _decode_runs_block(starts, ends, offsets, block_info=None):
+    (y0, y1), (x0, x1) = block_info[None]['array-location']
+    return _decode_runs(starts, ends, offsets, (x0, y0, x1, y1))
+
+
+def _rasterize_runs(
+    coordinates, offsets, shape, band_height=2048, max_padding=1024,
+):
+    """Draw and fill contours like `rasterize_contours`, as runs.
+
+    Every contour is drawn on its own canvas, which covers its bounding box
+    and is encoded straight away, so no canvas of the whole image is made.
+    Contours that are taller than `band_height` are drawn a band of rows at
+    a time. Like in `rasterize_contours`, a canvas that is cut off by the
+    edge of a band or of the image is padded by the contour's longest
+    segment, so that its lines are drawn as if they were not clipped.
+    """
+    import cv2
+
+    height, width = shape
+    coordinates = coordinates.astype(np.int32, copy=False)
+    bboxes, longest_segments = _contour_extents(coordinates, offsets)
+    parts = []
+    for i in range(len(offsets) - 1):
+        x_min, y_min, x_max, y_max = (int(v) for v in bboxes[i])
+        if offsets[i] == offsets[i + 1] or x_max < 0 or y_max < 0 \
+                or x_min >= width or y_min >= height:
+            continue
+        contour = coordinates[offsets[i]:offsets[i + 1]]
+        padding = min(int(longest_segments[i]) + 1, max_padding)
+        for y0 in range(max(y_min, 0), min(y_max, height - 1) + 1,
+                        band_height):
+            y1 = min(y0 + band_height, y_max + 1, height)
+            # the padding never needs to reach past the contour itself
+            canvas_y0 = max(y0 - padding, y_min)
+            canvas_y1 = min(y1 + padding, y_max + 1)
+            canvas = np.zeros(
+                (canvas_y1 - canvas_y0, x_max - x_min + 1), dtype=np.uint8)
+            shift = (-x_min, -canvas_y0)
+            cv2.drawContours(canvas, [contour], -1, 1, offset=shift)
+            cv2.fillPoly(canvas, [contour], 1, offset=shift)
+            rows, starts, ends = _encode_runs(
+                canvas[y0 - canvas_y0:y1 - canvas_y0])
+            parts.append((rows + y0, starts + x_min, ends + x_min))
+    profiling.count('contours_drawn', len(offsets) - 1)
+    if not parts:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty
+    rows, starts, ends = (np.concatenate(part) for part in zip(*parts))
+    return _merge_runs(
+        rows, np.clip(starts, 0, width), np.clip(ends, 0, width), width)
+
+
+@lru_cache(maxsize=32)
+def _disk_offsets(radius):
+    """Return the (dy, dx) offsets of the pixels of a filled cv2 circle."""
+    import cv2
+
+    size = 2 * radius + 3
+    kernel = np.zeros((size, size), dtype=np.uint8)
+    cv2.circle(kernel, (radius + 1, radius + 1), radius, 1, -1)
+    dy, dx = np.nonzero(kernel)
+    return dy - (radius + 1), dx - (radius + 1)
+
+
+def _stamp_markers(canvas, centers, x0, y0, radius, color):
+    """Draw filled circles around `centers` onto a window of an image.
+
+    Every circle is a copy of the same precomputed disk, so all of them are
+    drawn at once with a single fancy-indexing assignment.
+    """
+    if len(centers) == 0:
+        return
+    dy, dx = _disk_offsets(radius)
+    ys = (centers[:, 1, None] - y0 + dy).ravel()
+    xs = (centers[:, 0, None] - x0 + dx).ravel()
+    inside = (ys >= 0) & (ys < canvas.shape[0]) \
+        & (xs >= 0) & (xs < canvas.shape[1])
+    canvas[ys[inside], xs[inside]] = color
+    profiling.count('markers_drawn', len(centers))
+
+
+def _bucket_centers(centers, chunks, radius):
+    """Group the centers by the chunks that their markers overlap.
+
+    Returns the centers sorted by chunk, with duplicates for markers that
+    overlap several chunks, and the offsets of every chunk's centers, with
+    chunks numbered in C order.
+    """
+    row_edges = np.cumsum((0,) + tuple(chunks[0]))
+    col_edges = np.cumsum((0,) + tuple(chunks[1]))
+    n_rows, n_cols = len(chunks[0]), len(chunks[1])
+
+    def chunk_range(values, edges, n):
+        first = np.searchsorted(edges, values - radius, side='right') - 1
+        last = np.searchsorted(edges, values + radius, side='right') - 1
+        return np.clip(first, 0, n - 1), np.clip(last, 0, n - 1)
+
+    # markers that are entirely outside of the image are dropped
+    x, y = centers[:, 0], centers[:, 1]
+    visible = (x + radius >= 0) & (x - radius < col_edges[-1]) \
+        & (y + radius >= 0) & (y - radius < row_edges[-1])
+    centers = centers[visible]
+    row_first, row_last = chunk_range(centers[:, 1], row_edges, n_rows)
+    col_first, col_last = chunk_range(centers[:, 0], col_edges, n_cols)
+    n_row_chunks = row_last - row_first + 1
+    n_col_chunks = col_last - col_first + 1
+    # enumerate every (center, chunk) pair; almost every marker lies within
+    # a single chunk, so this is barely larger than `centers`
+    copies = n_row_chunks * n_col_chunks
+    owner = np.repeat(np.arange(len(centers)), copies)
+    rank = np.arange(len(owner)) - np.repeat(np.cumsum(copies) - copies, copies)
+    rows = row_first[owner] + rank // n_col_chunks[owner]
+    cols = col_first[owner] + rank % n_col_chunks[owner]
+    chunk_ids = rows * n_cols + cols
+    order = np.argsort(chunk_ids, kind='stable')
+    offsets = np.concatenate(([0], np.cumsum(
+        np.bincount(chunk_ids, minlength=n_rows * n_cols))))
+    return centers[owner[order]], offsets
+
+
+def _chunk_markers(buckets, block_info):
+    """Return the centers of the markers that overlap the block's chunk."""
+    centers, offsets, n_cols = buckets
+    row, col = block_info[None]['chunk-location'][:2]
+    chunk_id = row * n_cols + col
+    return centers[offsets[chunk_id]:offsets[chunk_id + 1]]
+
+
+def _markers_block(block_info=None, buckets=None, radius=4, color=None):
+    (y0, y1), (x0, x1), _ = block_info[None]['array-location']
+    canvas = np.zeros((y1 - y0, x1 - x0, 3), dtype=np.uint8)
+    _stamp_markers(
+        canvas, _chunk_markers(buckets, block_info), x0, y0, radius, color)
+    return canvas
+
+
+def render_markers(
+    centers, shape, chunks=None, radius=4, color=(255, 0, 0)
+):
+    """Draw a filled circle around every center, optionally lazily.
+
+    The pixels of one circle, as drawn by ``cv2.circle``, are computed once,
+    and every circle is stamped at once with NumPy indexing. When `chunks`
+    is given, the centers are first grouped by the chunks that their
+    circles overlap, and every chunk only draws its own circles when it is
+    computed.
+
+    Parameters
+    ----------
+    centers : array_like of int
+        The (X, Y) coordinates of the centers of the circles.
+    shape : tuple of int
+        The (height, width) of the output image.
+    chunks : tuple, optional
+        The chunks of the output along the Y and X axes, in any form accepted
+        by `dask.array.core.normalize_chunks`, such as ``slide.chunks[:2]``.
+        If `None` (the default), the image is drawn eagerly into a NumPy
+        array.
+    radius : int, optional
+        The radius of the circles.
+    color : array_like of int, optional
+        The RGB color of the circles.
+
+    Returns
+    -------
+    rendered_markers : numpy.ndarray or dask.array.Array
+        An array with shape ``(height, width, 3)`` and dtype `numpy.uint8`.
+    """
+    centers = np.asarray(centers, dtype=np.int64).reshape(-1, 2)
+    color = np.asarray(color, dtype=np.uint8)
+    height, width = shape[:2]
+    if chunks is None:
+        canvas = np.zeros((height, width, 3), dtype=np.uint8)
+        _stamp_markers(canvas, centers, 0, 0, radius, color)
+        return canvas
+
+    import dask.array as da
+
+    chunks = da.core.normalize_chunks(chunks, (height, width))
+    buckets = _bucket_centers(centers, chunks, radius) + (len(chunks[1]),)
+    return da.map_blocks(
+        _markers_block,
+        chunks=chunks + ((3,),),
+        dtype=np.uint8,
+        meta=np.empty((0, 0, 0), dtype=np.uint8),
+        buckets=buckets,
+        radius=radius,
+        color=color,
+    )
+
+
+def centers_to_image(
+    centers, radius=4, write_color=[255, 0, 0], shape=None, chunks=None
+):
     """Draw coordinates of centers to a static image.
 
     Parameters
@@ -206,10 +1897,13 @@ def centers_to_image(centers, radius=4, write_color=[255, 0, 0], shape=None):
         The shape of the output image. Defaults to (x_max, y_max, 3), where
         x_max are the maximum x-coordinate and y-coordinate, respectively, of
         the centers.
+    chunks : tuple, optional
+        If given, the image is drawn lazily, chunk by chunk, as a dask array
+        with these chunks along the Y and X axes; see `render_markers`.
 
     Returns
     -------
-    rendered_annotations : numpy.ndarray
+    rendered_annotations : numpy.ndarray or dask.array.Array
         An N-dimensional NumPy array representing the RGB output image with the
         shape defined as `shape`.
     """
@@ -217,10 +1911,151 @@ def centers_to_image(centers, radius=4, write_color=[255, 0, 0], shape=None):
         x_max = np.amax([x for x, _ in centers])
         y_max = np.amax([y for _, y in centers])
         shape = (y_max, x_max, 3)
-    rendered_annotations = np.zeros(shape, dtype=np.uint8)
-    for center in centers:
-        cv2.circle(rendered_annotations, center, radius, write_color, -1)
-    return rendered_annotations
+    return render_markers(
+        centers, shape, chunks=chunks, radius=radius, color=write_color)
+
+
+def _select_color_block(rgb, color):
+    import cv2
+
+    return cv2.inRange(np.ascontiguousarray(rgb), color, color)
+
+
+def _overlay_block(
+    image,
+    mask=None,
+    block_info=None,
+    contours=None,
+    buckets=None,
+    radius=4,
+    marker_color=None,
+):
+    import cv2
+
+    (y0, y1), (x0, x1) = block_info[0]['array-location'][:2]
+    # copy, since slide tiles are shared with the tile cache
+    canvas = np.array(image, dtype=np.uint8)
+    if contours is not None:
+        layer = _rasterize_window(window=(x0, y0, x1, y1), **contours)
+    else:
+        layer = np.asarray(mask, dtype=np.uint8)
+        if layer.shape[2] == 1:
+            layer = cv2.cvtColor(layer, cv2.COLOR_GRAY2RGB)
+    # saturate instead of wrapping around, so bright pixels stay bright
+    cv2.add(canvas, np.ascontiguousarray(layer), dst=canvas)
+    _stamp_markers(
+        canvas, _chunk_markers(buckets, block_info), x0, y0, radius,
+        marker_color)
+    return canvas
+
+
+def render_overlay(
+    image,
+    annotations,
+    centers=None,
+    radius=4,
+    marker_color=(255, 0, 0),
+    outline_color=(0, 255, 0),
+    fill_color=(230, 230, 230),
+    max_padding=1024,
+):
+    """Overlay annotations and the centers of nuclei on an image, lazily.
+
+    The image, the annotations and the center markers are composed by a
+    single blockwise dask graph, so every chunk of the image is read once,
+    and the chunks are rendered in parallel and fused with the tasks that
+    read them.
+
+    Parameters
+    ----------
+    image : (M, N, 3) array_like or dask.array.Array
+        The RGB image to draw on, such as a level of a slide from
+        `file_to_dask_array`. The output has the chunks of `image`.
+    annotations : list of numpy.ndarray, viewmask.PackedAnnotations or array_like
+        Either contours with (X, Y) coordinates in the pixel space of
+        `image`, such as `viewmask.Annotations`, whose outlines are drawn in
+        `outline_color` and which are filled with `fill_color`, or an
+        (M, N[, 3]) annotation mask, which is added to `image`.
+    centers : array_like of int, optional
+        The (X, Y) coordinates of the markers to draw. By default, the
+        centers of the contours are used. For an annotation mask, the
+        centers of its pure blue (nuclei) objects are used, or the centers of
+        all of its objects if it has no pure blue pixels.
+    radius : int, optional
+        The radius of the markers.
+    marker_color : array_like of int, optional
+        The RGB color of the markers.
+    outline_color, fill_color : array_like of int, optional
+        The RGB colors of the contour outlines and fills.
+    max_padding : int, optional
+        See `rasterize_contours`.
+
+    Returns
+    -------
+    overlay : dask.array.Array
+        An array with the shape and chunks of `image` and dtype
+        `numpy.uint8`. Annotations are added with saturation, so that
+        pixels cannot wrap around to dark colors.
+
+    See Also
+    --------
+    rasterize_contours : Draw contours without an image.
+    centers_of_contours : The centers that are drawn by default.
+    """
+    import dask.array as da
+
+    if not isinstance(image, da.Array):
+        image = da.from_array(np.asarray(image))
+    height, width = image.shape[:2]
+    kwargs = dict(
+        radius=radius,
+        marker_color=np.asarray(marker_color, dtype=np.uint8),
+    )
+    args = [image]
+
+    if isinstance(annotations, (np.ndarray, da.Array)):
+        mask = annotations
+        if not isinstance(mask, da.Array):
+            mask = da.from_array(mask)
+        if mask.shape[:2] != (height, width):
+            raise ValueError(
+                "the annotation mask must have the height and width of the "
+                "image")
+        if centers is None:
+            contours = []
+            if mask.ndim == 3:
+                blue = np.array([0, 0, 255], dtype=mask.dtype)
+                nuclei = mask.map_blocks(
+                    _select_color_block, color=blue, drop_axis=2,
+                    dtype=np.uint8)
+                contours = mask_to_contours(nuclei, tiled=True)
+            if not contours:  # no blue nuclei, so use every object
+                contours = mask_to_contours(mask, tiled=True)
+            centers = centers_of_contours(contours) if contours else []
+        if mask.ndim == 2:
+            # a trailing axis lines the mask up with the image's chunks
+            mask = mask[:, :, None]
+        args.append(mask.rechunk(image.chunks[:2] + (mask.shape[2],)))
+    else:
+        kwargs['contours'] = _rasterize_kwargs(
+            annotations, outline_color, fill_color, max_padding)
+        if centers is None:
+            centers = centers_of_contours(annotations) \
+                if len(kwargs['contours']['offsets']) > 1 else []
+    # every chunk only stamps the markers that overlap it
+    kwargs['buckets'] = _bucket_centers(
+        np.asarray(centers, dtype=np.int64).reshape(-1, 2),
+        image.chunks[:2],
+        radius,
+    ) + (len(image.chunks[1]),)
+
+    return da.map_blocks(
+        _overlay_block,
+        *args,
+        dtype=np.uint8,
+        meta=np.empty((0,) * image.ndim, dtype=np.uint8),
+        **kwargs,
+    )
 
 
 def split_dask_array_by_colors(arr):
@@ -242,19 +2077,51 @@ def split_dask_array_by_colors(arr):
     return red_img, green_img, blue_img
 
 
-def get_hematoxylin(rgb):
+def _hematoxylin_block(rgb, output_dtype=None):
+    from skimage.color import rgb2hed, hed_from_rgb
+
+    arr_hema = rgb2hed(rgb)[..., 0]
+    if output_dtype is None:
+        return arr_hema
+    if np.dtype(output_dtype) == np.uint8:
+        # for 8-bit pixels without a zero channel, the optical densities are
+        # at most log(1 / 255) / log(1e-6), so the positive coefficients bound
+        # the stain intensity and give every chunk the same scale
+        h_max = np.clip(hed_from_rgb[:, 0], 0, None).sum() \
+            * np.log(255) / -np.log(1e-6)
+        return np.round(
+            np.clip(arr_hema, 0, h_max) * (255 / h_max)).astype(np.uint8)
+    return arr_hema.astype(output_dtype)
+
+
+def get_hematoxylin(rgb, dtype=None, out=None):
     """Extract the hematoxylin layer from an RGB image.
 
     Parameters
     ----------
-    rgb : (..., 3) array_like
-        The RGB input image to process.
+    rgb : (..., 3) array_like or dask.array.Array
+        The RGB input image to process. If `rgb` is a dask array, such as a
+        slide from `file_to_dask_array`, the color deconvolution runs lazily,
+        chunk by chunk, so a whole slide can be processed on all cores with
+        bounded memory.
+    dtype : {None, numpy.float32, numpy.uint8}, optional
+        The data type of the output. By default, the float64 output of
+        `skimage.color.rgb2hed` is returned. If `numpy.uint8`, the intensity
+        is quantized to [0, 255], where 255 is the largest hematoxylin
+        intensity of an 8-bit RGB pixel with no zero channel, so that every
+        chunk uses the same scale; darker pixels are clipped to 255.
+    out : array_like, optional
+        An array-like object that supports NumPy-style slice assignment, such
+        as a `numpy.memmap`, a Zarr array or an HDF5 dataset, with shape
+        ``rgb.shape[:-1]``. If `rgb` is a dask array, every chunk is written
+        to `out` as soon as it has been computed, and `out` is returned.
 
     Returns
     -------
-    arr_hema : ndarray
+    arr_hema : ndarray or dask.array.Array
         A 2-dimensional array representing the hematoxylin
-        intensity.
+        intensity. If `rgb` is a dask array, so is `arr_hema`, unless `out`
+        is given.
 
     Raises
     ------
@@ -274,9 +2141,12 @@ def get_hematoxylin(rgb):
     >>> from viewmask.utils import get_hematoxylin
     >>> rgb = data.immunohistochemistry()
     >>> he_layer = get_hematoxylin(rgb)
-    """
-    from skimage.color import rgb2hed
 
+    >>> slide = file_to_dask_array(path)
+    >>> he_layer = np.lib.format.open_memmap(
+    ...     'he.npy', mode='w+', dtype=np.uint8, shape=slide.shape[:2])
+    >>> get_hematoxylin(slide, dtype=np.uint8, out=he_layer)
+    """
     # matplotlib navy is (22, 0, 134), vispy navy is (0, 0, 128)
     # cmap_hema = Colormap(['white', 'navy'])
 
@@ -286,35 +2156,504 @@ def get_hematoxylin(rgb):
     # matplotlib darkviolet is (166, 0, 218), vispy darkviolet is (148, 0, 211)
     # cmap_eosin = Colormap(['darkviolet', 'white'])
 
-    ihc_hed = rgb2hed(rgb)
-    arr_hema = ihc_hed[:, :, 0]
+    import dask.array as da
+
+    if not isinstance(rgb, da.Array):
+        arr_hema = _hematoxylin_block(rgb, dtype)
+        if out is not None:
+            out[...] = arr_hema
+            return out
+        return arr_hema
+
+    if rgb.ndim < 2 or rgb.shape[-1] != 3:
+        raise ValueError("the input array must have shape (..., 3)")
+    output_dtype = np.dtype(dtype or np.float64)
+    arr_hema = rgb.rechunk({rgb.ndim - 1: 3}).map_blocks(
+        _hematoxylin_block,
+        output_dtype=dtype,
+        dtype=output_dtype,
+        drop_axis=rgb.ndim - 1,
+        meta=np.empty((0,) * (rgb.ndim - 1), dtype=output_dtype),
+    )
+    if out is not None:
+        da.store(arr_hema, out)
+        return out
     return arr_hema
 
 
-def fit_spline_to_points(points):
-    """Fit a B-spline through a sequence of points.
+def _measure_window(
+    rgb, window, coordinates, offsets, index, bboxes, longest_segments,
+    max_padding,
+):
+    """Sum the hematoxylin intensity of the contours within a window.
+
+    Returns the indices of the contours that intersect the window, and the
+    number of their pixels in the window, the sum of the intensities of
+    those pixels and the sum of their squares.
+    """
+    import cv2
+
+    x0, y0, x1, y1 = window
+    hits = index.query((x0, y0, x1 - 1, y1 - 1))
+    counts = np.zeros(len(hits), dtype=np.int64)
+    sums = np.zeros(len(hits))
+    squares = np.zeros(len(hits))
+    if not len(hits):
+        return hits, counts, sums, squares
+    hema = _hematoxylin_block(np.asarray(rgb))
+    for k, i in enumerate(hits):
+        # like rasterize_contours, fill a canvas that is padded by the
+        # longest segment, so that clipping cannot move the contour's edges
+        padding = min(int(longest_segments[i]) + 1, max_padding)
+        cx0 = max(bboxes[i, 0], x0 - padding)
+        cy0 = max(bboxes[i, 1], y0 - padding)
+        cx1 = min(bboxes[i, 2] + 1, x1 + padding)
+        cy1 = min(bboxes[i, 3] + 1, y1 + padding)
+        canvas = np.zeros((cy1 - cy0, cx1 - cx0), dtype=np.uint8)
+        cv2.fillPoly(
+            canvas, [coordinates[offsets[i]:offsets[i + 1]]], 1,
+            offset=(-int(cx0), -int(cy0)))
+        inside = canvas[
+            max(y0 - cy0, 0):y1 - cy0, max(x0 - cx0, 0):x1 - cx0
+        ].view(bool)
+        values = hema[
+            max(cy0 - y0, 0):min(cy1, y1) - y0,
+            max(cx0 - x0, 0):min(cx1, x1) - x0,
+        ][inside]
+        counts[k] = values.size
+        sums[k] = values.sum()
+        squares[k] = np.dot(values, values)
+    return hits, counts, sums, squares
+
+
+def measure_contours(contours, image=None, max_padding=1024):
+    """Measure the shape, and optionally the staining, of every contour.
+
+    The geometry of all contours is computed at once from their
+    coordinates. If an image is given, the hematoxylin intensity of the
+    pixels inside every contour is summarized in a single pass over the
+    chunks of the image: every chunk is deconvolved once, and only the
+    contours that intersect it are filled, so the memory use is bounded by
+    the chunk size, no matter how large the image is.
+
+    Parameters
+    ----------
+    contours : list of numpy.ndarray or viewmask.PackedAnnotations
+        The contours to measure, where each contour is an array of (X, Y)
+        coordinate pairs, in the pixel space of `image`.
+    image : (M, N, 3) array_like or dask.array.Array, optional
+        The RGB image to measure the intensity in, such as a slide from
+        `file_to_dask_array`. The chunks of a dask array are processed in
+        parallel.
+    max_padding : int, optional
+        See `rasterize_contours`.
+
+    Returns
+    -------
+    measurements : dict of str to numpy.ndarray
+        A table with one row per contour, as a dict of columns:
+
+        - ``area``, the area enclosed by the contour, like
+          ``cv2.contourArea``;
+        - ``perimeter``, the length of the closed contour, like
+          ``cv2.arcLength``;
+        - ``bbox_x_min``, ``bbox_y_min``, ``bbox_x_max`` and ``bbox_y_max``,
+          the inclusive bounding box of the contour;
+        - ``centroid_x`` and ``centroid_y``, the centroid of the contour, as
+          in `centers_of_contours`;
+
+        and, if `image` is given,
+
+        - ``n_pixels``, the number of pixels inside the contour, as filled
+          by `rasterize_contours`;
+        - ``hematoxylin_mean`` and ``hematoxylin_std``, the mean and
+          standard deviation of the hematoxylin intensity of those pixels,
+          as computed by `get_hematoxylin`, or NaN if there are none.
+
+        The columns can be passed to ``pandas.DataFrame``.
+    """
+    coordinates, offsets = _flatten_contours(contours)
+    # np.int32 is necessary for cv2.fillPoly
+    coordinates = coordinates.astype(np.int32, copy=False)
+    double_area, centroid_x, centroid_y = _contour_centroids(
+        coordinates, offsets)
+    steps = (coordinates[_next_vertex_indices(offsets)] - coordinates) \
+        .astype(np.float64)
+    bboxes, longest_segments = _contour_extents(coordinates, offsets)
+    measurements = {
+        'area': np.abs(double_area) / 2,
+        'perimeter': _segment_reduce(np.hypot(*steps.T), offsets),
+        'bbox_x_min': bboxes[:, 0],
+        'bbox_y_min': bboxes[:, 1],
+        'bbox_x_max': bboxes[:, 2],
+        'bbox_y_max': bboxes[:, 3],
+        'centroid_x': centroid_x,
+        'centroid_y': centroid_y,
+    }
+    if image is None:
+        return measurements
+
+    import dask
+    import dask.array as da
+    from functools import partial
+
+    if not isinstance(image, da.Array):
+        image = da.from_array(np.asarray(image), chunks=(1000, 1000, 3))
+    image = image.rechunk({2: 3})
+    measure_window = partial(
+        _measure_window,
+        coordinates=coordinates,
+        offsets=offsets,
+        index=BoundingBoxIndex(bboxes),
+        bboxes=bboxes,
+        longest_segments=longest_segments,
+        max_padding=max_padding,
+    )
+    row_edges = np.cumsum((0,) + image.chunks[0])
+    col_edges = np.cumsum((0,) + image.chunks[1])
+    blocks = image.to_delayed()[..., 0]
+    parts = [
+        dask.delayed(measure_window)(blocks[row, col], (
+            col_edges[col], row_edges[row],
+            col_edges[col + 1], row_edges[row + 1]))
+        for row in range(blocks.shape[0])
+        for col in range(blocks.shape[1])
+    ]
+
+    n_contours = len(offsets) - 1
+    counts = np.zeros(n_contours, dtype=np.int64)
+    sums = np.zeros(n_contours)
+    squares = np.zeros(n_contours)
+    for hits, part_counts, part_sums, part_squares in dask.compute(*parts):
+        # a contour can be hit by several chunks
+        np.add.at(counts, hits, part_counts)
+        np.add.at(sums, hits, part_sums)
+        np.add.at(squares, hits, part_squares)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = sums / counts
+        variance = np.maximum(squares / counts - mean ** 2, 0)
+    measurements['n_pixels'] = counts
+    measurements['hematoxylin_mean'] = mean
+    measurements['hematoxylin_std'] = np.sqrt(variance)
+    return measurements
+
+
+def _iter_row_bands(arr, multiple=1):
+    """Yield ``(y, band)`` for consecutive bands of rows of an image.
+
+    Every band but the last is a multiple of `multiple` rows high. A dask
+    array is computed one row of chunks at a time, and the rows that are
+    left over after the last whole multiple are carried over into the next
+    band, so every chunk is computed exactly once, and only a row of chunks
+    and fewer than `multiple` extra rows are held in memory. A NumPy array
+    is sliced into bands of `multiple` rows.
+    """
+    import dask.array as da
+
+    if not isinstance(arr, da.Array):
+        for y in range(0, arr.shape[0], multiple):
+            yield y, np.asarray(arr[y:y + multiple])
+        return
+    y, leftover = 0, None
+    edges = np.cumsum((0,) + arr.chunks[0])
+    for y0, y1 in zip(edges[:-1], edges[1:]):
+        with profiling.stage('compute'):
+            rows = np.asarray(arr[y0:y1].compute())
+        if leftover is not None:
+            rows = np.concatenate((leftover, rows))
+        height = rows.shape[0] - rows.shape[0] % multiple
+        if y1 == arr.shape[0]:
+            height = rows.shape[0]
+        if height:
+            yield y, rows[:height]
+            y += height
+        leftover = rows[height:] if height < rows.shape[0] else None
+
+
+def write_tiff(
+    arr, output, tile_size=256, pyramid=False, compression='zlib',
+    bigtiff=None,
+):
+    """Write an image to a tiled TIFF file, one row of chunks at a time.
+
+    Parameters
+    ----------
+    arr : (M, N[, C]) array_like or dask.array.Array
+        The image to write. If `arr` is a dask array, such as a lazy overlay
+        of a whole slide, only one row of its chunks is computed and held in
+        memory at a time.
+    output : str or file object
+        The path of the TIFF file, or a seekable file object opened in
+        binary mode.
+    tile_size : int, optional
+        The height and width of the tiles in the file, which must be a
+        multiple of 16.
+    pyramid : bool, optional
+        Whether to also write the levels of a 2x downsampled pyramid, as
+        sub-IFDs of the full resolution image, like pyramidal OME-TIFF files.
+    compression : str, optional
+        The compression of the tiles, passed to `tifffile`. JPEG and most
+        other codecs need the ``imagecodecs`` package; ``zlib`` does not.
+    bigtiff : bool, optional
+        Whether to write a BigTIFF file. By default, BigTIFF is used if the
+        image is larger than 4 GB.
+
+    Notes
+    -----
+    When a pyramid of a dask array is written, the first downsampled level
+    is kept in a temporary file, a quarter of the size of the image, while
+    the full resolution image is written.
+    """
+    import tempfile
+    from contextlib import ExitStack
+    import dask.array as da
+    import tifffile
+
+    stack = ExitStack()
+    arr_levels = _downsample_pyramid(arr) if pyramid else [arr]
+    reduced = None
+    if len(arr_levels) > 1 and isinstance(arr, da.Array):
+        # the full resolution bands are downsampled into a temporary file as
+        # they are written, so that the other levels do not compute `arr`
+        # again
+        scratch = stack.enter_context(tempfile.TemporaryFile())
+        reduced = np.memmap(
+            scratch, dtype=arr.dtype, mode='w+', shape=arr_levels[1].shape)
+        arr_levels = [arr] + _downsample_pyramid(reduced)[
+            :len(arr_levels) - 1]
+    if bigtiff is None:
+        bigtiff = arr.nbytes > 2 ** 32 - 2 ** 25
+    photometric = 'rgb' if arr.ndim == 3 and arr.shape[2] in (3, 4) \
+        else 'minisblack'
+    extrasamples = 'unassalpha' if photometric == 'rgb' \
+        and arr.shape[2] == 4 else None
+
+    def tiles(level):
+        for y0, band in _iter_row_bands(level, tile_size):
+            profiling.count('rows_written', band.shape[0])
+            if level is arr and reduced is not None:
+                # bands start at multiples of tile_size, which are even
+                reduced[y0 // 2:(y0 + band.shape[0] + 1) // 2] = \
+                    band[::2, ::2]
+            for y in range(0, band.shape[0], tile_size):
+                for x in range(0, band.shape[1], tile_size):
+                    # older versions of tifffile compress the tiles as they
+                    # are, which needs them to be contiguous
+                    yield np.ascontiguousarray(
+                        band[y:y + tile_size, x:x + tile_size])
+
+    with stack, tifffile.TiffWriter(output, bigtiff=bigtiff) as tif:
+        for level, level_arr in enumerate(arr_levels):
+            tif.write(
+                tiles(level_arr),
+                shape=level_arr.shape,
+                dtype=level_arr.dtype,
+                tile=(tile_size, tile_size),
+                photometric=photometric,
+                extrasamples=extrasamples,
+                compression=compression,
+                subifds=len(arr_levels) - 1 if level == 0 else None,
+                subfiletype=1 if level else 0,
+            )
+
+
+def _png_chunk(chunk_type, data):
+    import struct
+    import zlib
+
+    return (
+        struct.pack('>I', len(data)) + chunk_type + data
+        + struct.pack('>I', zlib.crc32(chunk_type + data))
+    )
+
+
+def write_png(arr, output, compression=6):
+    """Write an 8-bit image to a PNG file, one row of chunks at a time.
+
+    Unlike saving with PIL, which needs the whole image in memory, rows are
+    compressed as soon as their band has been computed and written to
+    `output` as separate ``IDAT`` chunks.
+
+    Parameters
+    ----------
+    arr : (M, N[, C]) array_like or dask.array.Array
+        The grayscale, gray and alpha, RGB or RGBA image to write, with
+        dtype uint8.
+    output : str or file object
+        The path of the PNG file, or a file object opened in binary mode.
+    compression : int, optional
+        The zlib compression level, from 0 to 9.
+
+    Raises
+    ------
+    ValueError
+        If `arr` is not an 8-bit image with 1 to 4 channels.
+    """
+    import struct
+    import zlib
+
+    channels = arr.shape[2] if arr.ndim == 3 else 1
+    if arr.dtype != np.uint8 or arr.ndim not in (2, 3) or channels > 4:
+        raise ValueError(
+            "the image must be uint8 with shape (M, N) or (M, N, 1-4)")
+    color_type = {1: 0, 2: 4, 3: 2, 4: 6}[channels]
+
+    if isinstance(output, str):
+        with open(output, 'wb') as f:
+            return write_png(arr, f, compression=compression)
+
+    output.write(b'\x89PNG\r\n\x1a\n')
+    output.write(_png_chunk(b'IHDR', struct.pack(
+        '>IIBBBBB', arr.shape[1], arr.shape[0], 8, color_type, 0, 0, 0)))
+    compressor = zlib.compressobj(compression)
+    for _, band in _iter_row_bands(arr):
+        # every scanline starts with the byte of filter type 0 (None)
+        scanlines = np.zeros(
+            (band.shape[0], 1 + band.shape[1] * channels), dtype=np.uint8)
+        scanlines[:, 1:] = band.reshape(band.shape[0], -1)
+        with profiling.stage('encode'):
+            data = compressor.compress(scanlines.tobytes())
+            if data:
+                output.write(_png_chunk(b'IDAT', data))
+        profiling.count('rows_written', band.shape[0])
+    output.write(_png_chunk(b'IDAT', compressor.flush()))
+    output.write(_png_chunk(b'IEND', b''))
+
+
+def write_image(arr, output, **kwargs):
+    """Write an image, choosing the writer from the file extension.
+
+    TIFF and PNG files are written one row of chunks at a time, with
+    `write_tiff` and `write_png`; other formats are computed in memory and
+    saved with PIL.
+
+    Parameters
+    ----------
+    arr : (M, N[, C]) array_like or dask.array.Array
+        The image to write.
+    output : str or file object
+        The path of the file, or a file object opened in binary mode whose
+        ``name`` has the extension of the format to write.
+    **kwargs
+        Passed to `write_tiff` or `write_png`.
+    """
+    from os.path import splitext
+
+    ext = splitext(str(getattr(output, 'name', output)))[1].lower()
+    if ext in ('.tif', '.tiff'):
+        write_tiff(arr, output, **kwargs)
+    elif ext == '.png':
+        write_png(arr, output, **kwargs)
+    else:
+        from PIL.Image import fromarray as array_to_pil_image
+        with profiling.stage('compute'):
+            arr = np.asarray(arr)
+        with profiling.stage('encode'):
+            array_to_pil_image(arr).save(output)
+
+
+def fit_spline_to_points(points, n_points=None, spacing=2.0, max_points=1000):
+    """Fit a closed B-spline through a sequence of points.
 
     Parameters
     ----------
-    points : numpy.ndarray
-        A list of sample vector arrays representing the curve.
+    points : array_like
+        An array with shape (N, 2) of the (X, Y) coordinates of the vertices
+        of a closed contour.
+    n_points : int, optional
+        The number of points to sample along the spline. If `None` (the
+        default), the number of points is chosen from the arc length of the
+        contour, so that consecutive points are about `spacing` pixels apart.
+    spacing : float, optional
+        The distance, in pixels, between consecutive sampled points when
+        `n_points` is `None`.
+    max_points : int, optional
+        The maximum number of points to sample when `n_points` is `None`.
 
     Returns
     -------
     spline_points : numpy.ndarray
-        An N-dimensional NumPy array representing the RGB output image with the
-        shape defined as `shape`.
+        A float64 array with shape (n_points, 2) of the (X, Y) coordinates of
+        the points sampled along the spline. Contours with fewer than 4
+        distinct vertices cannot be fit with a cubic spline, and are returned
+        unchanged.
     """
     # https://pathflowinterns.slack.com/archives/DTLUTM8NS/p1597243698287400
-    # TODO: are the docstrings/types correct?
     from scipy.interpolate import splprep, splev
-    tck, u = splprep(points.T, u=None, s=0.0, per=1)
-    u_new = np.linspace(u.min(), u.max(), 1000)
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    # splprep cannot handle repeated consecutive vertices
+    keep = np.any(points != np.roll(points, 1, axis=0), axis=1)
+    distinct = points[keep] if keep.any() else points[:1]
+    if len(distinct) < 4:
+        return points
+    # with per=1, the last point is assumed to be equal to the first
+    closed = np.vstack((distinct, distinct[:1]))
+    if n_points is None:
+        perimeter = np.hypot(*np.diff(closed, axis=0).T).sum()
+        n_points = int(np.clip(np.ceil(perimeter / spacing), 4, max_points))
+    tck, u = splprep(closed.T, u=None, s=0.0, per=1)
+    u_new = np.linspace(u.min(), u.max(), n_points)
     x_new, y_new = splev(u_new, tck, der=0)
     spline_points = np.vstack((x_new, y_new)).T
     return spline_points
 
 
+def _fit_spline_batch(contours, **kwargs):
+    return [fit_spline_to_points(contour, **kwargs) for contour in contours]
+
+
+def fit_splines(contours, processes=None, batch_size=2048, **kwargs):
+    """Fit a closed B-spline through each of many contours in parallel.
+
+    Parameters
+    ----------
+    contours : iterable of numpy.ndarray
+        The contours to fit, where each contour is an array of (X, Y)
+        coordinate pairs.
+    processes : int, optional
+        The number of worker processes to use. Defaults to the number of CPUs.
+        If 1, or if there is only a single batch, the contours are fit in the
+        current process, as they are in daemonic processes, which cannot
+        start workers.
+    batch_size : int, optional
+        The number of contours sent to a worker at a time.
+    **kwargs
+        Passed to `fit_spline_to_points`. By default, the number of points of
+        every spline is chosen from the contour's arc length.
+
+    Returns
+    -------
+    spline_contours : list of numpy.ndarray
+        The fitted contours, in the same order as `contours`.
+
+    See Also
+    --------
+    fit_spline_to_points : Fit a B-spline through a single contour.
+    """
+    import os
+    from functools import partial
+    from multiprocessing import current_process
+
+    contours = [np.asarray(contour).reshape(-1, 2) for contour in contours]
+    batches = [
+        contours[start:start + batch_size]
+        for start in range(0, len(contours), batch_size)
+    ]
+    profiling.count('splines_fitted', len(contours))
+    fit_batch = partial(_fit_spline_batch, **kwargs)
+    processes = processes or os.cpu_count() or 1
+    # daemonic processes, such as the workers of the batch command, cannot
+    # start processes of their own
+    if processes == 1 or len(batches) <= 1 or current_process().daemon:
+        batches = map(fit_batch, batches)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(processes) as executor:
+            batches = list(executor.map(fit_batch, batches))
+    return [contour for batch in batches for contour in batch]
+
+
 def region_to_contour(region, fit_spline=False):
     """Convert an XML region to a contour.
 